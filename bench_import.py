@@ -0,0 +1,41 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# 导入xwlb_daily时不应加载的SDK，它们只在第一次真正调用时才导入
+HEAVY_MODULES = ("google.generativeai", "notion_client", "requests", "smtplib", "httpx")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import xwlb_daily
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({"ms": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+def measure(runs):
+    """在全新的解释器中多次导入xwlb_daily，返回每次的耗时（毫秒）和被提前加载的重量级模块"""
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", PROBE], check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        loaded.update(result["loaded"])
+    return timings, sorted(loaded)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="测量xwlb_daily的冷启动导入耗时")
+    parser.add_argument("--runs", type=int, default=5, help="测量次数")
+    parser.add_argument("--max-ms", type=float, default=300, help="导入耗时中位数上限（毫秒），超出时返回非零退出码")
+    args = parser.parse_args()
+    
+    timings, loaded = measure(args.runs)
+    median = statistics.median(timings)
+    print(f"导入xwlb_daily耗时中位数: {median:.0f} ms（最小 {min(timings):.0f} ms，最大 {max(timings):.0f} ms，共 {args.runs} 次）")
+    if loaded:
+        print(f"导入时提前加载了重量级模块: {', '.join(loaded)}")
+    if loaded or median > args.max_ms:
+        sys.exit(1)
@@ -1,26 +1,95 @@
 import schedule
 import time
-import subprocess
+import datetime
+import os
+import threading
 import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# 流水线只在调度器启动时导入一次，之后每次任务都复用已建立的连接、客户端和缓存
+import xwlb_daily
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 文字版通常在当晚播出后陆续发布，从这个时间开始轮询当天的页面
+PROBE_START = os.environ.get("PROBE_START", "20:00")
+# 同时运行的任务数
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 2))
+# 任务超时（小时），超时后发送通知；线程无法被强制终止，任务结束前同名任务不会再次启动
+DAILY_JOB_TIMEOUT = float(os.environ.get("DAILY_JOB_TIMEOUT", 2))
+WAIT_JOB_TIMEOUT = float(os.environ.get("WAIT_JOB_TIMEOUT", xwlb_daily.PROBE_MAX_HOURS + 2))
+
+class JobRunner:
+    """在进程内的线程池中运行调度任务
+    
+    同名任务上一次还没结束时跳过本次触发；任务抛出的异常只记录并通知，不会影响调度器；
+    超过超时时间仍在运行的任务会发送一次通知。
+    """
+    
+    def __init__(self, max_workers=SCHEDULER_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._running = {}
+        self._lock = threading.Lock()
+    
+    def submit(self, name, func, *args, timeout_hours=DAILY_JOB_TIMEOUT):
+        with self._lock:
+            if name in self._running:
+                logger.warning(f"任务 {name} 上一次仍在运行，跳过本次触发")
+                return None
+            self._running[name] = {"deadline": time.time() + timeout_hours * 3600, "timed_out": False}
+        
+        logger.info(f"开始执行任务 {name}")
+        future = self.executor.submit(self._run, name, func, *args)
+        future.add_done_callback(lambda _: self._finish(name))
+        return future
+    
+    def _run(self, name, func, *args):
+        try:
+            result = func(*args)
+            logger.info(f"任务 {name} 执行完成")
+            return result
+        except Exception as e:
+            logger.error(f"任务 {name} 执行失败: {str(e)}")
+            xwlb_daily.send_error_notification("调度任务失败", f"任务 {name} 执行失败: {str(e)}", "新闻联播调度器",
+                                               log_info=f"完整错误堆栈: {traceback.format_exc()}")
+            xwlb_daily.flush_notifications()
+    
+    def _finish(self, name):
+        with self._lock:
+            self._running.pop(name, None)
+    
+    def check_timeouts(self):
+        """对超时的任务各发送一次通知"""
+        now = time.time()
+        with self._lock:
+            expired = [name for name, job in self._running.items() if not job["timed_out"] and now > job["deadline"]]
+            for name in expired:
+                self._running[name]["timed_out"] = True
+        for name in expired:
+            logger.error(f"任务 {name} 超时仍未结束")
+            xwlb_daily.send_error_notification("调度任务超时", f"任务 {name} 超过时间限制仍在运行", "新闻联播调度器")
+            xwlb_daily.flush_notifications()
+
+runner = JobRunner()
+
 def run_xwlb_daily():
-    """运行新闻联播摘要生成脚本"""
-    logger.info("开始执行新闻联播摘要生成任务")
-    try:
-        subprocess.run(["python", "xwlb_daily.py"], check=True)
-        logger.info("新闻联播摘要生成任务执行完成")
-    except subprocess.SubprocessError as e:
-        logger.error(f"新闻联播摘要生成任务执行失败: {str(e)}")
+    """运行新闻联播摘要生成任务（处理昨天）"""
+    runner.submit("daily", xwlb_daily.main, timeout_hours=DAILY_JOB_TIMEOUT)
+
+def wait_and_run_today():
+    """轮询当天的文字版，发布后立即处理"""
+    runner.submit("wait", xwlb_daily.watch, datetime.datetime.now(), timeout_hours=WAIT_JOB_TIMEOUT)
 
 if __name__ == "__main__":
-    # 设置每天早上9点运行
+    # 每晚等待当天的文字版发布后立即处理
+    schedule.every().day.at(PROBE_START).do(wait_and_run_today)
+    # 早上9点再处理一次昨天的，作为兜底（已完成的阶段会直接跳过）
     schedule.every().day.at("09:00").do(run_xwlb_daily)
     
-    logger.info("调度器已启动，将在每天上午9点执行新闻联播摘要任务")
+    logger.info(f"调度器已启动，每天{PROBE_START}开始等待当天的文字版，上午9点兜底处理前一天")
     
     # 首次运行
     run_xwlb_daily()
@@ -28,4 +97,5 @@ if __name__ == "__main__":
     # 保持程序运行
     while True:
         schedule.run_pending()
-        time.sleep(60)
+        runner.check_timeouts()
+        time.sleep(30)
@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import glob
+import html
+import logging
+import os
+import re
+import sqlite3
+import time
+from dotenv import load_dotenv
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 本地全文检索库，默认放在运行记录目录中，随运行记录一起保留
+ARCHIVE_PATH = os.environ.get("XWLB_ARCHIVE_PATH", os.path.join(os.environ.get("XWLB_RUNS_DIR", "runs"), "archive.sqlite3"))
+# trigram分词器要求检索词至少3个字符，更短的词改用LIKE逐条扫描
+FTS_MIN_CHARS = 3
+# 片段长度（token数，trigram下约等于字数）
+SNIPPET_TOKENS = int(os.environ.get("XWLB_SNIPPET_TOKENS", 24))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL UNIQUE,
+    title TEXT,
+    url TEXT,
+    content TEXT,
+    summary TEXT,
+    notes_html TEXT,
+    notes_text TEXT,
+    notion_page_id TEXT,
+    source TEXT,
+    updated_at TEXT
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS broadcasts_fts USING fts5(
+    title, content, summary, notes_text,
+    content='broadcasts', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS broadcasts_ai AFTER INSERT ON broadcasts BEGIN
+    INSERT INTO broadcasts_fts(rowid, title, content, summary, notes_text)
+    VALUES (new.id, new.title, new.content, new.summary, new.notes_text);
+END;
+CREATE TRIGGER IF NOT EXISTS broadcasts_ad AFTER DELETE ON broadcasts BEGIN
+    INSERT INTO broadcasts_fts(broadcasts_fts, rowid, title, content, summary, notes_text)
+    VALUES ('delete', old.id, old.title, old.content, old.summary, old.notes_text);
+END;
+CREATE TRIGGER IF NOT EXISTS broadcasts_au AFTER UPDATE ON broadcasts BEGIN
+    INSERT INTO broadcasts_fts(broadcasts_fts, rowid, title, content, summary, notes_text)
+    VALUES ('delete', old.id, old.title, old.content, old.summary, old.notes_text);
+    INSERT INTO broadcasts_fts(rowid, title, content, summary, notes_text)
+    VALUES (new.id, new.title, new.content, new.summary, new.notes_text);
+END;
+"""
+
+# 各列在bm25排序中的权重：标题、原文、摘要、笔记
+COLUMN_WEIGHTS = (5.0, 1.0, 3.0, 2.0)
+
+TITLE_DATE_PATTERN = re.compile(r"(\d{4})年(\d{1,2})月(\d{1,2})日")
+
+def html_to_text(body):
+    """去掉HTML标签，只保留笔记中的文字用于检索"""
+    if not body:
+        return None
+    body = re.sub(r"(?is)<(script|style)\b.*?</\1>", " ", body)
+    text = html.unescape(re.sub(r"<[^>]+>", " ", body))
+    return re.sub(r"\s+", " ", text).strip()
+
+def build_match_query(query):
+    """把用户输入的检索词转成FTS5查询：每个词加引号按短语匹配，多个词之间为AND"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+def make_snippet(text, term, width=SNIPPET_TOKENS):
+    """在text中截取term附近的片段，用于LIKE检索的结果"""
+    index = text.find(term)
+    if index < 0:
+        return text[:width * 2]
+    start = max(0, index - width)
+    end = min(len(text), index + len(term) + width)
+    return ("…" if start > 0 else "") + text[start:index] + f"[{term}]" + text[index + len(term):end] + ("…" if end < len(text) else "")
+
+class TranscriptArchive:
+    """新闻联播原文、摘要和笔记的本地存档，带FTS5全文索引
+    
+    每期节目按播出日期保存一行，写入时只覆盖传入的非空字段，流水线可以在各阶段分别写入。
+    每次操作单独打开连接，多个线程和进程同时写入时由SQLite的锁保证一致。
+    """
+    
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        self._initialized = False
+    
+    def connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._initialized = True
+        return conn
+    
+    def upsert(self, date, title=None, url=None, content=None, summary=None, notes_html=None, notion_page_id=None, source="run"):
+        """写入一期节目，已有记录时只更新传入的非空字段"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(
+                    """
+                    INSERT INTO broadcasts (date, title, url, content, summary, notes_html, notes_text, notion_page_id, source, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(date) DO UPDATE SET
+                        title = COALESCE(excluded.title, title),
+                        url = COALESCE(excluded.url, url),
+                        content = COALESCE(excluded.content, content),
+                        summary = COALESCE(excluded.summary, summary),
+                        notes_html = COALESCE(excluded.notes_html, notes_html),
+                        notes_text = COALESCE(excluded.notes_text, notes_text),
+                        notion_page_id = COALESCE(excluded.notion_page_id, notion_page_id),
+                        source = excluded.source,
+                        updated_at = excluded.updated_at
+                    """,
+                    (date, title, url, content, summary, notes_html, html_to_text(notes_html), notion_page_id, source,
+                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                )
+        finally:
+            conn.close()
+    
+    def get(self, date):
+        conn = self.connect()
+        try:
+            row = conn.execute("SELECT * FROM broadcasts WHERE date = ?", (date,)).fetchone()
+            return dict(row) if row else None
+        finally:
+            conn.close()
+    
+    def dates(self):
+        """返回已有原文的播出日期"""
+        conn = self.connect()
+        try:
+            return {row["date"] for row in conn.execute("SELECT date FROM broadcasts WHERE content IS NOT NULL")}
+        finally:
+            conn.close()
+    
+    def search(self, query, limit=20, since=None, until=None):
+        """全文检索，返回按相关度排序的{date, title, snippet, score}列表
+        
+        所有检索词都不少于FTS_MIN_CHARS个字符时使用FTS5索引按bm25排序；
+        有更短的词（例如两个字的中文词）时改用LIKE扫描，按出现次数排序。
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        conn = self.connect()
+        try:
+            if all(len(term) >= FTS_MIN_CHARS for term in terms):
+                return self._search_fts(conn, query, limit, since, until)
+            return self._search_like(conn, terms, limit, since, until)
+        finally:
+            conn.close()
+    
+    def _search_fts(self, conn, query, limit, since, until):
+        weights = ", ".join(str(weight) for weight in COLUMN_WEIGHTS)
+        sql = f"""
+            SELECT b.date, b.title,
+                   snippet(broadcasts_fts, -1, '[', ']', '…', {SNIPPET_TOKENS}) AS snippet,
+                   bm25(broadcasts_fts, {weights}) AS score
+            FROM broadcasts_fts JOIN broadcasts b ON b.id = broadcasts_fts.rowid
+            WHERE broadcasts_fts MATCH ? AND b.date >= ? AND b.date <= ?
+            ORDER BY score LIMIT ?
+        """
+        rows = conn.execute(sql, (build_match_query(query), since or "", until or "9999", limit))
+        return [{"date": row["date"], "title": row["title"], "snippet": row["snippet"], "score": round(-row["score"], 3)} for row in rows]
+    
+    def _search_like(self, conn, terms, limit, since, until):
+        fields = "COALESCE(title, '') || char(10) || COALESCE(summary, '') || char(10) || COALESCE(notes_text, '') || char(10) || COALESCE(content, '')"
+        conditions = " AND ".join(f"instr({fields}, ?) > 0" for _ in terms)
+        sql = f"SELECT date, title, {fields} AS text FROM broadcasts WHERE {conditions} AND date >= ? AND date <= ?"
+        results = []
+        for row in conn.execute(sql, (*terms, since or "", until or "9999")):
+            text = row["text"]
+            results.append({
+                "date": row["date"],
+                "title": row["title"],
+                "snippet": make_snippet(text.replace("\n", " "), terms[0]),
+                "score": sum(text.count(term) for term in terms),
+            })
+        results.sort(key=lambda item: (item["score"], item["date"]), reverse=True)
+        return results[:limit]
+    
+    def rebuild(self):
+        """重建全文索引"""
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO broadcasts_fts(broadcasts_fts) VALUES ('rebuild')")
+        finally:
+            conn.close()
+
+def parse_notion_blocks(blocks):
+    """按"摘要"和"原文"两个二级标题把页面子块拆回摘要和原文"""
+    sections = {"摘要": [], "原文": []}
+    current = None
+    for block in blocks:
+        block_type = block.get("type")
+        text = "".join(part.get("plain_text") or part.get("text", {}).get("content", "")
+                       for part in block.get(block_type, {}).get("rich_text", []))
+        if block_type == "heading_2":
+            current = text.strip() if text.strip() in sections else None
+        elif block_type == "paragraph" and current:
+            sections[current].append(text)
+    # 保存时按2000字符切块，原样拼接即可还原
+    return "".join(sections["摘要"]) or None, "".join(sections["原文"]) or None
+
+def notion_page_date(page, schema):
+    """从页面标题中解析播出日期；标题中没有日期时使用日期属性（保存时的日期）"""
+    properties = page.get("properties", {})
+    title = "".join(part.get("plain_text", "") for part in properties.get(schema["title_property"], {}).get("title", []))
+    match = TITLE_DATE_PATTERN.search(title)
+    if match:
+        return title, datetime.date(*(int(part) for part in match.groups())).isoformat()
+    date_value = (properties.get(schema["date_property"], {}).get("date") or {}).get("start")
+    return title, date_value[:10] if date_value else None
+
+def import_from_notion(archive, overwrite=False):
+    """从Notion数据库回填存档，已有原文的日期默认跳过，不再读取其子块"""
+    import xwlb_daily
+    schema = xwlb_daily.get_notion_schema()
+    if not schema:
+        logger.error("无法获取Notion数据库属性，导入失败")
+        return 0
+    existing = set() if overwrite else archive.dates()
+    imported = 0
+    cursor = None
+    while True:
+        response = xwlb_daily.query_notion_pages(start_cursor=cursor)
+        for page in response.get("results", []):
+            title, date = notion_page_date(page, schema)
+            if not date or date in existing:
+                continue
+            blocks = []
+            block_cursor = None
+            while True:
+                block_response = xwlb_daily.list_notion_blocks(page["id"], start_cursor=block_cursor)
+                blocks.extend(block_response.get("results", []))
+                if not block_response.get("has_more"):
+                    break
+                block_cursor = block_response.get("next_cursor")
+            summary, content = parse_notion_blocks(blocks)
+            url, _ = xwlb_daily.get_broadcast_url(datetime.datetime.strptime(date, "%Y-%m-%d"))
+            archive.upsert(date, title=title or None, url=url, content=content, summary=summary, notion_page_id=page["id"], source="notion")
+            existing.add(date)
+            imported += 1
+            logger.info(f"已从Notion导入 {date} {title}")
+        if not response.get("has_more"):
+            break
+        cursor = response.get("next_cursor")
+    return imported
+
+def import_from_runs(archive):
+    """从本地运行记录回填存档，运行记录中有HTML笔记，Notion中没有"""
+    import xwlb_daily
+    imported = 0
+    for path in sorted(glob.glob(os.path.join(xwlb_daily.RUNS_DIR, "????-??-??.json"))):
+        run_id = os.path.basename(path)[:-len(".json")]
+        try:
+            date = datetime.datetime.strptime(run_id, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if xwlb_daily.archive_stage(xwlb_daily.RunJournal(run_id), date, archive=archive):
+            imported += 1
+    return imported
+
+def parse_day(value):
+    """校验YYYY-MM-DD格式的日期参数，返回原字符串"""
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式应为YYYY-MM-DD: {value}")
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="新闻联播本地存档的全文检索和导入")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    search_parser = subparsers.add_parser("search", help="全文检索，不访问任何远程服务")
+    search_parser.add_argument("query", nargs="+", help="检索词，多个词之间为AND")
+    search_parser.add_argument("--since", type=parse_day, help="起始日期（包含）")
+    search_parser.add_argument("--until", type=parse_day, help="结束日期（包含）")
+    search_parser.add_argument("--limit", type=int, default=20, help="最多返回的条数")
+    show_parser = subparsers.add_parser("show", help="输出某一天的存档内容")
+    show_parser.add_argument("date", type=parse_day)
+    show_parser.add_argument("--field", choices=("summary", "content", "notes_text", "notes_html"), default="summary")
+    notion_parser = subparsers.add_parser("import-notion", help="从Notion数据库回填")
+    notion_parser.add_argument("--overwrite", action="store_true", help="重新导入已有原文的日期")
+    subparsers.add_parser("import-runs", help="从本地运行记录回填")
+    subparsers.add_parser("rebuild", help="重建全文索引")
+    args = parser.parse_args()
+    
+    archive = TranscriptArchive()
+    if args.command == "search":
+        start = time.perf_counter()
+        results = archive.search(" ".join(args.query), limit=args.limit, since=args.since, until=args.until)
+        for result in results:
+            print(f"{result['date']}  {result['title'] or ''}  ({result['score']})")
+            print(f"    {result['snippet']}")
+        print(f"共 {len(results)} 条结果，耗时 {(time.perf_counter() - start) * 1000:.1f} ms")
+    elif args.command == "show":
+        record = archive.get(args.date)
+        if not record:
+            raise SystemExit(f"存档中没有 {args.date}")
+        print(record[args.field] or "")
+    else:
+        import xwlb_daily
+        xwlb_daily.setup_logging()
+        if args.command == "import-notion":
+            count = import_from_notion(archive, overwrite=args.overwrite)
+        elif args.command == "import-runs":
+            count = import_from_runs(archive)
+        else:
+            archive.rebuild()
+            count = None
+        if count is not None:
+            logger.info(f"共导入 {count} 期")
@@ -0,0 +1,732 @@
+import asyncio
+import argparse
+import datetime
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
+import time
+import httpx
+import aiosmtplib
+from notion_client import AsyncClient, APIResponseError, APIErrorCode
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
+import google.generativeai as genai
+
+import xwlb_daily
+from xwlb_daily import (
+    PrivacyFilter, RunJournal, JinaReader, jina_headers, API_CONCURRENCY, JINA_API_KEY, GEMINI_API_KEY,
+    NOTION_API_KEY, NOTION_DATABASE_ID, EMAIL_ADDRESS, EMAIL_PASSWORD, EMAIL_SENDER,
+    JINA_POOL_SIZE, JINA_CONNECT_TIMEOUT, JINA_READ_TIMEOUT, SMTP_TIMEOUT, NOTION_BATCH_SIZE,
+    SUMMARY_PLACEHOLDER, NOTES_FALLBACK_MARKER, STREAM_NOTES, NotesCheckpoint, clear_notes_checkpoints, build_continue_prompt, cache_key, cache_get, cache_set, check_required_env,
+    get_broadcast_url, check_jina_result, report_jina_http_error, build_summary_prompt, build_notes_prompt,
+    is_transient_gemini_error, report_gemini_error, build_notes_fallback, get_cached_notion_schema,
+    parse_notion_schema, remember_notion_schema, build_notion_children, build_notion_properties,
+    is_notion_rate_limited, is_retryable_notion_error, wait_notion_retry,
+    send_error_notification, flush_notifications, parse_date, GEMINI_TOKEN_BUDGET, GEMINI_MAP_MODEL,
+    estimate_tokens, split_transcript, build_segment_prompt, GENERATION_MODE, GEMINI_SINGLE_PASS_MODEL,
+    STRUCTURED_NOTES_SCHEMA, build_structured_prompt, render_summary_text, render_notes_html,
+    GEMINI_SUMMARY_MODELS, GEMINI_NOTES_MODELS, GEMINI_HEDGE_DELAY, GEMINI_HEDGE_MODEL, model_router,
+    gemini_api_name, is_gemini_auth_error, rate_limiter, usage_ledger, record_jina_usage, record_gemini_usage,
+    run_metrics, before_sleep_record, archive_stage, journal_complete, profile_stage, DeliveryLog, load_subscribers, classify_delivery, split_batches,
+    build_delivery_message, serialize_message, DELIVERY_WORKERS, DELIVERY_ROUNDS, is_gemini_quota_error, parse_gemini_retry_delay, DIRECT_FETCH, DIRECT_TIMEOUT, DIRECT_USER_AGENT,
+    build_conditional_headers, handle_direct_response, setup_logging, acquire_date_lock, release_date_lock,
+)
+
+# 设置日志
+logger = logging.getLogger(__name__)
+logger.addFilter(PrivacyFilter())
+
+class AsyncPipeline:
+    """基于asyncio的新闻联播流水线
+    
+    与xwlb_daily.process_broadcast()的阶段和运行记录完全相同，但Jina、Gemini、Notion和SMTP
+    都使用异步客户端。多个日期在同一个事件循环中并发处理，每个外部服务各用一个信号量限制并发。
+    """
+    
+    def __init__(self, concurrency=None):
+        limits = concurrency or API_CONCURRENCY
+        self.semaphores = {name: asyncio.Semaphore(max(1, limit)) for name, limit in limits.items()}
+        self.jina = httpx.AsyncClient(
+            headers=jina_headers(JINA_API_KEY),
+            timeout=httpx.Timeout(JINA_READ_TIMEOUT, connect=JINA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=JINA_POOL_SIZE, max_keepalive_connections=JINA_POOL_SIZE),
+        )
+        # 直接抓取页面使用单独的客户端，不带Jina的认证头
+        self.direct = httpx.AsyncClient(
+            headers={"User-Agent": DIRECT_USER_AGENT},
+            timeout=DIRECT_TIMEOUT,
+            limits=httpx.Limits(max_connections=max(1, limits.get("mrxwlb", 1))),
+        )
+        self.notion = AsyncClient(auth=NOTION_API_KEY)
+        genai.configure(api_key=GEMINI_API_KEY)
+    
+    @asynccontextmanager
+    async def api_slot(self, api_name):
+        """占用一个并发名额，并按与同步版本共享的令牌桶限速、计入当日用量
+        
+        令牌桶和用量账本在文件锁内读写JSON，放到线程中执行，不阻塞其他日期的协程。
+        """
+        async with self.semaphores[api_name]:
+            wait_seconds = await asyncio.to_thread(rate_limiter.reserve, api_name)
+            if wait_seconds > 0:
+                run_metrics.add(f"api.{api_name}", wait_seconds=wait_seconds)
+                await asyncio.sleep(wait_seconds)
+            await asyncio.to_thread(usage_ledger.record, api_name)
+            with run_metrics.stage(f"api.{api_name}"):
+                yield
+    
+    async def aclose(self):
+        await self.jina.aclose()
+        await self.direct.aclose()
+        await self.notion.aclose()
+    
+    async def fetch_direct(self, url):
+        """直接下载页面并提取文稿，与xwlb_daily.fetch_direct()相同"""
+        entry = cache_get("direct", cache_key(url))
+        async with self.api_slot("mrxwlb"):
+            response = await self.direct.get(url, headers=build_conditional_headers(entry))
+        # 提取正文后会写入缓存并记录用量（带文件锁），放到线程中执行
+        return await asyncio.to_thread(handle_direct_response, url, response.status_code, response.headers, response.content, entry)
+    
+    async def fetch_webpage(self, url):
+        """读取新闻联播页面：先直接抓取，失败或内容不完整时使用Jina AI"""
+        if DIRECT_FETCH:
+            try:
+                result = await self.fetch_direct(url)
+                if result:
+                    return result
+            except httpx.HTTPError as e:
+                logger.warning(f"直接抓取失败: {str(e)}")
+            logger.info("改用Jina AI读取网页内容")
+        return await self.read_webpage(url)
+    
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        before_sleep=before_sleep_record(logger)
+    )
+    async def read_webpage(self, url):
+        """使用Jina AI的Reader API异步读取网页内容"""
+        cached = cache_get("jina", cache_key(url))
+        if cached:
+            return cached
+        
+        payload = {
+            "url": url
+        }
+        
+        try:
+            logger.info(f"正在使用Jina AI读取网页内容")
+            async with self.api_slot("jina"):
+                response = await self.jina.post(JinaReader.endpoint, json=payload)
+            run_metrics.add("api.jina", bytes=len(response.content))
+            response.raise_for_status()
+            
+            result = response.json()
+            
+            # 检查Jina AI返回的结果是否成功
+            check_jina_result(result, url)
+            await asyncio.to_thread(record_jina_usage, result)
+            
+            await asyncio.to_thread(cache_set, "jina", cache_key(url), result)
+            return result
+        except httpx.HTTPStatusError as e:
+            import traceback
+            log_details = f"请求URL: {url}\n请求体: {payload}\n响应状态码: {e.response.status_code}\n响应内容: {e.response.text}\n完整错误: {traceback.format_exc()}"
+            # 429时会在文件锁内写入限速状态，放到线程中执行
+            await asyncio.to_thread(report_jina_http_error, e.response.status_code, e, log_details)
+            raise
+        except Exception as e:
+            import traceback
+            error_msg = f"读取网页内容失败: {str(e)}"
+            logger.error(error_msg)
+            if "API" in str(e) or "auth" in str(e).lower() or "key" in str(e).lower():
+                log_details = f"请求URL: {url}\n请求体: {payload}\n完整错误: {traceback.format_exc()}"
+                send_error_notification("未知API错误", str(e), "Jina AI", log_info=log_details)
+            raise
+    
+    async def generate(self, task, model_name, prompt, stream=False):
+        """异步调用一个Gemini模型并记录延迟和成败，结果按模型和prompt缓存，stream=True时流式写入检查点"""
+        gemini_cache_key = cache_key(model_name, prompt)
+        cached = cache_get("gemini", gemini_cache_key)
+        if cached:
+            return cached
+        
+        model = genai.GenerativeModel(model_name)
+        start = time.time()
+        response = None
+        try:
+            async with self.api_slot(gemini_api_name(model_name)):
+                if stream:
+                    checkpoint = NotesCheckpoint(gemini_cache_key)
+                    text = await self.stream_notes(model, prompt, checkpoint)
+                    checkpoint.clear()
+                else:
+                    response = await model.generate_content_async(prompt)
+                    text = response.text
+        except Exception as e:
+            error_str = str(e)
+            model_router.record(task, model_name, time.time() - start, error_str)
+            if is_gemini_quota_error(error_str):
+                await asyncio.to_thread(rate_limiter.block, gemini_api_name(model_name), parse_gemini_retry_delay(error_str))
+            raise
+        model_router.record(task, model_name, time.time() - start)
+        await asyncio.to_thread(record_gemini_usage, model_name, prompt, text, response)
+        await asyncio.to_thread(cache_set, "gemini", gemini_cache_key, text)
+        return text
+    
+    async def generate_with_fallback(self, task, chain, prompt, stream=False):
+        """按路由顺序依次尝试模型链，与xwlb_daily.generate_with_fallback()相同，返回(模型名, 文本)"""
+        for model_name in chain:
+            cached = cache_get("gemini", cache_key(model_name, prompt))
+            if cached:
+                return model_name, cached
+        
+        last_error = None
+        for model_name in model_router.route(task, chain):
+            try:
+                return model_name, await self.generate(task, model_name, prompt, stream=stream)
+            except Exception as e:
+                error_str = str(e)
+                if is_gemini_auth_error(error_str):
+                    raise
+                logger.warning(f"{model_name} 调用失败，尝试下一个模型: {error_str}")
+                last_error = e
+        raise last_error
+    
+    async def generate_hedged(self, task, chain, prompt, stream=False):
+        """超过GEMINI_HEDGE_DELAY秒仍未完成时同时请求对冲模型，先得到的有效结果胜出，另一个请求被取消
+        
+        与xwlb_daily.generate_hedged()相同，只在超时时对冲，主请求提前失败时直接抛出以便从检查点续写。
+        """
+        primary = asyncio.create_task(self.generate_with_fallback(task, chain, prompt, stream))
+        if GEMINI_HEDGE_DELAY <= 0 or not GEMINI_HEDGE_MODEL or GEMINI_HEDGE_MODEL in chain:
+            return (await primary)[1]
+        
+        done, _ = await asyncio.wait([primary], timeout=GEMINI_HEDGE_DELAY)
+        if done:
+            return primary.result()[1]
+        logger.info(f"{'/'.join(chain)} 在{int(GEMINI_HEDGE_DELAY)}秒内未完成，同时请求 {GEMINI_HEDGE_MODEL}")
+        hedge = asyncio.create_task(self.generate_with_fallback(task, [GEMINI_HEDGE_MODEL], prompt))
+        
+        pending = {primary, hedge}
+        last_error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task_done in done:
+                    try:
+                        model_name, text = task_done.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if text.strip():
+                        logger.info(f"采用 {model_name} 的结果")
+                        if task_done is hedge:
+                            # 取消后主请求不会再写入检查点，它留下的部分结果已经没有用处
+                            primary.cancel()
+                            clear_notes_checkpoints(chain, prompt)
+                        return text
+        finally:
+            # 对冲模型失败时主请求的检查点保留在磁盘上，下次仍可从断点继续
+            for task_pending in pending:
+                task_pending.cancel()
+        raise last_error or ValueError("Gemini返回了空内容")
+    
+    async def generate_structured_notes(self, content, title):
+        """一次调用同时生成摘要和笔记的结构化内容，失败时返回None，由调用方退回分别生成"""
+        prompt = build_structured_prompt(content, title)
+        structured_cache_key = cache_key(GEMINI_SINGLE_PASS_MODEL, "json", prompt)
+        cached = cache_get("gemini", structured_cache_key)
+        if cached:
+            return cached
+        
+        model = genai.GenerativeModel(GEMINI_SINGLE_PASS_MODEL, generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": STRUCTURED_NOTES_SCHEMA,
+        })
+        for attempt in range(3):
+            try:
+                async with self.api_slot("gemini_pro"):
+                    response = await model.generate_content_async(prompt)
+                await asyncio.to_thread(record_gemini_usage, GEMINI_SINGLE_PASS_MODEL, prompt, response.text, response)
+                data = json.loads(response.text)
+                await asyncio.to_thread(cache_set, "gemini", structured_cache_key, data)
+                return data
+            except json.JSONDecodeError as e:
+                logger.warning(f"结构化输出不是合法的JSON，将进行重试: {str(e)}")
+            except Exception as e:
+                error_str = str(e)
+                if not is_transient_gemini_error(error_str):
+                    report_gemini_error(error_str, GEMINI_SINGLE_PASS_MODEL, content, prompt)
+                    break
+                logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
+            await asyncio.sleep(4 * (attempt + 1))
+        logger.warning("一次性生成失败，改为分别生成摘要和笔记")
+        return None
+    
+    async def stream_notes(self, model, prompt, checkpoint):
+        """流式生成HTML笔记，与xwlb_daily.stream_notes()相同，每段输出立即写入检查点"""
+        if checkpoint.text:
+            logger.info(f"从已生成的 {len(checkpoint.text)} 字符处继续生成笔记")
+            request_prompt = build_continue_prompt(prompt, checkpoint.text)
+        else:
+            request_prompt = prompt
+        
+        response = await model.generate_content_async(request_prompt, stream=True)
+        async for chunk in response:
+            try:
+                text = chunk.text
+            except ValueError:
+                continue
+            checkpoint.append(text)
+        return checkpoint.result()
+    
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        before_sleep=before_sleep_record(logger)
+    )
+    async def summarize_with_gemini(self, content):
+        """使用Google Gemini API异步总结内容"""
+        prompt = build_summary_prompt(content)
+        try:
+            logger.info("正在总结内容")
+            model_name, text = await self.generate_with_fallback("summary", GEMINI_SUMMARY_MODELS, prompt)
+            return text
+        except Exception as e:
+            error_str = str(e)
+            logger.error(f"生成摘要失败: {error_str}")
+            
+            # 对于500错误或服务不可用，让重试机制处理
+            if is_transient_gemini_error(error_str):
+                logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
+                raise
+            
+            report_gemini_error(error_str, "/".join(GEMINI_SUMMARY_MODELS), content, prompt)
+            raise
+    
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        before_sleep=before_sleep_record(logger)
+    )
+    async def generate_html_notes(self, content, title):
+        """使用Google Gemini API异步生成HTML格式的笔记"""
+        prompt = build_notes_prompt(content, title)
+        for model_name in GEMINI_NOTES_MODELS + [GEMINI_HEDGE_MODEL]:
+            cached = cache_get("gemini", cache_key(model_name, prompt))
+            if cached:
+                return cached
+        try:
+            logger.info("正在生成笔记")
+            return await self.generate_hedged("notes", GEMINI_NOTES_MODELS, prompt, stream=STREAM_NOTES)
+        except Exception as e:
+            error_str = str(e)
+            logger.error(f"生成HTML笔记失败: {error_str}")
+            
+            # 对于500错误或服务不可用，让重试机制处理
+            if is_transient_gemini_error(error_str):
+                logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
+                raise
+            
+            report_gemini_error(error_str, "/".join(GEMINI_NOTES_MODELS), content, prompt)
+            return build_notes_fallback(title, content, error_str)
+    
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=1, min=4, max=10),
+        retry=retry_if_exception(lambda e: is_transient_gemini_error(str(e))),
+        before_sleep=before_sleep_record(logger)
+    )
+    async def summarize_segment(self, prompt):
+        """用flash模型提炼一个分段"""
+        return await self.generate("segment", GEMINI_MAP_MODEL, prompt)
+    
+    async def condense_transcript(self, content, token_budget=None, max_rounds=3):
+        """文稿超出token预算时并发分段提炼，与xwlb_daily.condense_transcript()相同"""
+        token_budget = token_budget or GEMINI_TOKEN_BUDGET
+        for round_index in range(max_rounds):
+            if estimate_tokens(content) <= token_budget:
+                return content
+            
+            segments = split_transcript(content)
+            total = len(segments)
+            logger.info(f"内容约 {estimate_tokens(content)} token，超出预算 {token_budget}，分 {total} 段并行提炼（第{round_index + 1}轮）")
+            
+            async def map_segment(index, segment):
+                try:
+                    return await self.summarize_segment(build_segment_prompt(segment, index, total))
+                except Exception as e:
+                    logger.warning(f"第{index}段提炼失败，保留原文: {str(e)}")
+                    return segment
+            
+            summaries = await asyncio.gather(*(map_segment(i, seg) for i, seg in enumerate(segments, start=1)))
+            content = "\n\n".join(summaries)
+        return content
+    
+    async def summarize_content(self, content):
+        """生成摘要，重试仍失败时返回占位摘要而不是抛出异常"""
+        try:
+            summary = await self.summarize_with_gemini(content)
+            logger.info(f"成功生成摘要，长度: {len(summary)} 字符")
+            return summary
+        except Exception as e:
+            import traceback
+            error_str = str(e)
+            
+            if "RetryError" in error_str:
+                log_details = f"Gemini API重试3次后仍然失败\n模型: {'/'.join(GEMINI_SUMMARY_MODELS)}\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\n完整错误: {traceback.format_exc()}"
+                send_error_notification("重试失败", "Gemini API摘要生成重试3次后仍然失败", "Gemini AI", log_info=log_details)
+            
+            logger.error(f"生成摘要失败，将跳过摘要步骤: {error_str}")
+            return SUMMARY_PLACEHOLDER
+    
+    async def get_notion_schema(self, refresh=False):
+        """获取数据库标题和日期属性的名称，与同步版本共用缓存"""
+        if not refresh:
+            cached = get_cached_notion_schema()
+            if cached:
+                return cached
+        try:
+            async with self.api_slot("notion"):
+                database = await self.notion.databases.retrieve(database_id=NOTION_DATABASE_ID)
+        except Exception as e:
+            logger.error(f"获取Notion数据库属性失败: {str(e)}")
+            return None
+        return remember_notion_schema(parse_notion_schema(database))
+    
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_notion_retry,
+        retry=retry_if_exception(is_notion_rate_limited),
+        before_sleep=before_sleep_record(logger),
+        reraise=True
+    )
+    async def create_notion_page(self, properties, children):
+        """创建Notion页面，只在被限流时重试，避免重复建页"""
+        async with self.api_slot("notion"):
+            return await self.notion.pages.create(
+                parent={"database_id": NOTION_DATABASE_ID},
+                properties=properties,
+                children=children
+            )
+    
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_notion_retry,
+        retry=retry_if_exception(is_retryable_notion_error),
+        before_sleep=before_sleep_record(logger),
+        reraise=True
+    )
+    async def append_notion_blocks(self, block_id, children):
+        """向页面追加一批子块，单批失败只重试这一批"""
+        async with self.api_slot("notion"):
+            return await self.notion.blocks.children.append(block_id=block_id, children=children)
+    
+    async def save_to_notion(self, title, content, summary, date=None, resume=None, on_progress=None):
+        """将原文和总结保存到Notion，参数和返回值与xwlb_daily.save_to_notion()相同"""
+        schema = await self.get_notion_schema()
+        if not schema:
+            logger.error("无法获取Notion数据库属性，保存失败")
+            return None
+        
+        children = build_notion_children(content, summary)
+        
+        def report_progress(page_id, appended):
+            if on_progress:
+                on_progress({"page_id": page_id, "appended": appended})
+        
+        try:
+            if resume:
+                page_id = resume["page_id"]
+                appended = resume["appended"]
+                logger.info(f"继续写入Notion页面，已写入 {appended}/{len(children)} 个块")
+            else:
+                logger.info(f"正在保存到Notion")
+                first_batch = children[:NOTION_BATCH_SIZE]
+                try:
+                    page = await self.create_notion_page(build_notion_properties(schema, title, date), first_batch)
+                except APIResponseError as e:
+                    if e.code != APIErrorCode.ValidationError:
+                        raise
+                    # 校验失败可能是缓存的数据库结构已过期，刷新后版本号有变化才重试
+                    fresh_schema = await self.get_notion_schema(refresh=True)
+                    if not fresh_schema or fresh_schema.get("version") == schema.get("version"):
+                        raise
+                    logger.warning("Notion数据库结构已变更，使用新的属性名称重试")
+                    page = await self.create_notion_page(build_notion_properties(fresh_schema, title, date), first_batch)
+                page_id = page["id"]
+                appended = len(first_batch)
+                report_progress(page_id, appended)
+            
+            # 同一页面的追加必须按顺序进行，否则块的先后顺序会错乱
+            while appended < len(children):
+                batch = children[appended:appended + NOTION_BATCH_SIZE]
+                await self.append_notion_blocks(page_id, batch)
+                appended += len(batch)
+                report_progress(page_id, appended)
+            
+            return page_id
+        except Exception as e:
+            logger.error(f"保存到Notion失败: {str(e)}")
+            return None
+    
+    async def _smtp_connect(self):
+        smtp_server = os.environ.get("SMTP_SERVER", "smtp.mailersend.net")
+        smtp_port = int(os.environ.get("SMTP_PORT", 587))
+        smtp = aiosmtplib.SMTP(hostname=smtp_server, port=smtp_port, username=EMAIL_ADDRESS,
+                               password=EMAIL_PASSWORD, start_tls=True, timeout=SMTP_TIMEOUT)
+        await smtp.connect()
+        return smtp
+    
+    async def deliver_batch(self, idle, text, batch):
+        """从连接池借一个异步SMTP连接发送一批收件人，整批遇到临时错误时重连重试，与xwlb_daily.deliver_batch()相同"""
+        smtp = await idle.get()
+        try:
+            for attempt in range(1, 4):
+                try:
+                    if smtp is None or not smtp.is_connected:
+                        smtp = await self._smtp_connect()
+                    async with self.api_slot("smtp"):
+                        errors, _ = await smtp.sendmail(EMAIL_SENDER, batch, text)
+                    return classify_delivery(batch, refused=errors)
+                except aiosmtplib.SMTPRecipientsRefused as e:
+                    return classify_delivery(batch, refused={r.recipient: (r.code, r.message) for r in e.recipients})
+                except Exception as e:
+                    transient = isinstance(e, (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPTimeoutError, ConnectionError)) or (
+                        isinstance(e, aiosmtplib.SMTPResponseException) and 400 <= e.code < 500)
+                    if attempt == 3 or not transient:
+                        logger.error(f"一批{len(batch)}个收件人发送失败: {str(e)}")
+                        return classify_delivery(batch, error=e)
+                    run_metrics.record_retry("deliver_batch")
+                    logger.warning(f"发送失败，{2 ** attempt}秒后重试: {str(e)}")
+                    if smtp is not None:
+                        smtp.close()
+                        smtp = None
+                    await asyncio.sleep(2 ** attempt)
+        finally:
+            idle.put_nowait(smtp)
+    
+    async def deliver_email(self, title, summary, html_notes, run_id=None):
+        """邮件只渲染一次，分批并行投递给所有订阅者，与xwlb_daily.deliver_email()相同"""
+        log = DeliveryLog(run_id)
+        subscribers = load_subscribers()
+        pending = log.pending(subscribers)
+        if not pending:
+            logger.info("所有订阅者都已投递，无需发送")
+            return bool(subscribers)
+        
+        # 渲染图表会调用graphviz子进程并写入缓存，放到线程中执行，不阻塞其他日期
+        text = await asyncio.to_thread(lambda: serialize_message(build_delivery_message(title, summary, html_notes, subscribers)))
+        workers = max(1, min(DELIVERY_WORKERS, API_CONCURRENCY["smtp"] or DELIVERY_WORKERS, len(split_batches(pending))))
+        logger.info(f"正在向 {len(pending)} 个订阅者发送邮件（{workers} 个连接）")
+        idle = asyncio.Queue()
+        for _ in range(workers):
+            idle.put_nowait(None)
+        try:
+            for round_index in range(max(1, DELIVERY_ROUNDS)):
+                for results in await asyncio.gather(*(self.deliver_batch(idle, text, batch) for batch in split_batches(pending))):
+                    log.record(results)
+                pending = log.retryable(pending)
+                if not pending:
+                    break
+                logger.warning(f"{len(pending)} 个收件人暂时无法投递（第{round_index + 1}轮）")
+        finally:
+            while not idle.empty():
+                smtp = idle.get_nowait()
+                if smtp is not None and smtp.is_connected:
+                    try:
+                        await smtp.quit()
+                    except aiosmtplib.SMTPException:
+                        smtp.close()
+        
+        counts = log.counts()
+        logger.info(f"邮件投递完成：送达 {counts.get('sent', 0)}，退信 {counts.get('bounced', 0)}，失败 {counts.get('failed', 0)}")
+        return not log.pending(subscribers)
+    
+    async def send_email(self, title, summary, html_notes, run_id=None):
+        """发送HTML格式的笔记摘要邮件"""
+        try:
+            logger.info(f"正在发送邮件....")
+            return await self.deliver_email(title, summary, html_notes, run_id=run_id)
+        except Exception as e:
+            logger.error(f"发送邮件失败: {str(e)}")
+            return False
+    
+    async def process_broadcast(self, date, notion_date=None):
+        """异步处理一期新闻联播，阶段划分和运行记录与同步版本一致
+        
+        与xwlb_daily.process_broadcast()共用按日期的锁，同一天同时只由一个任务处理。
+        """
+        handle = await asyncio.to_thread(acquire_date_lock, date.strftime("%Y-%m-%d"))
+        try:
+            return await self._process_broadcast(date, notion_date)
+        finally:
+            release_date_lock(handle)
+    
+    async def _process_broadcast(self, date, notion_date=None):
+        url, title = get_broadcast_url(date)
+        journal = RunJournal(date.strftime("%Y-%m-%d"))
+        if journal_complete(journal):
+            logger.info(f"{title} 的所有阶段均已完成，跳过")
+            await asyncio.to_thread(archive_stage, journal, date)
+            return True
+        
+        if journal.is_done("fetched"):
+            content = journal.get("fetched")
+        else:
+            result = await run_metrics.timed_async("stage.fetch", self.fetch_webpage(url))
+            if not result or "data" not in result or "content" not in result["data"]:
+                logger.error("无法获取网页内容")
+                return False
+            content = result["data"]["content"]
+            journal.record("fetched", content)
+            run_metrics.add("stage.fetch", characters=len(content))
+        logger.info(f"成功获取内容，长度: {len(content)} 字符")
+        
+        summary_needed = not (journal.is_done("notion_saved") and journal.is_done("email_sent"))
+        generate_summary = summary_needed and not journal.is_done("summarized")
+        generate_notes = not journal.is_done("notes_generated") and not journal.is_done("email_sent")
+        
+        # 长文稿先分段提炼，保证每次生成调用都在token预算内；Notion仍保存完整原文
+        generation_input = await run_metrics.timed_async("stage.condense", self.condense_transcript(content)) if generate_summary or generate_notes else content
+        
+        # 单次生成模式下只上传一次文稿，摘要和笔记都在本地从结构化结果渲染
+        structured = None
+        if GENERATION_MODE == "single" and (generate_summary or generate_notes):
+            structured = await run_metrics.timed_async("stage.single_pass", self.generate_structured_notes(generation_input, title))
+        
+        # 摘要和HTML笔记拿到原文后同时开始生成
+        summary_task = None
+        notes_task = None
+        if structured:
+            if generate_summary:
+                summary_task = asyncio.create_task(run_metrics.timed_async("stage.summary", asyncio.to_thread(render_summary_text, structured)))
+            if generate_notes:
+                notes_task = asyncio.create_task(run_metrics.timed_async("stage.notes", asyncio.to_thread(render_notes_html, structured, title)))
+        else:
+            if generate_summary:
+                summary_task = asyncio.create_task(run_metrics.timed_async("stage.summary", self.summarize_content(generation_input)))
+            if generate_notes:
+                notes_task = asyncio.create_task(run_metrics.timed_async("stage.notes", self.generate_html_notes(generation_input, title)))
+        
+        try:
+            # Notion只需要摘要，不必等待耗时更长的HTML笔记
+            if summary_task:
+                summary = await summary_task
+                if summary != SUMMARY_PLACEHOLDER:
+                    journal.record("summarized", summary)
+            else:
+                summary = journal.get("summarized")
+            
+            page_id = journal.get("notion_saved")
+            if not journal.is_done("notion_saved"):
+                resume = journal.get("notion_saved") if journal.status("notion_saved") == "partial" else None
+                with run_metrics.stage("stage.notion"):
+                    page_id = await self.save_to_notion(title, content, summary, date=notion_date, resume=resume,
+                                                        on_progress=lambda progress: journal.record("notion_saved", progress, status="partial"))
+                if page_id:
+                    journal.record("notion_saved", page_id)
+                    logger.info(f"成功保存到Notion！")
+                else:
+                    logger.warning("保存到Notion失败")
+            
+            email_sent = journal.is_done("email_sent")
+            if not email_sent:
+                try:
+                    if notes_task:
+                        html_notes = await notes_task
+                        if NOTES_FALLBACK_MARKER not in html_notes:
+                            journal.record("notes_generated", html_notes)
+                    else:
+                        html_notes = journal.get("notes_generated")
+                    email_sent = await run_metrics.timed_async("stage.email", self.send_email(title, summary, html_notes, run_id=journal.run_id))
+                    if email_sent:
+                        journal.record("email_sent", True)
+                        logger.info("成功发送邮件")
+                    else:
+                        logger.warning("发送邮件失败")
+                except Exception as e:
+                    import traceback
+                    error_str = str(e)
+                    if "RetryError" in error_str:
+                        log_details = f"HTML笔记生成重试失败\n模型: {'/'.join(GEMINI_NOTES_MODELS)}\n完整错误: {traceback.format_exc()}"
+                        send_error_notification("HTML笔记生成失败", "邮件中的HTML笔记生成失败", "Gemini AI", log_info=log_details)
+                    logger.error(f"发送邮件过程中出错: {error_str}")
+        finally:
+            # 出错提前返回时不留下未完成的生成任务
+            for task in (summary_task, notes_task):
+                if task and not task.done():
+                    task.cancel()
+        
+        # 其他笔记版本复用同步实现，在线程中生成和投递
+        profiles_sent = await asyncio.to_thread(profile_stage, journal, content, title, structured)
+        await asyncio.to_thread(archive_stage, journal, date)
+        return bool(page_id) and email_sent and profiles_sent
+    
+    async def run(self, dates):
+        """在同一个事件循环中并发处理多个日期，返回 {日期字符串: 是否全部成功}"""
+        async def run_one(date):
+            # 与每日定时任务保持一致：写入Notion的日期为播出日的次日
+            return await self.process_broadcast(date, date + datetime.timedelta(days=1))
+        
+        outcomes = await asyncio.gather(*(run_one(date) for date in dates), return_exceptions=True)
+        results = {}
+        for date, outcome in zip(dates, outcomes):
+            date_str = date.strftime("%Y-%m-%d")
+            if isinstance(outcome, BaseException):
+                logger.error(f"{date_str} 处理失败: {str(outcome)}")
+                send_error_notification("程序运行错误", f"{date_str} 新闻联播处理失败: {str(outcome)}", "新闻联播自动化系统",
+                                        log_info=f"异常类型: {type(outcome).__name__}")
+                results[date_str] = False
+            else:
+                results[date_str] = outcome
+        return results
+
+async def run_async(dates):
+    """创建异步流水线处理给定日期，结束后关闭所有连接并发出错误通知"""
+    run_metrics.reset()
+    pipeline = AsyncPipeline()
+    try:
+        return await pipeline.run(dates)
+    finally:
+        await pipeline.aclose()
+        run_metrics.emit()
+        await asyncio.to_thread(flush_notifications)
+
+def async_main(start_date=None, end_date=None):
+    """异步模式入口：不传日期时处理昨天，传入时处理整个日期范围（包含首尾）"""
+    if not check_required_env():
+        return {}
+    if start_date is None:
+        start_date = end_date = datetime.datetime.now() - datetime.timedelta(days=1)
+    if end_date < start_date:
+        start_date, end_date = end_date, start_date
+    dates = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+    
+    results = asyncio.run(run_async(dates))
+    failed = sorted(date for date, ok in results.items() if not ok)
+    logger.info(f"处理完成，成功 {len(results) - len(failed)} 天，失败 {len(failed)} 天")
+    logger.info(usage_ledger.report())
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="新闻联播摘要生成程序（asyncio模式）")
+    parser.add_argument("--backfill", nargs=2, type=parse_date, metavar=("START", "END"),
+                        help="处理指定日期范围（YYYY-MM-DD，包含首尾），默认只处理昨天")
+    parser.add_argument("--no-cache", action="store_true", help="不读取也不写入本地缓存")
+    parser.add_argument("--force", action="store_true", help="忽略已有运行记录，重新执行所有阶段")
+    args = parser.parse_args()
+    
+    setup_logging()
+    if args.no_cache:
+        xwlb_daily.CACHE_DISABLED = True
+    if args.force:
+        xwlb_daily.IGNORE_JOURNAL = True
+    
+    logger.info("开始以异步模式运行新闻联播摘要生成程序")
+    if args.backfill:
+        async_main(args.backfill[0], args.backfill[1])
+    else:
+        async_main()
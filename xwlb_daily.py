@@ -1,21 +1,62 @@
 import datetime
-import requests
+import importlib
 import os
 import json
 import urllib.parse
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from notion_client import Client
+import html
+from html.parser import HTMLParser
 import time
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, before_sleep_log
+import argparse
+import threading
+import hashlib
+import base64
+import re
+import queue
+import atexit
+import email.utils
+import sqlite3
+import contextvars
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，只在进程内加锁
+    fcntl = None
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as wait_futures, FIRST_COMPLETED
+from contextlib import contextmanager
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type, before_sleep_log
 from dotenv import load_dotenv
-import google.generativeai as genai
+from xwlb_archive import TranscriptArchive
 
 # 加载环境变量
 load_dotenv()
 
+class LazyModule:
+    """首次访问属性时才导入的模块代理
+    
+    Gemini、Notion和requests等SDK导入很慢，只检查配置或只重发邮件时用不到，
+    因此推迟到第一次真正调用时再导入。
+    """
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+    
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+genai = LazyModule("google.generativeai")
+notion_client = LazyModule("notion_client")
+requests = LazyModule("requests")
+smtplib = LazyModule("smtplib")
+
 # 创建自定义日志过滤器
 class PrivacyFilter(logging.Filter):
     def filter(self, record):
@@ -32,8 +73,11 @@ class PrivacyFilter(logging.Filter):
                     record.msg = record.msg.replace('https://api.notion.com/v1/', 'notion/')
         return True
 
+def setup_logging():
+    """配置日志输出格式，由命令行入口调用，被其他模块导入时不改动全局日志配置"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
 # 设置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # 添加隐私过滤器
@@ -67,22 +111,865 @@ RECIPIENT_EMAIL = os.environ.get("RECIPIENT_EMAIL")
 # 添加发件人邮箱环境变量
 EMAIL_SENDER = os.environ.get("EMAIL_SENDER")
 
+# 各外部API的并发上限，回填多天时每个服务最多同时占用这么多个请求
+API_CONCURRENCY = {
+    "jina": int(os.environ.get("JINA_CONCURRENCY", 4)),
+    "gemini_flash": int(os.environ.get("GEMINI_FLASH_CONCURRENCY", 4)),
+    "gemini_pro": int(os.environ.get("GEMINI_PRO_CONCURRENCY", 2)),
+    "notion": int(os.environ.get("NOTION_CONCURRENCY", 3)),
+    # 群发笔记时每个SMTP连接占一个名额，默认与DELIVERY_WORKERS相同
+    "smtp": int(os.environ.get("SMTP_CONCURRENCY", 4)),
+    "mrxwlb": int(os.environ.get("MRXWLB_CONCURRENCY", 2)),
+}
+# 回填模式的工作线程数（同时处理的日期数）
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 8))
+
+_api_semaphores = {name: threading.BoundedSemaphore(max(1, limit)) for name, limit in API_CONCURRENCY.items()}
+
+@contextmanager
+def api_slot(api_name):
+    """占用指定外部API的一个并发名额，并按令牌桶限速、计入当日用量"""
+    with _api_semaphores[api_name]:
+        rate_limiter.acquire(api_name)
+        usage_ledger.record(api_name)
+        with run_metrics.stage(f"api.{api_name}"):
+            yield
+
+# 本地磁盘缓存：重跑或同一天第二次运行时跳过已完成的Jina读取和Gemini生成
+CACHE_DIR = os.environ.get("XWLB_CACHE_DIR", ".cache")
+CACHE_TTL_HOURS = float(os.environ.get("XWLB_CACHE_TTL_HOURS", 72))
+CACHE_MAX_MB = float(os.environ.get("XWLB_CACHE_MAX_MB", 200))
+# 设置XWLB_NO_CACHE=1或使用--no-cache参数可绕过缓存
+CACHE_DISABLED = os.environ.get("XWLB_NO_CACHE", "").lower() in ("1", "true", "yes")
+
+_cache_lock = threading.Lock()
+
+def cache_key(*parts):
+    """根据任意可JSON序列化的内容计算缓存键"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _cache_path(namespace, key):
+    return os.path.join(CACHE_DIR, namespace, f"{key}.json")
+
+def cache_get(namespace, key):
+    """读取缓存，不存在、已过期或缓存被禁用时返回None"""
+    if CACHE_DISABLED:
+        return None
+    path = _cache_path(namespace, key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    if time.time() - entry.get("created", 0) > CACHE_TTL_HOURS * 3600:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    
+    # 更新访问时间，容量淘汰时按最近使用排序
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    logger.info(f"命中本地缓存: {namespace}")
+    return entry.get("value")
+
+def cache_set(namespace, key, value):
+    """写入缓存，写入后按TTL和容量上限淘汰旧条目"""
+    if CACHE_DISABLED:
+        return
+    path = _cache_path(namespace, key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再替换，避免并发或中断时留下半个文件
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"created": time.time(), "value": value}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"写入本地缓存失败: {str(e)}")
+        return
+    evict_cache()
+
+# 生成失败时使用的占位内容，运行记录据此判断阶段是否真正完成
+SUMMARY_PLACEHOLDER = "由于Gemini API不稳定，无法生成摘要。请稍后重试。"
+NOTES_FALLBACK_MARKER = "⚠️ 笔记生成失败"
+
+# 每个播出日期的运行记录目录
+RUNS_DIR = os.environ.get("XWLB_RUNS_DIR", "runs")
+# 使用--force参数时忽略已有运行记录，所有阶段重新执行
+IGNORE_JOURNAL = False
+
+# 每次运行都把原文、摘要和笔记写入本地全文检索库（见xwlb_archive.py），设为0时不写入
+ARCHIVE_ENABLED = os.environ.get("XWLB_ARCHIVE", "1") != "0"
+
+class RunJournal:
+    """单日运行记录，保存每个阶段的状态和输出，重跑时从第一个未完成的阶段继续"""
+    STAGES = ("fetched", "summarized", "notes_generated", "notion_saved", "email_sent")
+    
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.path = os.path.join(RUNS_DIR, f"{run_id}.json")
+        self.stages = {}
+        if not IGNORE_JOURNAL:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.stages = json.load(f).get("stages", {})
+            except (OSError, ValueError):
+                self.stages = {}
+        if self.stages:
+            logger.info(f"{run_id} 已有运行记录，第一个未完成阶段: {self.first_incomplete() or '无'}")
+    
+    def status(self, stage):
+        return self.stages.get(stage, {}).get("status")
+    
+    def is_done(self, stage):
+        return self.status(stage) == "done"
+    
+    def get(self, stage):
+        return self.stages.get(stage, {}).get("output")
+    
+    def first_incomplete(self):
+        for stage in self.STAGES:
+            if not self.is_done(stage):
+                return stage
+        return None
+    
+    def record(self, stage, output=None, status="done"):
+        """记录阶段结果并立即落盘"""
+        self.stages[stage] = {
+            "status": status,
+            "output": output,
+            "updated": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        try:
+            os.makedirs(RUNS_DIR, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"run_id": self.run_id, "stages": self.stages}, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"写入运行记录失败: {str(e)}")
+
+_date_locks = {}
+_date_locks_guard = threading.Lock()
+
+def acquire_date_lock(run_id):
+    """独占一个播出日期，返回交给release_date_lock()的句柄
+    
+    调度器的每日任务和等待任务、手动重跑可能同时处理同一天，而运行记录和投递记录都没有并发保护。
+    进程内用线程锁、进程之间用runs/locks下的文件锁串行化，后来者等前一个结束后再读取运行记录，
+    已完成的阶段直接跳过，不会重复创建Notion页面或重复发信。
+    """
+    with _date_locks_guard:
+        lock = _date_locks.setdefault(run_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        logger.info(f"{run_id} 正在由其他任务处理，等待其完成")
+        lock.acquire()
+    lock_file = None
+    try:
+        path = os.path.join(RUNS_DIR, "locks", f"{run_id}.lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_file = open(path, "a")
+        if fcntl:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"{run_id} 正在由其他进程处理，等待其完成")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except BaseException:
+        if lock_file is not None:
+            lock_file.close()
+        lock.release()
+        raise
+    return lock, lock_file
+
+def release_date_lock(handle):
+    lock, lock_file = handle
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    finally:
+        lock.release()
+
+@contextmanager
+def date_lock(run_id):
+    handle = acquire_date_lock(run_id)
+    try:
+        yield
+    finally:
+        release_date_lock(handle)
+
+# 各外部API每分钟允许的请求数（令牌桶），0表示不限速
+API_RATE_LIMITS = {
+    "jina": float(os.environ.get("JINA_RATE_PER_MIN", 200)),
+    "gemini_flash": float(os.environ.get("GEMINI_FLASH_RATE_PER_MIN", 10)),
+    "gemini_pro": float(os.environ.get("GEMINI_PRO_RATE_PER_MIN", 5)),
+    "notion": float(os.environ.get("NOTION_RATE_PER_MIN", 180)),
+    "smtp": float(os.environ.get("SMTP_RATE_PER_MIN", 20)),
+    "mrxwlb": float(os.environ.get("MRXWLB_RATE_PER_MIN", 30)),
+}
+# 各外部API每日请求配额，0表示未知，仅用于用量账本中显示占用比例
+API_DAILY_QUOTAS = {
+    "jina": int(os.environ.get("JINA_DAILY_QUOTA", 0)),
+    "gemini_flash": int(os.environ.get("GEMINI_FLASH_DAILY_QUOTA", 250)),
+    "gemini_pro": int(os.environ.get("GEMINI_PRO_DAILY_QUOTA", 100)),
+    "notion": int(os.environ.get("NOTION_DAILY_QUOTA", 0)),
+    "smtp": int(os.environ.get("SMTP_DAILY_QUOTA", 500)),
+    "mrxwlb": 0,
+}
+
+def update_json_file(path, update):
+    """在文件锁内读取、修改并原子写回JSON文件，多个进程同时运行时不会互相覆盖
+    
+    update接收已有数据（文件不存在时为空字典）并原地修改，其返回值作为本函数的返回值。
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            result = update(data)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+            return result
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def parse_retry_after(value):
+    """解析Retry-After头（秒数或HTTP日期），无法解析时返回None"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RateLimiter:
+    """各外部API的令牌桶限速器
+    
+    桶状态保存在运行目录下的ratelimit.json中，回填、定时任务和手动重跑同时运行时共享同一组桶。
+    令牌不足时预支并返回需要等待的时间，因此排队的请求按到达顺序均匀放行。
+    收到Retry-After时调用block()，在该时间之前所有进程的同类请求都会等待。
+    """
+    
+    def __init__(self, rates=None, path=None):
+        self.rates = rates or API_RATE_LIMITS
+        self.path = path or os.path.join(RUNS_DIR, "ratelimit.json")
+        self._lock = threading.Lock()
+    
+    def capacity(self, api_name):
+        # 桶容量等于并发上限，空闲后最多允许这么多个请求同时发出
+        return max(1, API_CONCURRENCY.get(api_name, 1))
+    
+    def reserve(self, api_name):
+        """取一个令牌，返回放行前需要等待的秒数（由调用方等待）"""
+        rate = self.rates.get(api_name, 0) / 60
+        
+        def take(state):
+            now = time.time()
+            bucket = state.setdefault(api_name, {"tokens": self.capacity(api_name), "updated": now, "blocked_until": 0})
+            wait_seconds = max(0.0, bucket.get("blocked_until", 0) - now)
+            if rate > 0:
+                elapsed = max(0.0, now - bucket["updated"])
+                tokens = min(self.capacity(api_name), bucket["tokens"] + elapsed * rate) - 1
+                bucket["tokens"] = tokens
+                bucket["updated"] = now
+                if tokens < 0:
+                    wait_seconds = max(wait_seconds, -tokens / rate)
+            return wait_seconds
+        
+        with self._lock:
+            try:
+                wait_seconds = update_json_file(self.path, take)
+            except OSError as e:
+                logger.warning(f"读取限速状态失败，本次不限速: {str(e)}")
+                return 0.0
+        if wait_seconds > 0:
+            logger.info(f"{api_name} 限速，等待 {wait_seconds:.1f} 秒")
+            usage_ledger.record(api_name, requests=0, throttled=1)
+        return wait_seconds
+    
+    def acquire(self, api_name):
+        wait_seconds = self.reserve(api_name)
+        if wait_seconds > 0:
+            run_metrics.add(f"api.{api_name}", wait_seconds=wait_seconds)
+            time.sleep(wait_seconds)
+    
+    def block(self, api_name, seconds):
+        """服务端要求等待（Retry-After）时，暂停该API的所有请求"""
+        if not seconds:
+            return
+        logger.warning(f"{api_name} 要求等待 {seconds:.0f} 秒后重试")
+        
+        def set_blocked(state):
+            bucket = state.setdefault(api_name, {"tokens": 0, "updated": time.time(), "blocked_until": 0})
+            bucket["blocked_until"] = max(bucket.get("blocked_until", 0), time.time() + seconds)
+        
+        with self._lock:
+            try:
+                update_json_file(self.path, set_blocked)
+            except OSError as e:
+                logger.warning(f"写入限速状态失败: {str(e)}")
+
+class UsageLedger:
+    """每日用量账本：按API记录请求数、token数、字符数和被限速的次数，保存在runs/usage/日期.json"""
+    
+    FIELDS = ("requests", "tokens", "characters", "throttled")
+    
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(RUNS_DIR, "usage")
+        self._lock = threading.Lock()
+    
+    def path(self, day=None):
+        day = day or datetime.date.today()
+        return os.path.join(self.directory, f"{day:%Y-%m-%d}.json")
+    
+    def record(self, api_name, requests=1, tokens=0, characters=0, throttled=0):
+        counts = {"requests": requests, "tokens": tokens, "characters": characters, "throttled": throttled}
+        if not any(counts.values()):
+            return
+        
+        def add(ledger):
+            entry = ledger.setdefault(api_name, dict.fromkeys(self.FIELDS, 0))
+            for field, value in counts.items():
+                entry[field] = entry.get(field, 0) + value
+        
+        with self._lock:
+            try:
+                update_json_file(self.path(), add)
+            except OSError as e:
+                logger.warning(f"写入用量账本失败: {str(e)}")
+        if tokens or characters:
+            run_metrics.add(f"api.{api_name}", tokens=tokens, characters=characters)
+    
+    def load(self, day=None):
+        try:
+            with open(self.path(day), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def report(self, day=None):
+        """返回当日用量的文本报告，有配额的API同时显示占用比例"""
+        day = day or datetime.date.today()
+        ledger = self.load(day)
+        lines = [f"{day:%Y-%m-%d} API用量："]
+        for api_name in API_RATE_LIMITS:
+            entry = ledger.get(api_name, {})
+            line = (f"- {api_name}: 请求 {entry.get('requests', 0)} 次，token {entry.get('tokens', 0)}，"
+                    f"字符 {entry.get('characters', 0)}，限速等待 {entry.get('throttled', 0)} 次")
+            quota = API_DAILY_QUOTAS.get(api_name)
+            if quota:
+                line += f"，已用配额 {entry.get('requests', 0) / quota:.0%}"
+            lines.append(line)
+        return "\n".join(lines)
+
+# 运行指标的输出格式：json、prometheus（node_exporter的textfile格式）或none
+METRICS_FORMAT = os.environ.get("METRICS_FORMAT", "json").lower()
+# 输出文件路径，默认json写到runs/metrics/运行开始时间.json，prometheus写到runs/metrics/xwlb.prom
+METRICS_PATH = os.environ.get("METRICS_PATH", "")
+
+class RunMetrics:
+    """单次运行的耗时和用量指标
+    
+    按名称累计耗时、次数、失败次数、限速等待时间、字符数、字节数和token数：流水线阶段记为stage.*，
+    每次外部API调用记为api.*。tenacity的重试次数按函数名单独累计。
+    运行结束时由emit()输出，错误通知邮件中也会附上当时的指标。
+    """
+    FIELDS = ("seconds", "count", "errors", "wait_seconds", "characters", "bytes", "tokens")
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}
+            self.retries = {}
+    
+    def add(self, name, **counts):
+        with self._lock:
+            entry = self.stages.setdefault(name, dict.fromkeys(self.FIELDS, 0))
+            for field, value in counts.items():
+                entry[field] += value
+    
+    @contextmanager
+    def stage(self, name):
+        """统计with块的耗时，块内抛出异常时计一次失败"""
+        start = time.time()
+        try:
+            yield
+        except BaseException:
+            self.add(name, errors=1)
+            raise
+        finally:
+            self.add(name, seconds=time.time() - start, count=1)
+    
+    def timed(self, name, func):
+        """返回在name下计时的func，用于提交到线程池的任务"""
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    
+    async def timed_async(self, name, awaitable):
+        with self.stage(name):
+            return await awaitable
+    
+    def record_retry(self, func_name):
+        with self._lock:
+            self.retries[func_name] = self.retries.get(func_name, 0) + 1
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                "started": datetime.datetime.fromtimestamp(self.started).strftime("%Y-%m-%d %H:%M:%S"),
+                "duration_seconds": round(time.time() - self.started, 3),
+                "stages": {name: {field: round(value, 3) for field, value in entry.items()} for name, entry in self.stages.items()},
+                "retries": dict(self.retries),
+            }
+    
+    def format_text(self):
+        """按耗时从高到低列出各项指标"""
+        snapshot = self.snapshot()
+        lines = [f"运行时长: {snapshot['duration_seconds']:.1f} 秒"]
+        for name, entry in sorted(snapshot["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            line = f"{name}: {entry['seconds']:.1f} 秒 / {entry['count']} 次"
+            if entry["errors"]:
+                line += f"，失败 {entry['errors']} 次"
+            if entry["wait_seconds"]:
+                line += f"，限速等待 {entry['wait_seconds']:.1f} 秒"
+            for field, label in (("characters", "字符"), ("bytes", "字节"), ("tokens", "token")):
+                if entry[field]:
+                    line += f"，{label} {int(entry[field])}"
+            lines.append(line)
+        if snapshot["retries"]:
+            lines.append("重试: " + "，".join(f"{name} x{count}" for name, count in sorted(snapshot["retries"].items())))
+        return "\n".join(lines)
+    
+    def format_prometheus(self):
+        """输出Prometheus textfile格式，每项指标都是本次运行的值"""
+        snapshot = self.snapshot()
+        lines = [
+            "# HELP xwlb_run_duration_seconds Wall time of the last run.",
+            "# TYPE xwlb_run_duration_seconds gauge",
+            f"xwlb_run_duration_seconds {snapshot['duration_seconds']}",
+            "# HELP xwlb_run_timestamp_seconds Start time of the last run.",
+            "# TYPE xwlb_run_timestamp_seconds gauge",
+            f"xwlb_run_timestamp_seconds {self.started:.0f}",
+        ]
+        for field in self.FIELDS:
+            metric = f"xwlb_stage_{field}"
+            lines.append(f"# TYPE {metric} gauge")
+            for name, entry in sorted(snapshot["stages"].items()):
+                lines.append(f'{metric}{{stage="{name}"}} {entry[field]}')
+        lines.append("# TYPE xwlb_retries gauge")
+        for name, count in sorted(snapshot["retries"].items()):
+            lines.append(f'xwlb_retries{{function="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+    
+    def emit(self):
+        """运行结束时输出指标日志，并按METRICS_FORMAT写入文件"""
+        logger.info("运行指标:\n" + self.format_text())
+        if METRICS_FORMAT not in ("json", "prometheus"):
+            return
+        if METRICS_FORMAT == "prometheus":
+            path = METRICS_PATH or os.path.join(RUNS_DIR, "metrics", "xwlb.prom")
+            text = self.format_prometheus()
+        else:
+            started = datetime.datetime.fromtimestamp(self.started)
+            path = METRICS_PATH or os.path.join(RUNS_DIR, "metrics", f"{started:%Y%m%d-%H%M%S}.json")
+            text = json.dumps(self.snapshot(), ensure_ascii=False, indent=2)
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入运行指标失败: {str(e)}")
+
+# 当前运行的指标收集器，由入口函数调用run_metrics.reset()绑定
+_current_run_metrics = contextvars.ContextVar("run_metrics")
+
+class CurrentRunMetrics:
+    """转发到当前运行的RunMetrics
+    
+    main()、watch()等入口调用reset()时为本次运行新建一个收集器并绑定到当前上下文，
+    调度器同时运行两个任务时各自累计，不会互相清空。线程池任务需要用ContextThreadPoolExecutor
+    提交才能继承提交方的收集器；没有绑定的上下文使用进程内的默认收集器。
+    """
+    
+    def __init__(self):
+        self._default = RunMetrics()
+    
+    def current(self):
+        return _current_run_metrics.get(self._default)
+    
+    def reset(self):
+        _current_run_metrics.set(RunMetrics())
+    
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """在提交时的上下文中执行任务的线程池，任务中的指标计入提交方所在的运行"""
+    
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def before_sleep_record(log):
+    """与tenacity的before_sleep_log相同，另外把重试次数计入运行指标"""
+    log_retry = before_sleep_log(log, logging.WARNING)
+    
+    def callback(retry_state):
+        run_metrics.record_retry(getattr(retry_state.fn, "__name__", "unknown"))
+        log_retry(retry_state)
+    return callback
+
+rate_limiter = RateLimiter()
+usage_ledger = UsageLedger()
+run_metrics = CurrentRunMetrics()
+transcript_archive = TranscriptArchive()
+
+def evict_cache():
+    """删除过期缓存，并在总大小超出上限时按最近使用时间淘汰"""
+    with _cache_lock:
+        entries = []
+        now = time.time()
+        for root, _, files in os.walk(CACHE_DIR):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        
+        total_size = 0
+        kept = []
+        for mtime, size, path in entries:
+            # 访问时间也超过TTL的条目一定已过期
+            if now - mtime > CACHE_TTL_HOURS * 3600:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            total_size += size
+            kept.append((mtime, size, path))
+        
+        max_size = CACHE_MAX_MB * 1024 * 1024
+        for mtime, size, path in sorted(kept):
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+# SMTP连接超时（秒）
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
+
+class MailTransport:
+    """进程内共享的SMTP连接
+    
+    第一次发信时完成STARTTLS和登录，之后所有邮件复用同一个已认证的连接，
+    连接被服务器断开时自动重连。start_background()之后可以用send_async()
+    把邮件放入队列，由后台线程依次发送，调用方不必等待SMTP。
+    """
+    
+    def __init__(self, server, port, username, password, timeout=SMTP_TIMEOUT):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+    
+    def _connect(self):
+        conn = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            conn.starttls()
+            conn.login(self.username, self.password)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+    
+    def _disconnect(self):
+        if self._conn is None:
+            return
+        try:
+            self._conn.quit()
+        except Exception:
+            self._conn.close()
+        self._conn = None
+    
+    def send(self, msg, from_addr, to_addrs):
+        """同步发送一封邮件，返回sendmail拒收的收件人字典"""
+        return self.send_raw(msg.as_string(), from_addr, to_addrs)
+    
+    def send_raw(self, text, from_addr, to_addrs):
+        """发送已经序列化好的邮件，群发时同一份内容只序列化一次"""
+        with self._lock, api_slot("smtp"):
+            if self._conn is None:
+                self._conn = self._connect()
+            try:
+                return self._conn.sendmail(from_addr, to_addrs, text)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # 空闲连接被服务器关闭，重新建立连接后再发一次
+                logger.info("SMTP连接已断开，正在重新连接")
+                self._disconnect()
+                self._conn = self._connect()
+                return self._conn.sendmail(from_addr, to_addrs, text)
+            except Exception:
+                # 连接状态未知，丢弃后下次重新建立
+                self._disconnect()
+                raise
+    
+    def start_background(self):
+        """启动后台发送线程"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_worker, name="mail-sender", daemon=True)
+                self._worker.start()
+    
+    def send_async(self, msg, from_addr, to_addrs):
+        """把邮件放入发送队列，返回Future"""
+        self.start_background()
+        future = Future()
+        self._queue.put((future, msg, from_addr, to_addrs))
+        return future
+    
+    def _run_worker(self):
+        while True:
+            future, msg, from_addr, to_addrs = self._queue.get()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(self.send(msg, from_addr, to_addrs))
+                    except Exception as e:
+                        future.set_exception(e)
+            finally:
+                self._queue.task_done()
+    
+    def flush(self):
+        """等待队列中的邮件全部发送完毕"""
+        self._queue.join()
+    
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._disconnect()
+
+_mail_transport = None
+_mail_transport_lock = threading.Lock()
+
+def new_mail_transport():
+    """按环境变量中的服务器配置创建一个新的SMTP连接"""
+    smtp_server = os.environ.get("SMTP_SERVER", "smtp.mailersend.net")
+    smtp_port = int(os.environ.get("SMTP_PORT", 587))
+    return MailTransport(smtp_server, smtp_port, EMAIL_ADDRESS, EMAIL_PASSWORD)
+
+def get_mail_transport():
+    """获取进程内共享的SMTP连接"""
+    global _mail_transport
+    with _mail_transport_lock:
+        if _mail_transport is None:
+            _mail_transport = new_mail_transport()
+        return _mail_transport
+
+class MailPool:
+    """群发时使用的一组SMTP连接
+    
+    第一个连接就是进程内共享的连接，其余按需创建；每个发送线程借用一个连接，用完归还。
+    close()只关闭池自己创建的连接。
+    """
+    
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._idle = queue.Queue()
+        self._created = []
+        self._lock = threading.Lock()
+        self._idle.put(get_mail_transport())
+    
+    @contextmanager
+    def connection(self):
+        try:
+            transport = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if len(self._created) + 1 < self.size:
+                    transport = new_mail_transport()
+                    self._created.append(transport)
+                else:
+                    transport = None
+            if transport is None:
+                transport = self._idle.get()
+        try:
+            yield transport
+        finally:
+            self._idle.put(transport)
+    
+    def close(self):
+        for transport in self._created:
+            transport.close()
+
+# 同一(API, 错误类型)在该时间窗口内只通知一次（秒）
+ERROR_NOTIFY_WINDOW = float(os.environ.get("ERROR_NOTIFY_WINDOW", 3600))
+# 同一时间窗口内最多发送的错误通知邮件数，超出后只记录日志
+ERROR_NOTIFY_BUDGET = int(os.environ.get("ERROR_NOTIFY_BUDGET", 3))
+
+class ErrorNotifier:
+    """错误通知聚合器
+    
+    运行过程中的错误先按(api_name, error_type)去重收集，flush()时合并成一封摘要邮件发送。
+    窗口期内已经通知过的错误不再重复发送，每个窗口期内最多发送ERROR_NOTIFY_BUDGET封。
+    """
+    
+    def __init__(self, window=ERROR_NOTIFY_WINDOW, budget=ERROR_NOTIFY_BUDGET):
+        self.window = window
+        self.budget = budget
+        self._sent_times = []
+        self._pending = {}
+        self._last_notified = {}
+        self._lock = threading.Lock()
+    
+    def add(self, error_type, error_message, api_name, log_info=None):
+        key = (api_name, error_type)
+        now = time.time()
+        with self._lock:
+            if now - self._last_notified.get(key, float("-inf")) < self.window:
+                logger.info(f"{api_name} {error_type} 已在{int(self.window)}秒内通知过，不再重复发送")
+                return
+            entry = self._pending.get(key)
+            if entry:
+                entry["count"] += 1
+                entry["last_seen"] = now
+                return
+            self._pending[key] = {
+                "api_name": api_name,
+                "error_type": error_type,
+                "error_message": error_message,
+                "log_info": log_info,
+                "count": 1,
+                "first_seen": now,
+                "last_seen": now,
+            }
+    
+    def flush(self):
+        """把收集到的错误合并成一封邮件发送"""
+        with self._lock:
+            if not self._pending:
+                return
+            entries = list(self._pending.values())
+            self._pending = {}
+            now = time.time()
+            self._sent_times = [t for t in self._sent_times if now - t < self.window]
+            if len(self._sent_times) >= self.budget:
+                logger.warning(f"错误通知邮件已达到上限({self.budget}封)，以下错误仅记录日志: "
+                               + "; ".join(f"{e['api_name']} {e['error_type']} x{e['count']}" for e in entries))
+                return
+            self._sent_times.append(now)
+            for entry in entries:
+                self._last_notified[(entry["api_name"], entry["error_type"])] = now
+        send_error_digest(entries)
+
+error_notifier = ErrorNotifier()
+
+def flush_notifications():
+    """合并发送待发的错误通知，并等待邮件队列清空"""
+    error_notifier.flush()
+    if _mail_transport is not None:
+        _mail_transport.flush()
+
+def shutdown_mail():
+    """进程退出前发完所有邮件并关闭SMTP连接"""
+    error_notifier.flush()
+    if _mail_transport is not None:
+        _mail_transport.close()
+
+atexit.register(shutdown_mail)
+
 def send_error_notification(error_type, error_message, api_name, log_info=None):
-    """发送API错误通知邮件"""
+    """记录API错误，运行结束时与其他错误合并成一封通知邮件"""
+    error_notifier.add(error_type, error_message, api_name, log_info=log_info)
+    return True
+
+def send_error_digest(entries):
+    """发送合并后的API错误通知邮件"""
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    api_names = list(dict.fromkeys(entry["api_name"] for entry in entries))
     msg = MIMEMultipart()
     msg['From'] = EMAIL_SENDER
     msg['To'] = RECIPIENT_EMAIL
-    msg['Subject'] = f"⚠️ 【API错误通知】{api_name} API异常"
-    
-    # 添加日志信息部分
-    log_section = ""
-    if log_info:
-        log_section = f"""
-        <div class="log-section">
-            <h3>🔍 详细日志信息：</h3>
-            <pre style="background-color: #f1f3f4; padding: 15px; border-radius: 5px; font-size: 12px; overflow-x: auto; white-space: pre-wrap; border: 1px solid #dadce0;">{log_info}</pre>
-        </div>
+    msg['Subject'] = f"⚠️ 【API错误通知】{'、'.join(api_names)} API异常"
+    
+    error_sections = ""
+    text_sections = ""
+    for entry in entries:
+        count_info = f"（本次运行共出现 {entry['count']} 次）" if entry["count"] > 1 else ""
+        
+        # 添加日志信息部分
+        log_section = ""
+        if entry["log_info"]:
+            log_section = f"""
+            <div class="log-section">
+                <h3>🔍 详细日志信息：</h3>
+                <pre style="background-color: #f1f3f4; padding: 15px; border-radius: 5px; font-size: 12px; overflow-x: auto; white-space: pre-wrap; border: 1px solid #dadce0;">{entry["log_info"]}</pre>
+            </div>
+            """
+        
+        error_sections += f"""
+            <div class="error-info">
+                <h3>错误详情：</h3>
+                <p><strong>API服务：</strong>{entry["api_name"]}</p>
+                <p><strong>错误类型：</strong>{entry["error_type"]}{count_info}</p>
+                <p><strong>错误信息：</strong>{entry["error_message"]}</p>
+            </div>
+            
+            {log_section}
         """
+        
+        # 文本版本也包含日志信息
+        text_log_section = f"\n\n详细日志信息：\n{entry['log_info']}" if entry["log_info"] else ""
+        text_sections += f"""
+    API服务：{entry["api_name"]}
+    错误类型：{entry["error_type"]}{count_info}
+    错误信息：{entry["error_message"]}
+    {text_log_section}
+    """
+    
+    # 附上本次运行到目前为止的耗时、重试和用量，便于判断是哪个环节出了问题
+    metrics_text = run_metrics.format_text()
     
     html_content = f"""
     <!DOCTYPE html>
@@ -152,14 +1039,12 @@ def send_error_notification(error_type, error_message, api_name, log_info=None):
                 <h1 class="error-title">🚨 API 服务异常通知</h1>
             </div>
             
-            <div class="error-info">
-                <h3>错误详情：</h3>
-                <p><strong>API服务：</strong>{api_name}</p>
-                <p><strong>错误类型：</strong>{error_type}</p>
-                <p><strong>错误信息：</strong>{error_message}</p>
-            </div>
+            {error_sections}
             
-            {log_section}
+            <div class="log-section">
+                <h3>📊 本次运行指标：</h3>
+                <pre style="background-color: #f1f3f4; padding: 15px; border-radius: 5px; font-size: 12px; overflow-x: auto; white-space: pre-wrap; border: 1px solid #dadce0;">{html.escape(metrics_text)}</pre>
+            </div>
             
             <div class="suggestion">
                 <h3>🔧 建议处理方案：</h3>
@@ -180,16 +1065,12 @@ def send_error_notification(error_type, error_message, api_name, log_info=None):
     </html>
     """
     
-    # 文本版本也包含日志信息
-    text_log_section = f"\n\n详细日志信息：\n{log_info}" if log_info else ""
-    
     text_content = f"""
     API服务异常通知
+    {text_sections}
     
-    API服务：{api_name}
-    错误类型：{error_type}
-    错误信息：{error_message}
-    {text_log_section}
+    本次运行指标：
+    {metrics_text}
     
     建议处理方案：
     1. 检查API密钥是否有效
@@ -207,29 +1088,30 @@ def send_error_notification(error_type, error_message, api_name, log_info=None):
     msg.attach(part1)
     msg.attach(part2)
     
-    smtp_server = os.environ.get("SMTP_SERVER", "smtp.mailersend.net")
-    smtp_port = int(os.environ.get("SMTP_PORT", 587))
+    # 错误通知交给后台线程发送，不阻塞出错的流程
+    api_label = '、'.join(api_names)
+    logger.info(f"正在发送{api_label} API错误通知邮件...")
     
-    try:
-        logger.info(f"正在发送{api_name} API错误通知邮件...")
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        server.sendmail(EMAIL_SENDER, RECIPIENT_EMAIL, text)
-        server.quit()
-        logger.info(f"{api_name} API错误通知邮件发送成功")
-        return True
-    except Exception as e:
-        logger.error(f"发送{api_name} API错误通知邮件失败: {str(e)}")
-        return False
+    def log_result(future):
+        try:
+            future.result()
+            logger.info(f"{api_label} API错误通知邮件发送成功")
+        except Exception as e:
+            logger.error(f"发送{api_label} API错误通知邮件失败: {str(e)}")
+    
+    get_mail_transport().send_async(msg, EMAIL_SENDER, RECIPIENT_EMAIL).add_done_callback(log_result)
+    return True
 
 def get_yesterday_url():
     """获取前一天的新闻联播URL"""
     yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
-    year = yesterday.strftime("%Y")
-    month = yesterday.strftime("%m")
-    day = yesterday.strftime("%d")
+    return get_broadcast_url(yesterday)
+
+def get_broadcast_url(date):
+    """获取指定日期的新闻联播URL"""
+    year = date.strftime("%Y")
+    month = date.strftime("%m")
+    day = date.strftime("%d")
     
     # 构建URL，参考用户提供的示例
     date_part = f"{year}年{month}月{day}日新闻联播文字版"
@@ -240,14 +1122,109 @@ def get_yesterday_url():
     
     return url, title
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def read_webpage_with_jina(url):
-    """使用Jina AI的Reader API读取网页内容"""
+# Jina Reader连接池设置
+JINA_POOL_SIZE = int(os.environ.get("JINA_POOL_SIZE", 10))
+JINA_CONNECT_TIMEOUT = float(os.environ.get("JINA_CONNECT_TIMEOUT", 10))
+JINA_READ_TIMEOUT = float(os.environ.get("JINA_READ_TIMEOUT", 90))
+# Jina Reader选项：只保留目标元素、去掉页眉页脚等，direct引擎不渲染页面，速度更快；默认都留空，不发送对应的请求头
+JINA_TARGET_SELECTOR = os.environ.get("JINA_TARGET_SELECTOR", "")
+JINA_REMOVE_SELECTOR = os.environ.get("JINA_REMOVE_SELECTOR", "")
+JINA_ENGINE = os.environ.get("JINA_ENGINE", "")
+
+def jina_headers(api_key):
+    """Jina Reader请求头，同步和异步客户端共用"""
     headers = {
-        "Authorization": f"Bearer {JINA_API_KEY}",
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
-        "Accept": "application/json"
+        "Accept": "application/json",
+        "Connection": "keep-alive"
     }
+    if JINA_TARGET_SELECTOR:
+        headers["X-Target-Selector"] = JINA_TARGET_SELECTOR
+    if JINA_REMOVE_SELECTOR:
+        headers["X-Remove-Selector"] = JINA_REMOVE_SELECTOR
+    if JINA_ENGINE:
+        headers["X-Engine"] = JINA_ENGINE
+    return headers
+
+class JinaReader:
+    """复用长连接的Jina Reader客户端
+    
+    内部持有一个带连接池的requests.Session，重试和多个日期的读取都复用已建立的TLS连接，
+    不再每次请求都重新握手。
+    """
+    endpoint = "https://r.jina.ai/"
+    
+    def __init__(self, api_key, pool_size=JINA_POOL_SIZE, connect_timeout=JINA_CONNECT_TIMEOUT, read_timeout=JINA_READ_TIMEOUT):
+        self.headers = jina_headers(api_key)
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # 连接池满时阻塞等待空闲连接，而不是新建用完即丢的连接
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+    
+    def post(self, payload, headers=None):
+        """向Reader接口发送请求，返回原始响应"""
+        return self.session.post(self.endpoint, json=payload, headers=headers, timeout=self.timeout)
+    
+    def close(self):
+        self.session.close()
+
+_jina_reader = None
+_jina_reader_lock = threading.Lock()
+
+def get_jina_reader():
+    """获取进程内共享的Jina Reader客户端"""
+    global _jina_reader
+    with _jina_reader_lock:
+        if _jina_reader is None:
+            _jina_reader = JinaReader(JINA_API_KEY)
+        return _jina_reader
+
+def check_jina_result(result, url):
+    """检查Jina AI返回的结果中是否包含正文，格式异常时通知并抛出异常"""
+    if "data" not in result or "content" not in result.get("data", {}):
+        error_msg = f"Jina AI返回格式异常：{result}"
+        logger.error(error_msg)
+        send_error_notification("响应格式异常", error_msg, "Jina AI", log_info=f"请求URL: {url}\n返回结果: {result}")
+        raise Exception(error_msg)
+
+def report_jina_http_error(status_code, error, log_details):
+    """按HTTP状态码分类记录Jina AI的请求错误"""
+    if status_code == 401:
+        error_msg = "Jina AI API密钥无效或已过期"
+        logger.error(error_msg)
+        send_error_notification("API密钥失效", f"HTTP 401: {str(error)}", "Jina AI", log_info=log_details)
+    elif status_code == 403:
+        error_msg = "Jina AI API访问被拒绝，可能账户被暂停"
+        logger.error(error_msg)
+        send_error_notification("访问被拒绝", f"HTTP 403: {str(error)}", "Jina AI", log_info=log_details)
+    elif status_code == 429:
+        error_msg = "Jina AI API请求频率超限"
+        logger.error(error_msg)
+        rate_limiter.block("jina", parse_retry_after(error.response.headers.get("Retry-After")))
+        send_error_notification("请求频率超限", f"HTTP 429: {str(error)}", "Jina AI", log_info=log_details)
+    else:
+        error_msg = f"Jina AI API请求失败: {str(error)}"
+        logger.error(error_msg)
+        send_error_notification("API请求失败", str(error), "Jina AI", log_info=log_details)
+
+def record_jina_usage(result):
+    """把Jina返回的token数和正文字符数计入用量账本"""
+    data = result.get("data") or {}
+    usage = data.get("usage") or {}
+    usage_ledger.record("jina", requests=0, tokens=usage.get("tokens", 0), characters=len(data.get("content") or ""))
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10), before_sleep=before_sleep_record(logger))
+def read_webpage_with_jina(url):
+    """使用Jina AI的Reader API读取网页内容"""
+    cached = cache_get("jina", cache_key(url))
+    if cached:
+        return cached
+    
+    reader = get_jina_reader()
+    headers = reader.headers
     
     payload = {
         "url": url
@@ -255,39 +1232,23 @@ def read_webpage_with_jina(url):
     
     try:
         logger.info(f"正在使用Jina AI读取网页内容")
-        response = requests.post("https://r.jina.ai/", headers=headers, json=payload)
+        with api_slot("jina"):
+            response = reader.post(payload)
+        run_metrics.add("api.jina", bytes=len(response.content))
         response.raise_for_status()
         
         result = response.json()
         
         # 检查Jina AI返回的结果是否成功
-        if "data" not in result or "content" not in result.get("data", {}):
-            error_msg = f"Jina AI返回格式异常：{result}"
-            logger.error(error_msg)
-            send_error_notification("响应格式异常", error_msg, "Jina AI", log_info=f"请求URL: {url}\n返回结果: {result}")
-            raise Exception(error_msg)
+        check_jina_result(result, url)
+        record_jina_usage(result)
         
+        cache_set("jina", cache_key(url), result)
         return result
     except requests.exceptions.HTTPError as e:
         import traceback
         log_details = f"请求URL: {url}\n请求头: {headers}\n请求体: {payload}\n响应状态码: {e.response.status_code}\n响应内容: {e.response.text if hasattr(e.response, 'text') else 'N/A'}\n完整错误: {traceback.format_exc()}"
-        
-        if e.response.status_code == 401:
-            error_msg = "Jina AI API密钥无效或已过期"
-            logger.error(error_msg)
-            send_error_notification("API密钥失效", f"HTTP 401: {str(e)}", "Jina AI", log_info=log_details)
-        elif e.response.status_code == 403:
-            error_msg = "Jina AI API访问被拒绝，可能账户被暂停"
-            logger.error(error_msg)
-            send_error_notification("访问被拒绝", f"HTTP 403: {str(e)}", "Jina AI", log_info=log_details)
-        elif e.response.status_code == 429:
-            error_msg = "Jina AI API请求频率超限"
-            logger.error(error_msg)
-            send_error_notification("请求频率超限", f"HTTP 429: {str(e)}", "Jina AI", log_info=log_details)
-        else:
-            error_msg = f"Jina AI API请求失败: {str(e)}"
-            logger.error(error_msg)
-            send_error_notification("API请求失败", str(e), "Jina AI", log_info=log_details)
+        report_jina_http_error(e.response.status_code, e, log_details)
         raise
     except Exception as e:
         import traceback
@@ -298,75 +1259,241 @@ def read_webpage_with_jina(url):
             send_error_notification("未知API错误", str(e), "Jina AI", log_info=log_details)
         raise
 
-@retry(
-    stop=stop_after_attempt(3), 
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    before_sleep=before_sleep_log(logger, logging.WARNING)
-)
-def summarize_with_gemini(content):
-    """使用Google Gemini API总结内容"""
-    prompt = f"""
-    请总结以下新闻联播内容，特别关注与考研和考公考试相关的重点内容。
+# 直接抓取mrxwlb.com页面，提取失败或内容不完整时才使用Jina
+DIRECT_FETCH = os.environ.get("XWLB_DIRECT_FETCH", "1").lower() in ("1", "true", "yes")
+DIRECT_TIMEOUT = float(os.environ.get("DIRECT_TIMEOUT", 20))
+# 提取出的正文少于该字符数时视为页面不完整（例如文字版尚未更新完）
+DIRECT_MIN_CHARS = int(os.environ.get("DIRECT_MIN_CHARS", 1500))
+# 正文所在元素的class，按顺序匹配第一个
+DIRECT_CONTENT_CLASSES = [c.strip() for c in os.environ.get("DIRECT_CONTENT_CLASSES", "entry-content,post-content,article-content").split(",") if c.strip()]
+DIRECT_USER_AGENT = "Mozilla/5.0 (compatible; xwlb-daily)"
+
+class TranscriptExtractor(HTMLParser):
+    """从文章页HTML中提取正文文本
     
-    请提供:
-    1. 整体摘要（200字左右）
-    2. 主要新闻点（列表形式）
-    3. 考研考公重点：重点标注与国家政策、经济发展、社会治理、重大事件、国际关系等相关的内容
-    4. 根据新闻模仿考研政治，公务员考试（行测、申论、面试）出几道模拟题，说明出题思路，答案解析，举一反三等等
-    新闻内容:
-    {content}
+    只收集第一个class在DIRECT_CONTENT_CLASSES中的元素内的文字，跳过脚本、样式和导航等元素，
+    块级元素之间换行。同时记录页面<title>。
     """
+    BLOCK_TAGS = {"p", "div", "br", "li", "tr", "section", "article", "blockquote",
+                  "h1", "h2", "h3", "h4", "h5", "h6"}
+    SKIP_TAGS = {"script", "style", "noscript", "iframe", "form", "nav", "header", "footer", "aside"}
     
-    try:
-        logger.info("正在总结内容")
-        # 配置Gemini API
-        genai.configure(api_key=GEMINI_API_KEY)
-        # 创建模型
-        # model = genai.GenerativeModel('gemini-2.0-flash')
-        # model = genai.GenerativeModel('gemini-2.5-flash')
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        # 生成回复
-        response = model.generate_content(prompt)
-        # 返回文本内容
-        return response.text
-    except Exception as e:
-        import traceback
-        error_str = str(e)
-        logger.error(f"生成摘要失败: {error_str}")
-        
-        # 对于500错误或服务不可用，让重试机制处理
-        if "500" in error_str or "An internal error has occurred" in error_str or "UNAVAILABLE" in error_str:
-            logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
-            raise  # 让retry装饰器重试
-        
-        # 构建详细日志信息
-        log_details = f"模型: gemini-2.5-flash\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\nPrompt长度: {len(prompt)} 字符\n完整错误: {traceback.format_exc()}"
-        
-        # 对于其他类型的错误（不会重试的错误），发送通知
-        if "403" in error_str and "CONSUMER_SUSPENDED" in error_str:
-            send_error_notification("账户被暂停", "API消费者账户已被暂停", "Gemini AI", log_info=log_details)
-        elif "403" in error_str and "Permission denied" in error_str:
-            send_error_notification("权限被拒绝", error_str, "Gemini AI", log_info=log_details)
-        elif "401" in error_str or "Invalid API key" in error_str:
-            send_error_notification("API密钥无效", error_str, "Gemini AI", log_info=log_details)
-        elif "429" in error_str or "quota" in error_str.lower():
-            send_error_notification("配额超限", error_str, "Gemini AI", log_info=log_details)
-        else:
-            send_error_notification("未知错误", error_str, "Gemini AI", log_info=log_details)
-        
-        raise
-
-@retry(
-    stop=stop_after_attempt(5),  #重试最多三次，貌似不太够，5次吧
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    before_sleep=before_sleep_log(logger, logging.WARNING)
-)
-def generate_html_notes(content, title):
-    """使用Google Gemini API生成HTML格式的笔记"""
+    def __init__(self, content_classes=None):
+        super().__init__(convert_charrefs=True)
+        self.content_classes = set(content_classes or DIRECT_CONTENT_CLASSES)
+        self.title = ""
+        self.parts = []
+        # 正文元素内尚未闭合的标签，第一个是正文元素本身；skip_from为第一个跳过元素在栈中的位置
+        self.stack = []
+        self.skip_from = None
+        self.found = False
+        self.done = False
+        self._in_title = False
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        if self.done:
+            return
+        if not self.stack:
+            classes = set((dict(attrs).get("class") or "").split())
+            if not self.found and classes & self.content_classes and tag not in HTML_VOID_TAGS:
+                self.found = True
+                self.stack.append(tag)
+            return
+        if tag in HTML_VOID_TAGS:
+            if tag == "br" and self.skip_from is None:
+                self.parts.append("\n")
+            return
+        if self.skip_from is None and tag in self.SKIP_TAGS:
+            self.skip_from = len(self.stack)
+        self.stack.append(tag)
+        if self.skip_from is None and tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+            # 标题按Markdown格式输出，与Jina的结果一致，分段时可以按新闻条目切分
+            if tag[0] == "h" and tag[1:].isdigit():
+                self.parts.append("#" * int(tag[1:]) + " ")
+    
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        if not self.stack or tag in HTML_VOID_TAGS:
+            return
+        # 找到最近的同名开标签，期间未闭合的标签（例如省略了</p>的段落）视为被隐式闭合；
+        # 多余的结束标签忽略，正文元素只在它自己的结束标签处结束
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i] == tag:
+                break
+        else:
+            return
+        if self.skip_from is None and any(open_tag in self.BLOCK_TAGS for open_tag in self.stack[i:]):
+            self.parts.append("\n")
+        del self.stack[i:]
+        if self.skip_from is not None and self.skip_from >= i:
+            self.skip_from = None
+        if not self.stack:
+            self.done = True
+    
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        if self.stack and self.skip_from is None:
+            self.parts.append(data)
+    
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n\n".join(line for line in lines if line)
+
+def extract_transcript(page_html):
+    """提取页面标题和正文，没有找到正文元素时正文为空字符串"""
+    extractor = TranscriptExtractor()
+    extractor.feed(page_html)
+    extractor.close()
+    return extractor.title.strip(), extractor.text()
+
+def transcript_looks_complete(content):
+    return len(content) >= DIRECT_MIN_CHARS
+
+_direct_session = None
+_direct_session_lock = threading.Lock()
+
+def get_direct_session():
+    """获取进程内共享的直接抓取会话，不带Jina的认证头"""
+    global _direct_session
+    with _direct_session_lock:
+        if _direct_session is None:
+            _direct_session = requests.Session()
+            _direct_session.headers.update({"User-Agent": DIRECT_USER_AGENT})
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, API_CONCURRENCY["mrxwlb"]))
+            _direct_session.mount("http://", adapter)
+            _direct_session.mount("https://", adapter)
+        return _direct_session
+
+def build_conditional_headers(entry):
+    """根据上次抓取记录的ETag和Last-Modified构建条件请求头"""
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+def handle_direct_response(url, status_code, headers, body, entry):
+    """处理直接抓取的响应，返回与Jina相同格式的结果；页面未变化时复用上次结果，提取失败或不完整时返回None"""
+    direct_cache_key = cache_key(url)
+    if status_code == 304 and entry:
+        logger.info("页面未变化，复用上次抓取的内容")
+        cache_set("direct", direct_cache_key, entry)
+        return entry["result"]
+    if status_code != 200:
+        logger.warning(f"直接抓取返回HTTP {status_code}")
+        return None
+    
+    run_metrics.add("api.mrxwlb", bytes=len(body))
+    title, content = extract_transcript(body.decode("utf-8", errors="replace"))
+    if not transcript_looks_complete(content):
+        logger.warning(f"直接抓取的正文只有 {len(content)} 字符，内容可能不完整")
+        return None
+    
+    result = {"data": {"url": url, "title": title, "content": content}}
+    usage_ledger.record("mrxwlb", requests=0, characters=len(content))
+    cache_set("direct", direct_cache_key, {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "result": result,
+    })
+    return result
+
+def fetch_direct(url):
+    """直接下载页面并提取文稿，带ETag/If-Modified-Since重新验证；提取失败或不完整时返回None"""
+    entry = cache_get("direct", cache_key(url))
+    with api_slot("mrxwlb"):
+        response = get_direct_session().get(url, headers=build_conditional_headers(entry), timeout=DIRECT_TIMEOUT)
+    return handle_direct_response(url, response.status_code, response.headers, response.content, entry)
+
+def fetch_webpage(url):
+    """读取新闻联播页面：先直接抓取，失败或内容不完整时使用Jina AI"""
+    if DIRECT_FETCH:
+        try:
+            result = fetch_direct(url)
+            if result:
+                return result
+        except requests.RequestException as e:
+            logger.warning(f"直接抓取失败: {str(e)}")
+        logger.info("改用Jina AI读取网页内容")
+    return read_webpage_with_jina(url)
+
+# 等待文字版发布：首次检查间隔、退避倍数和最长间隔（秒），以及最多等待的小时数
+PROBE_INTERVAL = float(os.environ.get("PROBE_INTERVAL", 120))
+PROBE_BACKOFF = float(os.environ.get("PROBE_BACKOFF", 1.5))
+PROBE_MAX_INTERVAL = float(os.environ.get("PROBE_MAX_INTERVAL", 900))
+PROBE_MAX_HOURS = float(os.environ.get("PROBE_MAX_HOURS", 5))
+# 页面已存在但正文连续这么多次不完整时不再等待，交给Jina读取（可能是页面结构变了）
+PROBE_INCOMPLETE_LIMIT = int(os.environ.get("PROBE_INCOMPLETE_LIMIT", 3))
+
+def probe_broadcast(url):
+    """用HEAD请求检查页面是否已发布，返回HTTP状态码"""
+    with api_slot("mrxwlb"):
+        response = get_direct_session().head(url, timeout=DIRECT_TIMEOUT, allow_redirects=True)
+    return response.status_code
+
+def wait_for_broadcast(date, max_hours=None):
+    """轮询直到指定日期的文字版发布且正文完整，返回是否等到
+    
+    先用HEAD请求检查页面是否存在，存在后再下载一次确认正文完整，下载的结果会写入缓存，
+    随后的流水线通过条件请求直接复用。检查间隔按PROBE_BACKOFF倍数递增，不超过PROBE_MAX_INTERVAL。
+    """
+    url, title = get_broadcast_url(date)
+    max_hours = PROBE_MAX_HOURS if max_hours is None else max_hours
+    deadline = time.time() + max_hours * 3600
+    interval = PROBE_INTERVAL
+    incomplete = 0
+    logger.info(f"等待 {title} 文字版发布，最多 {max_hours:g} 小时")
+    
+    while True:
+        try:
+            status = probe_broadcast(url)
+            # 不支持HEAD的服务器直接下载检查
+            if status == 200 or status in (405, 501):
+                if fetch_direct(url):
+                    logger.info(f"{title} 文字版已发布")
+                    return True
+                incomplete += 1
+                if incomplete >= PROBE_INCOMPLETE_LIMIT:
+                    logger.warning(f"{title} 页面已存在，但连续 {incomplete} 次未能提取完整正文，开始处理")
+                    return True
+            else:
+                logger.info(f"{title} 尚未发布（HTTP {status}）")
+        except requests.RequestException as e:
+            logger.warning(f"检查页面是否发布失败: {str(e)}")
+        
+        if time.time() + interval > deadline:
+            return False
+        logger.info(f"{int(interval)} 秒后再次检查")
+        time.sleep(interval)
+        interval = min(interval * PROBE_BACKOFF, PROBE_MAX_INTERVAL)
+
+def build_summary_prompt(content):
+    """构建摘要prompt"""
+    prompt = f"""
+    请总结以下新闻联播内容，特别关注与考研和考公考试相关的重点内容。
+    
+    请提供:
+    1. 整体摘要（200字左右）
+    2. 主要新闻点（列表形式）
+    3. 考研考公重点：重点标注与国家政策、经济发展、社会治理、重大事件、国际关系等相关的内容
+    4. 根据新闻模仿考研政治，公务员考试（行测、申论、面试）出几道模拟题，说明出题思路，答案解析，举一反三等等
+    新闻内容:
+    {content}
+    """
+    return prompt
+
+def build_notes_prompt(content, title):
+    """构建HTML笔记prompt"""
     prompt = f"""
     **注意：你的返回内容，只需要严格包含html语法内容，需要严格按照html标签语法，不要在html里出现markdown语法形式，更不需要有其他解释之类的东西**
     请将以下新闻联播内容转换为学习笔记形式，重点关注与考研和考公考试相关的内容。
-
+    
     请生成HTML格式的笔记，包含以下部分：
     1. 标题部分：大标题样式的"{title}"
     2. 整体摘要部分：简洁概括新闻重点（约300字左右）
@@ -435,7 +1562,7 @@ digraph {{
     
     
     
-
+    
     使用适当的HTML标签和CSS样式使内容美观易读，包括但不限于：
     - 使用不同颜色标注不同重要程度的内容
     - 使用合理的字体大小和间距
@@ -446,79 +1573,804 @@ digraph {{
     新闻内容:
     {content}
     """
+    return prompt
+
+def is_transient_gemini_error(error_str):
+    """500错误或服务不可用属于临时错误，交给重试机制处理"""
+    return "500" in error_str or "An internal error has occurred" in error_str or "UNAVAILABLE" in error_str
+
+def report_gemini_error(error_str, model_name, content, prompt):
+    """按错误类型发送Gemini API错误通知，需在except块中调用以记录堆栈"""
+    import traceback
+    # 构建详细日志信息
+    log_details = f"模型: {model_name}\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\nPrompt长度: {len(prompt)} 字符\n完整错误: {traceback.format_exc()}"
+    
+    if "403" in error_str and "CONSUMER_SUSPENDED" in error_str:
+        send_error_notification("账户被暂停", "API消费者账户已被暂停", "Gemini AI", log_info=log_details)
+    elif "403" in error_str and "Permission denied" in error_str:
+        send_error_notification("权限被拒绝", error_str, "Gemini AI", log_info=log_details)
+    elif "401" in error_str or "Invalid API key" in error_str:
+        send_error_notification("API密钥无效", error_str, "Gemini AI", log_info=log_details)
+    elif "429" in error_str or "quota" in error_str.lower():
+        send_error_notification("配额超限", error_str, "Gemini AI", log_info=log_details)
+    else:
+        send_error_notification("未知错误", error_str, "Gemini AI", log_info=log_details)
+
+# 各任务可用的模型链，逗号分隔；健康的模型中优先使用滚动延迟最低的，失败时沿链切换
+GEMINI_SUMMARY_MODELS = [m.strip() for m in os.environ.get("GEMINI_SUMMARY_MODELS", "gemini-2.5-flash,gemini-2.0-flash").split(",") if m.strip()]
+GEMINI_NOTES_MODELS = [m.strip() for m in os.environ.get("GEMINI_NOTES_MODELS", "gemini-2.5-pro").split(",") if m.strip()]
+# 笔记生成超过该秒数仍未完成时，同时用对冲模型请求一次，先返回有效结果的胜出；0表示不对冲
+GEMINI_HEDGE_DELAY = float(os.environ.get("GEMINI_HEDGE_DELAY", 180))
+GEMINI_HEDGE_MODEL = os.environ.get("GEMINI_HEDGE_MODEL", "gemini-2.5-flash")
+# 模型统计的滚动窗口（秒）、判为不健康的错误率，以及配额超限后的冷却时间（秒）
+GEMINI_STATS_WINDOW = float(os.environ.get("GEMINI_STATS_WINDOW", 1800))
+GEMINI_MAX_ERROR_RATE = float(os.environ.get("GEMINI_MAX_ERROR_RATE", 0.5))
+GEMINI_QUOTA_COOLDOWN = float(os.environ.get("GEMINI_QUOTA_COOLDOWN", 600))
+
+def is_gemini_quota_error(error_str):
+    return "429" in error_str or "quota" in error_str.lower() or "RESOURCE_EXHAUSTED" in error_str
+
+def is_gemini_auth_error(error_str):
+    """密钥或账户问题与模型无关，换模型也不会成功"""
+    return "401" in error_str or "Invalid API key" in error_str or "CONSUMER_SUSPENDED" in error_str
+
+def parse_gemini_retry_delay(error_str):
+    """从配额错误中取出服务端建议的重试等待秒数"""
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", error_str)
+    return float(match.group(1)) if match else None
+
+def record_gemini_usage(model_name, prompt, text, response=None):
+    """把一次生成的token数和字符数计入用量账本，响应中没有用量信息时按字符估算"""
+    usage = getattr(response, "usage_metadata", None)
+    tokens = getattr(usage, "total_token_count", 0) or estimate_tokens(prompt) + estimate_tokens(text)
+    usage_ledger.record(gemini_api_name(model_name), requests=0, tokens=tokens, characters=len(prompt) + len(text))
+
+def gemini_api_name(model_name):
+    """按模型名确定使用哪个并发限制"""
+    return "gemini_pro" if "pro" in model_name else "gemini_flash"
+
+class ModelRouter:
+    """Gemini模型路由
+    
+    按(任务, 模型)记录滚动窗口内的调用延迟和成败，以及模型的配额冷却状态。
+    route()把健康的模型按平均延迟排在前面（没有数据的模型按配置顺序排在最前，先试一次），
+    配额冷却中或错误率过高的模型排在最后，仅在其他模型都失败时使用。
+    """
+    
+    def __init__(self, window=GEMINI_STATS_WINDOW):
+        self.window = window
+        self._samples = {}
+        self._quota_until = {}
+        self._lock = threading.Lock()
+    
+    def _recent(self, task, model_name, now):
+        samples = [s for s in self._samples.get((task, model_name), []) if now - s[0] < self.window]
+        self._samples[(task, model_name)] = samples
+        return samples
+    
+    def record(self, task, model_name, latency, error_str=None):
+        now = time.time()
+        with self._lock:
+            self._recent(task, model_name, now).append((now, latency, error_str is None))
+            if error_str and is_gemini_quota_error(error_str):
+                self._quota_until[model_name] = now + GEMINI_QUOTA_COOLDOWN
+                logger.warning(f"{model_name} 配额超限，{int(GEMINI_QUOTA_COOLDOWN)}秒内优先使用其他模型")
+    
+    def is_healthy(self, task, model_name):
+        now = time.time()
+        with self._lock:
+            if self._quota_until.get(model_name, 0) > now:
+                return False
+            samples = self._recent(task, model_name, now)
+        if len(samples) < 3:
+            return True
+        errors = sum(1 for _, _, ok in samples if not ok)
+        return errors / len(samples) <= GEMINI_MAX_ERROR_RATE
+    
+    def latency(self, task, model_name):
+        """成功调用的平均延迟，没有数据时返回None"""
+        with self._lock:
+            latencies = [latency for _, latency, ok in self._recent(task, model_name, time.time()) if ok]
+        return sum(latencies) / len(latencies) if latencies else None
+    
+    def route(self, task, chain):
+        healthy = [m for m in chain if self.is_healthy(task, m)]
+        unhealthy = [m for m in chain if m not in healthy]
+        
+        def sort_key(model_name):
+            latency = self.latency(task, model_name)
+            return (latency is not None, latency or 0, chain.index(model_name))
+        
+        return sorted(healthy, key=sort_key) + unhealthy
+
+model_router = ModelRouter()
+
+class GenerationCancelled(Exception):
+    """对冲模型已经胜出，被放弃的流式请求主动停止"""
+
+def call_gemini(task, model_name, prompt, stream=False, cancelled=None):
+    """调用一个Gemini模型并记录延迟和成败，结果按模型和prompt缓存，stream=True时流式写入检查点
+    
+    cancelled为threading.Event，置位后流式请求在收到下一段输出时停止并抛出GenerationCancelled。
+    """
+    gemini_cache_key = cache_key(model_name, prompt)
+    cached = cache_get("gemini", gemini_cache_key)
+    if cached:
+        return cached
+    
+    genai.configure(api_key=GEMINI_API_KEY)
+    model = genai.GenerativeModel(model_name)
+    start = time.time()
+    response = None
+    try:
+        with api_slot(gemini_api_name(model_name)):
+            if stream:
+                checkpoint = NotesCheckpoint(gemini_cache_key)
+                text = stream_notes(model, prompt, checkpoint, cancelled)
+                checkpoint.clear()
+            else:
+                response = model.generate_content(prompt)
+                text = response.text
+    except GenerationCancelled:
+        # 主动放弃的请求不计入模型的错误率
+        raise
+    except Exception as e:
+        error_str = str(e)
+        model_router.record(task, model_name, time.time() - start, error_str)
+        if is_gemini_quota_error(error_str):
+            rate_limiter.block(gemini_api_name(model_name), parse_gemini_retry_delay(error_str))
+        raise
+    model_router.record(task, model_name, time.time() - start)
+    record_gemini_usage(model_name, prompt, text, response)
+    cache_set("gemini", gemini_cache_key, text)
+    return text
+
+def generate_with_fallback(task, chain, prompt, stream=False, cancelled=None):
+    """按路由顺序依次尝试模型链中的模型，返回(模型名, 文本)
+    
+    已有缓存结果的模型直接使用；临时错误和配额错误切换到下一个模型，
+    密钥等与模型无关的错误直接抛出。所有模型都失败时抛出最后一个错误。
+    """
+    for model_name in chain:
+        cached = cache_get("gemini", cache_key(model_name, prompt))
+        if cached:
+            return model_name, cached
+    
+    last_error = None
+    for model_name in model_router.route(task, chain):
+        try:
+            return model_name, call_gemini(task, model_name, prompt, stream=stream, cancelled=cancelled)
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            error_str = str(e)
+            if is_gemini_auth_error(error_str):
+                raise
+            logger.warning(f"{model_name} 调用失败，尝试下一个模型: {error_str}")
+            last_error = e
+    raise last_error
+
+def run_in_daemon(fn, *args):
+    """在守护线程中执行fn并返回Future，被对冲掉的慢请求不会阻塞进程退出"""
+    future = Future()
+    context = contextvars.copy_context()
+    
+    def target():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(fn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=target, name="gemini-hedge", daemon=True).start()
+    return future
+
+def generate_hedged(task, chain, prompt, stream=False):
+    """用模型链生成内容，超过GEMINI_HEDGE_DELAY秒仍未完成时同时请求对冲模型，返回先得到的有效结果
+    
+    只在超时时对冲：主请求在此之前失败时直接抛出，由调用方重试并从流式检查点继续，
+    不让对冲模型从头生成。两者都失败时抛出最后一个错误。
+    
+    对冲模型胜出时通知主请求停止：流式请求在收到下一段输出时退出并释放并发名额，随后清理它留下的检查点。
+    已经生成的部分仍会计费；非流式请求和尚未返回第一段输出的请求无法中断，要等到请求结束才释放名额。
+    """
+    cancelled = threading.Event()
+    primary = run_in_daemon(generate_with_fallback, task, chain, prompt, stream, cancelled)
+    if GEMINI_HEDGE_DELAY <= 0 or not GEMINI_HEDGE_MODEL or GEMINI_HEDGE_MODEL in chain:
+        return primary.result()[1]
+    
+    done, _ = wait_futures([primary], timeout=GEMINI_HEDGE_DELAY)
+    if done:
+        return primary.result()[1]
+    logger.info(f"{'/'.join(chain)} 在{int(GEMINI_HEDGE_DELAY)}秒内未完成，同时请求 {GEMINI_HEDGE_MODEL}")
+    hedge = run_in_daemon(generate_with_fallback, task, [GEMINI_HEDGE_MODEL], prompt)
+    
+    pending = {primary, hedge}
+    last_error = None
+    while pending:
+        done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                model_name, text = future.result()
+            except Exception as e:
+                last_error = e
+                continue
+            if text.strip():
+                logger.info(f"采用 {model_name} 的结果")
+                if future is hedge:
+                    # 主请求可能还在写入检查点，等它停止后再删除，避免删除后又被追加写回
+                    cancelled.set()
+                    primary.add_done_callback(lambda _: clear_notes_checkpoints(chain, prompt))
+                return text
+    raise last_error or ValueError("Gemini返回了空内容")
+
+@retry(
+    stop=stop_after_attempt(3), 
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    before_sleep=before_sleep_record(logger)
+)
+def summarize_with_gemini(content):
+    """使用Google Gemini API总结内容"""
+    prompt = build_summary_prompt(content)
+    
+    try:
+        logger.info("正在总结内容")
+        # 按模型链依次尝试，缓存键包含模型和完整prompt（prompt中已含新闻内容）
+        model_name, text = generate_with_fallback("summary", GEMINI_SUMMARY_MODELS, prompt)
+        return text
+    except Exception as e:
+        error_str = str(e)
+        logger.error(f"生成摘要失败: {error_str}")
+        
+        # 对于500错误或服务不可用，让重试机制处理
+        if is_transient_gemini_error(error_str):
+            logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
+            raise  # 让retry装饰器重试
+        
+        # 对于其他类型的错误（不会重试的错误），发送通知
+        report_gemini_error(error_str, "/".join(GEMINI_SUMMARY_MODELS), content, prompt)
+        
+        raise
+
+# 流式生成HTML笔记：边接收边写入检查点文件，中途出错时从已生成的部分继续
+STREAM_NOTES = os.environ.get("GEMINI_STREAM_NOTES", "1").lower() in ("1", "true", "yes")
+
+# 没有结束标签的HTML元素
+HTML_VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                  "link", "meta", "param", "source", "track", "wbr"}
+
+class HTMLTagTracker(HTMLParser):
+    """增量解析HTML片段，记录尚未闭合的标签，用于补全被截断的输出"""
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = []
+    
+    def handle_starttag(self, tag, attrs):
+        if tag not in HTML_VOID_TAGS:
+            self.open_tags.append(tag)
+    
+    def handle_endtag(self, tag):
+        # 找到最近的同名开标签，期间未闭合的标签视为被隐式闭合；多余的结束标签忽略
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[i] == tag:
+                del self.open_tags[i:]
+                return
+    
+    def closing_tags(self):
+        return "".join(f"</{tag}>" for tag in reversed(self.open_tags))
+
+def strip_code_fence(text):
+    """去掉模型有时包在HTML外面的```html代码块标记"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+    if text.rstrip().endswith("```"):
+        text = text.rstrip()[:-3]
+    return text.strip()
+
+def repair_html(text):
+    """去掉代码块标记并补全未闭合的标签"""
+    body = strip_code_fence(text)
+    tracker = HTMLTagTracker()
+    tracker.feed(body)
+    return body + tracker.closing_tags()
+
+def notes_checkpoint_path(key):
+    return os.path.join(RUNS_DIR, "partial", f"{key}.html")
+
+def clear_notes_checkpoints(chain, prompt):
+    """删除模型链中各模型对同一prompt留下的检查点，用于其他模型的结果已经胜出时"""
+    for model_name in chain:
+        try:
+            os.remove(notes_checkpoint_path(cache_key(model_name, prompt)))
+        except OSError:
+            pass
+
+class NotesCheckpoint:
+    """流式生成的HTML笔记检查点
+    
+    每收到一段输出就追加写入runs/partial下的文件，并增量更新未闭合标签。
+    重试或重跑时读取已有内容，去掉末尾不完整的标签后从那里继续生成。
+    """
+    
+    def __init__(self, key):
+        self.path = notes_checkpoint_path(key)
+        self.text = ""
+        self.tracker = HTMLTagTracker()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                partial = f.read()
+        except OSError:
+            partial = ""
+        # 解析器尚未消化的尾部是被截断的半个标签，丢弃后从完整的位置续写
+        self.tracker.feed(partial)
+        partial = partial[:len(partial) - len(self.tracker.rawdata)]
+        self.tracker = HTMLTagTracker()
+        self.tracker.feed(partial)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(partial)
+        self.text = partial
+        # 续写的输出可能又以```html代码块标记开头，确定开头之前先缓存，不写入检查点
+        self._head = "" if partial else None
+    
+    def append(self, chunk):
+        if self._head is not None:
+            self._head += chunk
+            head = self._head.lstrip()
+            if "```".startswith(head[:3]) and "\n" not in head:
+                return
+            chunk = self._take_head()
+        self.text += chunk
+        self.tracker.feed(chunk)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(chunk)
+    
+    def _take_head(self):
+        """返回缓存的续写开头，去掉其中的代码块标记行"""
+        head, self._head = self._head, None
+        if head.lstrip().startswith("```"):
+            head = head.lstrip()
+            head = head.split("\n", 1)[1] if "\n" in head else ""
+        return head
+    
+    def result(self):
+        """返回补全了结束标签的完整HTML"""
+        if self._head is not None:
+            self.append(self._take_head())
+        return strip_code_fence(self.text) + self.tracker.closing_tags()
+    
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def build_continue_prompt(prompt, partial):
+    """构建续写prompt，让模型从已生成内容的末尾继续输出"""
+    return f"""{prompt}
+    
+    你之前的输出在中途被中断，以下是已经输出的HTML内容。
+    请直接从中断处继续输出剩余的HTML，不要重复已输出的部分，也不要添加任何解释：
+    {partial[-4000:]}
+    """
+
+def stream_notes(model, prompt, checkpoint, cancelled=None):
+    """流式生成HTML笔记，每段输出立即写入检查点，返回补全后的HTML；cancelled置位后停止读取"""
+    if checkpoint.text:
+        logger.info(f"从已生成的 {len(checkpoint.text)} 字符处继续生成笔记")
+        request_prompt = build_continue_prompt(prompt, checkpoint.text)
+    else:
+        request_prompt = prompt
+    
+    if cancelled is not None and cancelled.is_set():
+        raise GenerationCancelled("对冲模型已经胜出，不再请求")
+    for chunk in model.generate_content(request_prompt, stream=True):
+        if cancelled is not None and cancelled.is_set():
+            # 不再读取剩余输出，尽快释放api_slot的并发名额
+            raise GenerationCancelled(f"对冲模型已经胜出，停止读取（已生成 {len(checkpoint.text)} 字符）")
+        try:
+            text = chunk.text
+        except ValueError:
+            # 没有文本的分片（例如只包含结束原因）直接跳过
+            continue
+        checkpoint.append(text)
+    return checkpoint.result()
+
+@retry(
+    stop=stop_after_attempt(5),  #重试最多三次，貌似不太够，5次吧
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    before_sleep=before_sleep_record(logger)
+)
+def generate_html_notes(content, title):
+    """使用Google Gemini API生成HTML格式的笔记"""
+    prompt = build_notes_prompt(content, title)
+    
+    # 任一模型已有缓存结果时直接使用
+    for model_name in GEMINI_NOTES_MODELS + [GEMINI_HEDGE_MODEL]:
+        cached = cache_get("gemini", cache_key(model_name, prompt))
+        if cached:
+            return cached
     
     try:
         logger.info("正在生成笔记")
-        # 配置Gemini API
-        genai.configure(api_key=GEMINI_API_KEY)
-        # 创建模型
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        # 生成回复
-        response = model.generate_content(prompt)
-        # 返回文本内容
-        return response.text
+        # pro模型较慢，超时未完成时用flash模型对冲
+        return generate_hedged("notes", GEMINI_NOTES_MODELS, prompt, stream=STREAM_NOTES)
     except Exception as e:
-        import traceback
         error_str = str(e)
         logger.error(f"生成HTML笔记失败: {error_str}")
         
         # 对于500错误或服务不可用，让重试机制处理
-        if "500" in error_str or "An internal error has occurred" in error_str or "UNAVAILABLE" in error_str:
+        if is_transient_gemini_error(error_str):
             logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
             raise  # 让retry装饰器重试
         
-        # 构建详细日志信息
-        log_details = f"模型: gemini-2.5-pro\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\nPrompt长度: {len(prompt)} 字符\n完整错误: {traceback.format_exc()}"
-        
         # 对于其他类型的错误（不会重试的错误），发送通知
-        if "403" in error_str and "CONSUMER_SUSPENDED" in error_str:
-            send_error_notification("账户被暂停", "API消费者账户已被暂停", "Gemini AI", log_info=log_details)
-        elif "403" in error_str and "Permission denied" in error_str:
-            send_error_notification("权限被拒绝", error_str, "Gemini AI", log_info=log_details)
-        elif "401" in error_str or "Invalid API key" in error_str:
-            send_error_notification("API密钥无效", error_str, "Gemini AI", log_info=log_details)
-        elif "429" in error_str or "quota" in error_str.lower():
-            send_error_notification("配额超限", error_str, "Gemini AI", log_info=log_details)
-        else:
-            send_error_notification("未知错误", error_str, "Gemini AI", log_info=log_details)
+        report_gemini_error(error_str, "/".join(GEMINI_NOTES_MODELS), content, prompt)
         
         # 如果失败，返回简单的HTML格式
-        return f"""
+        return build_notes_fallback(title, content, error_str)
+
+def build_notes_fallback(title, content, error_str):
+    """笔记生成失败时使用的简单HTML"""
+    return f"""
         <h1>{title}</h1>
         <div style="background-color: #fff3cd; border: 1px solid #ffeaa7; padding: 15px; border-radius: 5px; margin: 20px 0;">
-            <h3 style="color: #856404;">⚠️ 笔记生成失败</h3>
+            <h3 style="color: #856404;">{NOTES_FALLBACK_MARKER}</h3>
             <p>由于API错误，无法生成结构化笔记。错误信息：{error_str}</p>
             <p>请查看以下原始摘要内容：</p>
         </div>
         <pre style="background-color: #f8f9fa; padding: 15px; border-radius: 5px; white-space: pre-wrap;">{content[:500]}...</pre>
         """
 
-def get_notion_database_properties():
-    """获取Notion数据库的属性结构"""
+# 生成模式：separate为摘要(flash)和笔记(pro)分别调用，single为一次调用生成结构化内容后在本地渲染两者
+GENERATION_MODE = os.environ.get("GENERATION_MODE", "separate")
+GEMINI_SINGLE_PASS_MODEL = os.environ.get("GEMINI_SINGLE_PASS_MODEL", "gemini-2.5-pro")
+
+STRUCTURED_NOTES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "key_points": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"title": {"type": "string"}, "detail": {"type": "string"}},
+                "required": ["title", "detail"],
+            },
+        },
+        "exam_points": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "topic": {"type": "string"},
+                    "relevance": {"type": "string"},
+                    "question_type": {"type": "string"},
+                },
+                "required": ["topic", "relevance", "question_type"],
+            },
+        },
+        "questions": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "exam": {"type": "string"},
+                    "question": {"type": "string"},
+                    "approach": {"type": "string"},
+                    "answer": {"type": "string"},
+                    "extension": {"type": "string"},
+                },
+                "required": ["exam", "question", "approach", "answer"],
+            },
+        },
+        "html_sections": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"heading": {"type": "string"}, "html": {"type": "string"}},
+                "required": ["heading", "html"],
+            },
+        },
+    },
+    "required": ["summary", "key_points", "exam_points", "questions", "html_sections"],
+}
+
+def build_structured_prompt(content, title):
+    """构建单次生成结构化内容的prompt"""
+    prompt = f"""
+    请阅读以下新闻联播（{title}）内容，特别关注与考研和考公考试相关的重点内容，按JSON结构输出：
+    - summary：整体摘要（300字左右）
+    - key_points：主要新闻点，title为新闻标题，detail为详细新闻报道
+    - exam_points：考研考公重点与可能考点，topic为考点，relevance说明与国家政策、经济发展、社会治理、重大事件、国际关系等的关联，question_type为可能的题型
+    - questions：模仿考研政治和公务员考试（行测、申论、面试）出几道模拟题，exam为考试类型，approach说明出题思路和思考流程，answer为参考答案和解析（必须包含），extension为举一反三
+    - html_sections：其余学习内容，每项的html只使用HTML标签（不要Markdown），至少包含：
+      1. 申论用法：如何把今天的新闻融入申论写作，附高分申论片段示例
+      2. 记忆方法：如何简单地记忆需要用到的新闻素材
+      3. 抽认卡：正面是问题，反面是答案
+    新闻内容:
+    {content}
+    """
+    return prompt
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    before_sleep=before_sleep_record(logger)
+)
+def generate_json(model_name, prompt, schema, content, description):
+    """按JSON schema生成结构化内容并缓存，返回dict；content只用于错误通知"""
+    json_cache_key = cache_key(model_name, "json", prompt)
+    cached = cache_get("gemini", json_cache_key)
+    if cached:
+        return cached
+    
+    try:
+        logger.info(f"正在{description}")
+        genai.configure(api_key=GEMINI_API_KEY)
+        model = genai.GenerativeModel(model_name, generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": schema,
+        })
+        with api_slot(gemini_api_name(model_name)):
+            response = model.generate_content(prompt)
+        record_gemini_usage(model_name, prompt, response.text, response)
+        data = json.loads(response.text)
+        cache_set("gemini", json_cache_key, data)
+        return data
+    except json.JSONDecodeError as e:
+        # 输出被截断或格式不对，让重试机制重新生成
+        logger.warning(f"结构化输出不是合法的JSON，将进行重试: {str(e)}")
+        raise
+    except Exception as e:
+        error_str = str(e)
+        logger.error(f"{description}失败: {error_str}")
+        
+        # 对于500错误或服务不可用，让重试机制处理
+        if is_transient_gemini_error(error_str):
+            logger.warning(f"Gemini API服务暂时不可用，将进行重试: {error_str}")
+            raise
+        
+        report_gemini_error(error_str, model_name, content, prompt)
+        raise
+
+def generate_structured_notes(content, title):
+    """一次调用同时生成摘要和笔记所需的结构化内容，返回dict"""
+    return generate_json(GEMINI_SINGLE_PASS_MODEL, build_structured_prompt(content, title),
+                         STRUCTURED_NOTES_SCHEMA, content, "一次性生成摘要和笔记")
+
+def generate_single_pass(content, title):
+    """单次生成结构化内容，失败时返回None，由调用方退回分别生成"""
+    try:
+        data = generate_structured_notes(content, title)
+        logger.info(f"成功生成结构化内容，新闻点 {len(data.get('key_points', []))} 条，模拟题 {len(data.get('questions', []))} 道")
+        return data
+    except Exception as e:
+        logger.warning(f"一次性生成失败，改为分别生成摘要和笔记: {str(e)}")
+        return None
+
+def render_summary_text(data):
+    """把结构化内容渲染成保存到Notion的纯文本摘要"""
+    lines = ["1. 整体摘要", data.get("summary", ""), "", "2. 主要新闻点"]
+    for i, point in enumerate(data.get("key_points", []), start=1):
+        lines.append(f"{i}) {point.get('title', '')}：{point.get('detail', '')}")
+    lines += ["", f"3. {data.get('audience', '考研考公')}重点"]
+    for point in data.get("exam_points", []):
+        lines.append(f"- {point.get('topic', '')}：{point.get('relevance', '')}（{point.get('question_type', '')}）")
+    lines += ["", "4. 模拟题"]
+    for i, question in enumerate(data.get("questions", []), start=1):
+        lines.append(f"{i}) 【{question.get('exam', '')}】{question.get('question', '')}")
+        lines.append(f"   出题思路：{question.get('approach', '')}")
+        lines.append(f"   参考答案：{question.get('answer', '')}")
+        if question.get("extension"):
+            lines.append(f"   举一反三：{question.get('extension')}")
+    return "\n".join(lines)
+
+def render_notes_html(data, title):
+    """把结构化内容渲染成邮件使用的HTML笔记"""
+    esc = lambda text: html.escape(str(text or "")).replace("\n", "<br>")
+    parts = [f"<h1 style=\"text-align: center;\">{esc(title)}</h1>"]
+    
+    parts.append("<h2>整体摘要</h2>")
+    parts.append(f"<p>{esc(data.get('summary'))}</p>")
+    
+    parts.append("<h2>关键新闻点</h2><ol>")
+    for point in data.get("key_points", []):
+        parts.append(f"<li><strong>{esc(point.get('title'))}</strong><br>{esc(point.get('detail'))}</li>")
+    parts.append("</ol>")
+    
+    parts.append(f"<h2>{esc(data.get('audience', '考研考公'))}重要信息与可能考点</h2>")
+    parts.append("<table><tr><th>考点</th><th>关联内容</th><th>可能题型</th></tr>")
+    for point in data.get("exam_points", []):
+        parts.append(f"<tr><td class=\"important\">{esc(point.get('topic'))}</td>"
+                     f"<td>{esc(point.get('relevance'))}</td><td>{esc(point.get('question_type'))}</td></tr>")
+    parts.append("</table>")
+    
+    parts.append("<h2>模拟题</h2>")
+    for i, question in enumerate(data.get("questions", []), start=1):
+        parts.append(f"<h3>{i}. 【{esc(question.get('exam'))}】{esc(question.get('question'))}</h3>")
+        parts.append(f"<p><strong>出题思路：</strong>{esc(question.get('approach'))}</p>")
+        parts.append(f"<p class=\"highlight\"><strong>参考答案：</strong>{esc(question.get('answer'))}</p>")
+        if question.get("extension"):
+            parts.append(f"<p><strong>举一反三：</strong>{esc(question.get('extension'))}</p>")
+    
+    for section in data.get("html_sections", []):
+        parts.append(f"<h2>{esc(section.get('heading'))}</h2>")
+        parts.append(repair_html(section.get("html", "")))
+    
+    return "\n".join(parts)
+
+# 按受众划分的笔记版本。所有版本共用一次抓取和一次基础分析（摘要和主要新闻点），
+# 每个版本只根据基础分析单独生成考点、模拟题和学习段落
+PROMPT_PROFILES = {
+    "kaoyan": {
+        "label": "考研政治",
+        "focus": "考研政治（马原、毛中特、史纲、思修法基、形势与政策）",
+        "questions": "单项选择题、多项选择题和分析题",
+        "sections": "时政热点与教材知识点的对应关系；分析题答题模板；需要背诵的关键表述",
+    },
+    "xingce": {
+        "label": "行测/申论",
+        "focus": "公务员考试行测（常识判断、言语理解、资料分析）和申论",
+        "questions": "常识判断单选题、资料分析题和申论小题",
+        "sections": "申论用法（附高分申论片段示例）；可以直接引用的规范表述和数据；常识判断易混知识点",
+    },
+    "mianshi": {
+        "label": "面试",
+        "focus": "公务员和事业单位结构化面试（综合分析、组织管理、应急应变、人际关系）",
+        "questions": "结构化面试题",
+        "sections": "答题思路框架；可以引用的新闻素材和金句；答题时的常见误区",
+    },
+}
+# 自定义版本的JSON文件，格式与PROMPT_PROFILES相同，同名时逐个字段覆盖内置版本
+PROMPT_PROFILES_FILE = os.environ.get("PROMPT_PROFILES_FILE", "profiles.json")
+PROFILE_REQUIRED_KEYS = ("label", "focus", "questions", "sections")
+
+def load_prompt_profiles(path=PROMPT_PROFILES_FILE):
+    """把自定义版本合并到内置版本上，返回合并后的版本字典
+    
+    同名版本只覆盖文件中给出的字段。文件无法解析时只使用内置版本，
+    单个版本不是对象或合并后缺少必填字段时跳过该版本，都只记录日志，不影响导入本模块。
+    """
+    profiles = {name: dict(profile) for name, profile in PROMPT_PROFILES.items()}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            custom = json.load(f)
+    except FileNotFoundError:
+        return profiles
+    except (OSError, ValueError) as e:
+        logger.error(f"读取笔记版本文件 {path} 失败，只使用内置版本: {str(e)}")
+        return profiles
+    if not isinstance(custom, dict):
+        logger.error(f"笔记版本文件 {path} 应为JSON对象，只使用内置版本")
+        return profiles
+    
+    for name, overrides in custom.items():
+        if name == "default" or not isinstance(overrides, dict):
+            logger.error(f"笔记版本 {name} 无效，已跳过")
+            continue
+        profile = dict(profiles.get(name, {}), **overrides)
+        missing = [key for key in PROFILE_REQUIRED_KEYS if not isinstance(profile.get(key), str) or not profile[key].strip()]
+        if missing:
+            logger.error(f"笔记版本 {name} 缺少 {', '.join(missing)}，已跳过")
+            continue
+        profiles[name] = profile
+    return profiles
+
+PROMPT_PROFILES = load_prompt_profiles()
+# 基础分析读取整篇文稿，用flash即可；各版本只读取基础分析，输入很短
+GEMINI_ANALYSIS_MODEL = os.environ.get("GEMINI_ANALYSIS_MODEL", "gemini-2.5-flash")
+GEMINI_PROFILE_MODEL = os.environ.get("GEMINI_PROFILE_MODEL", "gemini-2.5-pro")
+
+BASE_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {name: STRUCTURED_NOTES_SCHEMA["properties"][name] for name in ("summary", "key_points")},
+    "required": ["summary", "key_points"],
+}
+PROFILE_SECTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {name: STRUCTURED_NOTES_SCHEMA["properties"][name] for name in ("exam_points", "questions", "html_sections")},
+    "required": ["exam_points", "questions", "html_sections"],
+}
+
+def build_analysis_prompt(content, title):
+    """构建与受众无关的基础分析prompt"""
+    prompt = f"""
+    请阅读以下新闻联播（{title}）内容，按JSON结构输出不针对任何考试的基础分析：
+    - summary：整体摘要（300字左右）
+    - key_points：全部主要新闻点，title为新闻标题，detail为详细新闻报道，保留其中的政策表述、数据和会议名称
+    新闻内容:
+    {content}
+    """
+    return prompt
+
+def build_profile_prompt(analysis, profile, title):
+    """根据基础分析构建某一受众的专属部分prompt，不再传入原文"""
+    prompt = f"""
+    以下是新闻联播（{title}）的摘要和主要新闻点，请面向{profile['focus']}的备考者，按JSON结构输出：
+    - exam_points：重要信息与可能考点，topic为考点（尽量对应到具体科目和知识点），relevance说明与新闻的关联，question_type为可能的题型
+    - questions：出几道{profile['questions']}，exam为题型，approach说明出题思路，answer为参考答案和解析（必须包含），extension为举一反三
+    - html_sections：其余学习内容，每项的html只使用HTML标签（不要Markdown），至少包含：{profile['sections']}
+    新闻分析:
+    {json.dumps(analysis, ensure_ascii=False)}
+    """
+    return prompt
+
+def generate_base_analysis(content, title):
+    """生成所有版本共用的基础分析"""
+    return generate_json(GEMINI_ANALYSIS_MODEL, build_analysis_prompt(content, title),
+                         BASE_ANALYSIS_SCHEMA, content, "生成基础分析")
+
+def generate_profile_sections(analysis, name, title):
+    """生成某一版本的考点、模拟题和学习段落，结果按基础分析和版本配置缓存"""
+    profile = PROMPT_PROFILES[name]
+    prompt = build_profile_prompt(analysis, profile, title)
+    return generate_json(GEMINI_PROFILE_MODEL, prompt, PROFILE_SECTIONS_SCHEMA, prompt, f"生成{profile['label']}版笔记")
+
+def render_profile(analysis, sections, name, title):
+    """把基础分析和版本专属部分合并，渲染成摘要文本和HTML笔记"""
+    data = dict(analysis, **sections, audience=PROMPT_PROFILES[name]["label"])
+    return render_summary_text(data), render_notes_html(data, title)
+
+_notion_client = None
+_notion_client_lock = threading.Lock()
+
+def get_notion_client():
+    """获取进程内共享的Notion客户端"""
+    global _notion_client
+    with _notion_client_lock:
+        if _notion_client is None:
+            _notion_client = notion_client.Client(auth=NOTION_API_KEY)
+        return _notion_client
+
+def retrieve_notion_database():
+    """获取Notion数据库对象，失败时返回None"""
     try:
-        notion = Client(auth=NOTION_API_KEY)
-        database = notion.databases.retrieve(database_id=NOTION_DATABASE_ID)
+        notion = get_notion_client()
+        with api_slot("notion"):
+            database = notion.databases.retrieve(database_id=NOTION_DATABASE_ID)
         logger.info(f"已获取Notion数据库属性")
-        return database['properties']
+        return database
     except Exception as e:
         logger.error(f"获取Notion数据库属性失败: {str(e)}")
         return None
 
-def save_to_notion(title, content, summary):
-    """将原文和总结保存到Notion"""
-    notion = Client(auth=NOTION_API_KEY)
+_notion_schema = None
+_notion_schema_lock = threading.Lock()
+
+def get_cached_notion_schema():
+    """只从内存或磁盘缓存中读取数据库结构，没有缓存时返回None"""
+    global _notion_schema
+    if not _notion_schema:
+        _notion_schema = cache_get("notion", cache_key("notion_schema", NOTION_DATABASE_ID))
+    return _notion_schema
+
+def get_notion_schema(refresh=False):
+    """获取数据库标题和日期属性的名称
     
-    # 获取数据库属性
-    db_properties = get_notion_database_properties()
-    if not db_properties:
-        logger.error("无法获取Notion数据库属性，保存失败")
-        return None
+    结果缓存在内存和本地磁盘缓存中，并记录数据库的last_edited_time作为版本号，
+    refresh=True时重新从Notion获取。
+    """
+    with _notion_schema_lock:
+        if not refresh:
+            cached = get_cached_notion_schema()
+            if cached:
+                return cached
         
-    # 找到标题和日期属性的正确名称
+        database = retrieve_notion_database()
+        if not database:
+            return None
+        return remember_notion_schema(parse_notion_schema(database))
+
+def parse_notion_schema(database):
+    """从数据库对象中找出标题和日期属性的名称"""
     title_property_name = None
     date_property_name = None
     
-    for name, prop in db_properties.items():
+    for name, prop in database['properties'].items():
         if (prop['type'] == 'title'):
             title_property_name = name
         elif (prop['type'] == 'date'):
@@ -528,6 +2380,101 @@ def save_to_notion(title, content, summary):
         logger.error(f"未找到所需属性，标题属性: {title_property_name}, 日期属性: {date_property_name}")
         return None
     
+    return {
+        "title_property": title_property_name,
+        "date_property": date_property_name,
+        "version": database.get("last_edited_time"),
+    }
+
+def remember_notion_schema(schema):
+    """把数据库结构写入内存和磁盘缓存"""
+    global _notion_schema
+    if schema:
+        _notion_schema = schema
+        cache_set("notion", cache_key("notion_schema", NOTION_DATABASE_ID), schema)
+    return schema
+
+# Notion单次请求最多携带100个子块
+NOTION_BATCH_SIZE = 100
+# 这些错误表示请求未被执行，可以安全重试
+# notion_client.APIErrorCode的取值，写成字符串以免导入时加载notion_client
+NOTION_RATE_LIMITED = "rate_limited"
+NOTION_RETRYABLE_CODES = (NOTION_RATE_LIMITED, "internal_server_error", "service_unavailable", "conflict_error")
+
+def is_notion_rate_limited(e):
+    return isinstance(e, notion_client.APIResponseError) and e.code == NOTION_RATE_LIMITED
+
+def is_retryable_notion_error(e):
+    return isinstance(e, notion_client.APIResponseError) and e.code in NOTION_RETRYABLE_CODES
+
+def wait_notion_retry(retry_state):
+    """遇到429时按Retry-After头等待，其他错误指数退避"""
+    e = retry_state.outcome.exception()
+    if is_notion_rate_limited(e):
+        retry_after = parse_retry_after(e.headers.get("retry-after", 1))
+        if retry_after is not None:
+            # 同时暂停其他线程和进程的Notion请求，避免它们继续触发429
+            rate_limiter.block("notion", retry_after)
+            return retry_after
+    return min(2 ** retry_state.attempt_number, 30)
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_notion_retry,
+    retry=retry_if_exception(is_notion_rate_limited),
+    before_sleep=before_sleep_record(logger),
+    reraise=True
+)
+def create_notion_page(properties, children):
+    """创建Notion页面，只在被限流时重试，避免重复建页"""
+    with api_slot("notion"):
+        return get_notion_client().pages.create(
+            parent={"database_id": NOTION_DATABASE_ID},
+            properties=properties,
+            children=children
+        )
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_notion_retry,
+    retry=retry_if_exception(is_retryable_notion_error),
+    before_sleep=before_sleep_record(logger),
+    reraise=True
+)
+def append_notion_blocks(block_id, children):
+    """向页面追加一批子块，单批失败只重试这一批"""
+    with api_slot("notion"):
+        return get_notion_client().blocks.children.append(block_id=block_id, children=children)
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_notion_retry,
+    retry=retry_if_exception(is_retryable_notion_error),
+    before_sleep=before_sleep_record(logger),
+    reraise=True
+)
+def query_notion_pages(start_cursor=None):
+    """按创建时间倒序分页读取数据库中的页面"""
+    kwargs = {"start_cursor": start_cursor} if start_cursor else {}
+    with api_slot("notion"):
+        return get_notion_client().databases.query(database_id=NOTION_DATABASE_ID, page_size=100,
+                                                   sorts=[{"timestamp": "created_time", "direction": "descending"}], **kwargs)
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_notion_retry,
+    retry=retry_if_exception(is_retryable_notion_error),
+    before_sleep=before_sleep_record(logger),
+    reraise=True
+)
+def list_notion_blocks(block_id, start_cursor=None):
+    """分页读取页面的子块"""
+    kwargs = {"start_cursor": start_cursor} if start_cursor else {}
+    with api_slot("notion"):
+        return get_notion_client().blocks.children.list(block_id=block_id, page_size=100, **kwargs)
+
+def build_notion_children(content, summary):
+    """构建Notion页面的子块：摘要标题、摘要段落、原文标题、原文段落"""
     # 将长内容分割成较小的块
     def chunk_text(text, max_length=2000):
         return [text[i:i+max_length] for i in range(0, len(text), max_length)]
@@ -575,110 +2522,694 @@ def save_to_notion(title, content, summary):
             }
         })
     
+    return children
+
+def build_notion_properties(schema, title, date=None):
+    """构建页面属性，date为写入日期属性的日期，默认为当天"""
     properties = {}
-    properties[title_property_name] = {
+    properties[schema["title_property"]] = {
         "title": [{"text": {"content": title}}]
     }
-    properties[date_property_name] = {
-        "date": {"start": datetime.datetime.now().strftime("%Y-%m-%d")}
+    properties[schema["date_property"]] = {
+        "date": {"start": (date or datetime.datetime.now()).strftime("%Y-%m-%d")}
     }
+    return properties
+
+def save_to_notion(title, content, summary, date=None, resume=None, on_progress=None):
+    """将原文和总结保存到Notion，date为写入日期属性的日期，默认为当天
     
-    try:
-        logger.info(f"正在保存到Notion")
-        page = notion.pages.create(
-            parent={"database_id": NOTION_DATABASE_ID},
-            properties=properties,
-            children=children
-        )
-        return page["id"]
+    页面先带着第一批子块创建，其余子块按Notion允许的最大批量依次追加。
+    每批成功后以{"page_id", "appended"}调用on_progress；传入同样格式的resume
+    时跳过建页，从上次中断的那一批继续追加。全部写完才返回页面ID。
+    """
+    # 获取数据库属性（优先使用缓存）
+    schema = get_notion_schema()
+    if not schema:
+        logger.error("无法获取Notion数据库属性，保存失败")
+        return None
+    
+    children = build_notion_children(content, summary)
+    
+    def report_progress(page_id, appended):
+        if on_progress:
+            on_progress({"page_id": page_id, "appended": appended})
+    
+    try:
+        if resume:
+            page_id = resume["page_id"]
+            appended = resume["appended"]
+            logger.info(f"继续写入Notion页面，已写入 {appended}/{len(children)} 个块")
+        else:
+            logger.info(f"正在保存到Notion")
+            first_batch = children[:NOTION_BATCH_SIZE]
+            try:
+                page = create_notion_page(build_notion_properties(schema, title, date), first_batch)
+            except notion_client.APIResponseError as e:
+                if e.code != notion_client.APIErrorCode.ValidationError:
+                    raise
+                # 校验失败可能是缓存的数据库结构已过期，刷新后版本号有变化才重试
+                fresh_schema = get_notion_schema(refresh=True)
+                if not fresh_schema or fresh_schema.get("version") == schema.get("version"):
+                    raise
+                logger.warning("Notion数据库结构已变更，使用新的属性名称重试")
+                page = create_notion_page(build_notion_properties(fresh_schema, title, date), first_batch)
+            page_id = page["id"]
+            appended = len(first_batch)
+            report_progress(page_id, appended)
+        
+        # 同一页面的追加必须按顺序进行，否则块的先后顺序会错乱
+        while appended < len(children):
+            batch = children[appended:appended + NOTION_BATCH_SIZE]
+            append_notion_blocks(page_id, batch)
+            appended += len(batch)
+            report_progress(page_id, appended)
+        
+        return page_id
     except Exception as e:
         logger.error(f"保存到Notion失败: {str(e)}")
         return None
 
-def send_email(title, summary, content=None):
-    """发送HTML格式的笔记摘要邮件"""
-    msg = MIMEMultipart('alternative')
-    # 使用环境变量中的发件人地址，而不是硬编码
-    msg['From'] = EMAIL_SENDER
-    msg['To'] = RECIPIENT_EMAIL
-    msg['Subject'] = f"【新闻联播学习笔记】{title}"
+# 订阅者列表文件，每行一个邮箱地址，#之后为注释；RECIPIENT_EMAIL总会收到邮件
+SUBSCRIBERS_FILE = os.environ.get("SUBSCRIBERS_FILE", "subscribers.txt")
+# 每个SMTP事务（一次DATA）包含的收件人数
+DELIVERY_BATCH_SIZE = int(os.environ.get("DELIVERY_BATCH_SIZE", 50))
+# 并行发送的SMTP连接数，不超过SMTP_CONCURRENCY（默认同为4）
+DELIVERY_WORKERS = int(os.environ.get("DELIVERY_WORKERS", 4))
+# 被临时拒收（4xx）的收件人在本次运行中最多再投递的轮数
+DELIVERY_ROUNDS = int(os.environ.get("DELIVERY_ROUNDS", 2))
+# 连续硬退信（5xx）达到该次数的地址不再投递
+BOUNCE_LIMIT = int(os.environ.get("BOUNCE_LIMIT", 3))
+BOUNCES_PATH = os.path.join(RUNS_DIR, "bounces.json")
+
+def load_subscriber_profiles():
+    """读取收件人并按笔记版本分组，返回{版本: [地址]}
     
-    # 先生成HTML格式笔记
-    html_notes = generate_html_notes(content or summary, title)
+    订阅者文件每行为“地址 [版本]”，不写版本的收到默认笔记（default）；RECIPIENT_EMAIL总是收到默认笔记。
+    地址按小写去重，重复时以第一次出现的为准。
+    """
+    entries = [(RECIPIENT_EMAIL, "default")]
+    try:
+        with open(SUBSCRIBERS_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split("#", 1)[0].split()
+                if fields:
+                    entries.append((fields[0], fields[1] if len(fields) > 1 else "default"))
+    except FileNotFoundError:
+        pass
+    seen = set()
+    groups = {}
+    for address, profile in entries:
+        if not address or "@" not in address or address.lower() in seen:
+            continue
+        if profile != "default" and profile not in PROMPT_PROFILES:
+            logger.warning(f"订阅者 {address} 的笔记版本 {profile} 不存在，已跳过")
+            continue
+        seen.add(address.lower())
+        groups.setdefault(profile, []).append(address)
+    return groups
+
+def load_subscribers(profile="default"):
+    """读取某一笔记版本的收件人"""
+    return load_subscriber_profiles().get(profile, [])
+
+class DeliveryLog:
+    """单日邮件的逐个收件人投递记录，以及跨日期累计的退信记录
     
-    # 添加CSS样式的基础HTML
-    html_content = f"""
-    <!DOCTYPE html>
-    <html lang="zh-CN">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title} - 学习笔记</title>
-        <style>
-            body {{
-                font-family: 'Microsoft YaHei', '微软雅黑', Arial, sans-serif;
-                line-height: 1.6;
-                color: #333;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-            }}
-            .container {{
-                background-color: #f9f9f9;
-                border-radius: 8px;
-                padding: 25px;
-                box-shadow: 0 2px 10px rgba(0,0,0,0.1);
-            }}
-            .header {{
-                text-align: center;
-                margin-bottom: 25px;
-                padding-bottom: 15px;
-                border-bottom: 2px solid #e0e0e0;
-            }}
-            .footer {{
-                font-size: 12px;
-                color: #888;
-                text-align: center;
-                margin-top: 30px;
-                padding-top: 15px;
-                border-top: 1px solid #e0e0e0;
-            }}
-            table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin: 20px 0;
-            }}
-            th, td {{
-                padding: 10px;
-                border: 1px solid #ddd;
-                text-align: left;
-            }}
-            th {{
-                background-color: #f0f0f0;
-            }}
-            .important {{
-                color: #d32f2f;
-                font-weight: bold;
-            }}
-            .highlight {{
-                background-color: #fff9c4;
-                padding: 2px 4px;
-                border-radius: 3px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            {html_notes}
-            
-            <div class="footer">
-                此邮件由AI自动生成，内容仅供参考学习使用。<br>
-                如需了解更多详情，请查看完整新闻内容。
-            </div>
+    投递记录保存在runs/delivery/日期.json中，重跑时已送达（sent）或已退信（bounced）的地址不再投递，
+    只补发失败（failed）和还没发过的地址。连续硬退信BOUNCE_LIMIT次的地址记入停发名单，成功送达后清零。
+    run_id为None时只在内存中记录。
+    """
+    
+    def __init__(self, run_id=None):
+        self.path = os.path.join(RUNS_DIR, "delivery", f"{run_id}.json") if run_id else None
+        self.recipients = {}
+        if self.path and not IGNORE_JOURNAL:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.recipients = json.load(f).get("recipients", {})
+            except (OSError, ValueError):
+                self.recipients = {}
+    
+    def suppressed(self):
+        try:
+            with open(BOUNCES_PATH, "r", encoding="utf-8") as f:
+                bounces = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        return {address for address, entry in bounces.items() if entry.get("count", 0) >= BOUNCE_LIMIT}
+    
+    def pending(self, addresses):
+        """返回还需要投递的地址，跳过已送达、已退信和停发名单中的地址"""
+        suppressed = self.suppressed()
+        return [address for address in addresses
+                if self.recipients.get(address.lower(), {}).get("status") not in ("sent", "bounced")
+                and address.lower() not in suppressed]
+    
+    def retryable(self, addresses):
+        """本次运行中还值得再投递的地址：临时拒收（4xx）或连接错误，整封邮件被5xx拒绝的留到下次运行"""
+        retry_addresses = []
+        for address in self.pending(addresses):
+            entry = self.recipients.get(address.lower(), {})
+            if entry.get("status") != "failed" or (entry.get("code") or 0) < 500:
+                retry_addresses.append(address)
+        return retry_addresses
+    
+    def record(self, results):
+        """写入一批投递结果，并更新跨日期的退信计数"""
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for address, result in results.items():
+            previous = self.recipients.get(address.lower(), {})
+            self.recipients[address.lower()] = dict(result, attempts=previous.get("attempts", 0) + 1, updated=now)
+        if not self.path:
+            return
+        
+        def merge(data):
+            data.setdefault("recipients", {}).update({address.lower(): self.recipients[address.lower()] for address in results})
+        
+        def count_bounces(bounces):
+            for address, result in results.items():
+                if result["status"] == "bounced":
+                    entry = bounces.setdefault(address.lower(), {"count": 0})
+                    entry.update(count=entry["count"] + 1, last=now, error=result.get("error"))
+                elif result["status"] == "sent":
+                    bounces.pop(address.lower(), None)
+        
+        try:
+            update_json_file(self.path, merge)
+            update_json_file(BOUNCES_PATH, count_bounces)
+        except OSError as e:
+            logger.warning(f"写入投递记录失败: {str(e)}")
+    
+    def counts(self):
+        counts = {}
+        for entry in self.recipients.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+def is_transient_smtp_error(e):
+    """整批发送时的临时错误：连接断开、超时和4xx响应；逐个收件人的拒收单独处理"""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError))
+
+def classify_delivery(batch, refused=None, error=None):
+    """把一批收件人的发送结果整理成{地址: {"status", "code", "error"}}
+    
+    refused为RCPT阶段被拒收的{地址: (code, message)}，5xx记为退信，4xx记为失败待重发；
+    error为整批失败时的异常，此时整批记为失败，不计入退信。
+    """
+    refused = {address.lower(): value for address, value in (refused or {}).items()}
+    results = {}
+    for address in batch:
+        if error is not None:
+            results[address] = {"status": "failed", "code": getattr(error, "smtp_code", getattr(error, "code", None)), "error": str(error)}
+        elif address.lower() in refused:
+            code, message = refused[address.lower()]
+            if isinstance(message, bytes):
+                message = message.decode("utf-8", "replace")
+            results[address] = {"status": "bounced" if code >= 500 else "failed", "code": code, "error": message}
+        else:
+            results[address] = {"status": "sent", "code": None, "error": None}
+    return results
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=30),
+    retry=retry_if_exception(is_transient_smtp_error),
+    before_sleep=before_sleep_record(logger),
+    reraise=True
+)
+def send_batch(pool, text, batch):
+    """用池中的一个连接把同一封邮件发给一批收件人，返回被拒收的收件人"""
+    with pool.connection() as transport:
+        return transport.send_raw(text, EMAIL_SENDER, batch)
+
+def deliver_batch(pool, text, batch):
+    try:
+        return classify_delivery(batch, refused=send_batch(pool, text, batch))
+    except smtplib.SMTPRecipientsRefused as e:
+        return classify_delivery(batch, refused=e.recipients)
+    except Exception as e:
+        logger.error(f"一批{len(batch)}个收件人发送失败: {str(e)}")
+        return classify_delivery(batch, error=e)
+
+def split_batches(addresses, size=DELIVERY_BATCH_SIZE):
+    size = max(1, size)
+    return [addresses[i:i + size] for i in range(0, len(addresses), size)]
+
+# 笔记中的QuickChart Graphviz图表改为本地用graphviz渲染，作为内嵌图片随邮件发送；设为0时保留远程链接
+DIAGRAM_RENDER = os.environ.get("XWLB_DIAGRAM_RENDER", "1") != "0"
+DOT_BINARY = os.environ.get("DOT_BINARY", "dot")
+DIAGRAM_TIMEOUT = float(os.environ.get("DIAGRAM_TIMEOUT", 20))
+DIAGRAM_DPI = int(os.environ.get("DIAGRAM_DPI", 110))
+# 图中中文使用的字体，需要系统中已安装
+DIAGRAM_FONT = os.environ.get("DIAGRAM_FONT", "Noto Sans CJK SC")
+
+QUICKCHART_IMG_PATTERN = re.compile(r"""<img\b[^>]*?\bsrc\s*=\s*(["'])(https?://quickchart\.io/graphviz\?.*?)\1[^>]*>""", re.IGNORECASE | re.DOTALL)
+QUICKCHART_MARKDOWN_PATTERN = re.compile(r"!\[([^\]]*)\]\((https?://quickchart\.io/graphviz\?graph=.*?\})\)", re.DOTALL)
+IMG_ALT_PATTERN = re.compile(r"""\balt\s*=\s*(["'])(.*?)\1""", re.IGNORECASE | re.DOTALL)
+DOT_NODE_PATTERN = re.compile(r'(\w+)\s*\[[^\]]*?\blabel\s*=\s*"([^"]*)"')
+DOT_EDGE_PATTERN = re.compile(r'(\w+)\s*->\s*(\w+)(?:\s*\[[^\]]*?\blabel\s*=\s*"([^"]*)")?')
+
+def extract_dot(url):
+    """从QuickChart链接中取出DOT源码，取不到时返回None"""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(html.unescape(url)).query)
+    graph = query.get("graph", [""])[0].strip()
+    return graph if re.match(r"^(strict\s+)?(di)?graph\b", graph, re.IGNORECASE) else None
+
+def render_dot(dot):
+    """用本地graphviz把DOT渲染成PNG，结果按DOT的哈希缓存
+    
+    返回PNG字节；DOT无法解析时返回None，找不到graphviz时抛出FileNotFoundError。
+    """
+    import subprocess
+    key = cache_key("graphviz", DIAGRAM_DPI, DIAGRAM_FONT, dot)
+    cached = cache_get("diagrams", key)
+    if cached:
+        return base64.b64decode(cached["png"]) if cached.get("png") else None
+    
+    result = subprocess.run(
+        [DOT_BINARY, "-Tpng", f"-Gdpi={DIAGRAM_DPI}", f"-Gfontname={DIAGRAM_FONT}",
+         f"-Nfontname={DIAGRAM_FONT}", f"-Efontname={DIAGRAM_FONT}"],
+        input=dot.encode("utf-8"), capture_output=True, timeout=DIAGRAM_TIMEOUT,
+    )
+    if result.returncode != 0 or not result.stdout:
+        logger.warning(f"图表DOT无法解析，改为文字提纲: {result.stderr.decode('utf-8', 'replace').strip()[:200]}")
+        cache_set("diagrams", key, {"png": None, "error": result.stderr.decode("utf-8", "replace")[:500]})
+        return None
+    cache_set("diagrams", key, {"png": base64.b64encode(result.stdout).decode("ascii")})
+    return result.stdout
+
+def dot_outline(dot, caption):
+    """DOT无法渲染时，用节点标签和连线拼出文字提纲"""
+    # 先去掉连线语句，避免把连线上的label当成节点的label
+    labels = {node: label for node, label in DOT_NODE_PATTERN.findall(DOT_EDGE_PATTERN.sub(";", dot))}
+    name = lambda node: html.escape(labels.get(node, node))
+    items = []
+    for source, target, label in DOT_EDGE_PATTERN.findall(dot):
+        arrow = f" →（{html.escape(label)}）→ " if label else " → "
+        items.append(f"<li>{name(source)}{arrow}{name(target)}</li>")
+    if not items:
+        items = [f"<li>{html.escape(label)}</li>" for label in labels.values()]
+    heading = f"<p><strong>{html.escape(caption or '图表')}</strong></p>"
+    return f'<div class="diagram-outline">{heading}<ul>{"".join(items)}</ul></div>' if items else heading
+
+def inline_diagrams(html_notes):
+    """把笔记中的QuickChart图表换成本地渲染的内嵌图片
+    
+    返回(新的HTML, [(content_id, png字节)])。DOT无法解析时换成文字提纲；
+    本机没有graphviz时保留原来的远程链接。同一张图只附加一次。
+    """
+    if not DIAGRAM_RENDER or not html_notes or "quickchart.io/graphviz" not in html_notes:
+        return html_notes, []
+    images = {}
+    missing_binary = []
+    
+    def replace(match, url, caption):
+        if missing_binary:
+            return match.group(0)
+        dot = extract_dot(url)
+        if dot is None:
+            return dot_outline("", caption)
+        try:
+            png = render_dot(dot)
+        except (FileNotFoundError, PermissionError):
+            logger.warning(f"未找到graphviz（{DOT_BINARY}），图表保留为远程链接")
+            missing_binary.append(True)
+            return match.group(0)
+        except Exception as e:
+            logger.warning(f"渲染图表失败，改为文字提纲: {str(e)}")
+            png = None
+        if png is None:
+            return dot_outline(dot, caption)
+        content_id = f"diagram-{hashlib.sha256(dot.encode('utf-8')).hexdigest()[:16]}@xwlb"
+        images[content_id] = png
+        return f'<img src="cid:{content_id}" alt="{html.escape(caption or "图表")}" style="max-width: 100%;">'
+    
+    def replace_img(match):
+        alt = IMG_ALT_PATTERN.search(match.group(0))
+        return replace(match, match.group(2), html.unescape(alt.group(2)) if alt else "")
+    
+    with run_metrics.stage("stage.diagrams"):
+        html_notes = QUICKCHART_IMG_PATTERN.sub(replace_img, html_notes)
+        html_notes = QUICKCHART_MARKDOWN_PATTERN.sub(lambda match: replace(match, match.group(2), match.group(1)), html_notes)
+    if images:
+        logger.info(f"已在本地渲染 {len(images)} 张图表")
+    return html_notes, list(images.items())
+
+def serialize_message(msg):
+    """序列化邮件并记录最终大小"""
+    text = msg.as_string()
+    size = len(text.encode("utf-8"))
+    run_metrics.add("stage.render", bytes=size)
+    logger.info(f"邮件大小 {size / 1024:.1f} KB")
+    return text
+
+def build_delivery_message(title, summary, html_notes, subscribers):
+    """只渲染一次邮件；有多个订阅者时To头不列出收件人，实际地址只出现在信封中"""
+    to_header = subscribers[0] if len(subscribers) == 1 else "undisclosed-recipients:;"
+    html_notes, images = inline_diagrams(html_notes)
+    return build_email_message(title, summary, html_notes, to_header=to_header, images=images)
+
+def deliver_email(title, summary, html_notes, run_id=None, subscribers=None):
+    """把同一封笔记邮件投递给所有订阅者（默认为默认笔记版本的订阅者）
+    
+    邮件只渲染和序列化一次，收件人按DELIVERY_BATCH_SIZE分批放进信封，多个SMTP连接并行发送。
+    每个收件人的结果写入投递记录；没有失败（退信不算失败）时返回True。
+    """
+    log = DeliveryLog(run_id)
+    subscribers = load_subscribers() if subscribers is None else subscribers
+    pending = log.pending(subscribers)
+    if not pending:
+        logger.info("所有订阅者都已投递，无需发送")
+        return bool(subscribers)
+    
+    text = serialize_message(build_delivery_message(title, summary, html_notes, subscribers))
+    workers = max(1, min(DELIVERY_WORKERS, API_CONCURRENCY["smtp"] or DELIVERY_WORKERS, len(split_batches(pending))))
+    logger.info(f"正在向 {len(pending)} 个订阅者发送邮件（{workers} 个连接）")
+    pool = MailPool(workers)
+    try:
+        for round_index in range(max(1, DELIVERY_ROUNDS)):
+            with ContextThreadPoolExecutor(max_workers=workers, thread_name_prefix="deliver") as executor:
+                futures = [executor.submit(deliver_batch, pool, text, batch) for batch in split_batches(pending)]
+                for future in as_completed(futures):
+                    log.record(future.result())
+            pending = log.retryable(pending)
+            if not pending:
+                break
+            logger.warning(f"{len(pending)} 个收件人暂时无法投递（第{round_index + 1}轮）")
+    finally:
+        pool.close()
+    
+    counts = log.counts()
+    logger.info(f"邮件投递完成：送达 {counts.get('sent', 0)}，退信 {counts.get('bounced', 0)}，失败 {counts.get('failed', 0)}")
+    return not log.pending(subscribers)
+
+def send_email(title, summary, content=None, html_notes=None, run_id=None):
+    """发送HTML格式的笔记摘要邮件，未传入html_notes时现场生成
+    
+    笔记只生成一次，再由deliver_email()投递给所有订阅者。
+    """
+    # 没有预先生成的笔记时，先生成HTML格式笔记
+    if html_notes is None:
+        html_notes = generate_html_notes(content or summary, title)
+    
+    try:
+        logger.info(f"正在发送邮件....")
+        return deliver_email(title, summary, html_notes, run_id=run_id)
+    except Exception as e:
+        logger.error(f"发送邮件失败: {str(e)}")
+        return False
+
+# 笔记邮件正文（纯文本和HTML部分，不含内嵌图片和附件）按传输编码计算的大小上限，Gmail超过约102KB会截断邮件
+EMAIL_SIZE_BUDGET = int(os.environ.get("EMAIL_SIZE_BUDGET", 100 * 1024))
+# 超出预算的段落移到这个附件中，附件包含完整笔记
+EMAIL_OVERFLOW_FILENAME = os.environ.get("EMAIL_OVERFLOW_FILENAME", "完整笔记.html")
+
+# 邮件样式。大多数邮件客户端会去掉<style>，渲染时把能内联的规则写进各元素的style属性
+EMAIL_CSS = """
+body {
+    font-family: 'Microsoft YaHei', '微软雅黑', Arial, sans-serif;
+    line-height: 1.6;
+    color: #333;
+    max-width: 800px;
+    margin: 0 auto;
+    padding: 20px;
+}
+.container {
+    background-color: #f9f9f9;
+    border-radius: 8px;
+    padding: 25px;
+    box-shadow: 0 2px 10px rgba(0,0,0,0.1);
+}
+.header {
+    text-align: center;
+    margin-bottom: 25px;
+    padding-bottom: 15px;
+    border-bottom: 2px solid #e0e0e0;
+}
+.footer {
+    font-size: 12px;
+    color: #888;
+    text-align: center;
+    margin-top: 30px;
+    padding-top: 15px;
+    border-top: 1px solid #e0e0e0;
+}
+.overflow-note {
+    background-color: #e8f0fe;
+    border-left: 4px solid #1a73e8;
+    padding: 10px 15px;
+    margin: 20px 0;
+}
+table {
+    width: 100%;
+    border-collapse: collapse;
+    margin: 20px 0;
+}
+th, td {
+    padding: 10px;
+    border: 1px solid #ddd;
+    text-align: left;
+}
+th {
+    background-color: #f0f0f0;
+}
+.important {
+    color: #d32f2f;
+    font-weight: bold;
+}
+.highlight {
+    background-color: #fff9c4;
+    padding: 2px 4px;
+    border-radius: 3px;
+}
+"""
+
+EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title} - 学习笔记</title>
+    {style}
+</head>
+<body>
+    <div class="container">
+        {notes}
+        
+        <div class="footer">
+            此邮件由AI自动生成，内容仅供参考学习使用。<br>
+            如需了解更多详情，请查看完整新闻内容。
         </div>
-    </body>
-    </html>
+    </div>
+</body>
+</html>
+"""
+
+START_TAG_PATTERN = re.compile(r"""<([a-zA-Z][a-zA-Z0-9]*)((?:[^<>"']|"[^"]*"|'[^']*')*)>""")
+ATTRIBUTE_PATTERN = re.compile(r"""\s([a-zA-Z_:][-a-zA-Z0-9_:.]*)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?""")
+# 邮件客户端不支持或会拦截的交互元素，连同内容一起去掉
+STRIPPED_ELEMENTS = ("script", "style", "iframe", "object", "embed", "form", "button", "select", "textarea", "noscript",
+                     "audio", "video", "canvas", "head", "title")
+STRIPPED_VOID_TAGS = ("input", "link", "meta", "base")
+# 只保留内容、去掉标签本身的外层元素（模型有时会输出完整的HTML文档）
+UNWRAPPED_TAGS = ("html", "body")
+
+def split_css_blocks(css):
+    """按顶层的花括号拆分CSS，返回[(选择器, 块内文本)]
+    
+    @media等at规则的块内文本原样保留，其中嵌套的规则不会被拆开；@import等没有块的语句块内文本为None。
     """
+    blocks = []
+    prelude_start = 0
+    body_start = 0
+    depth = 0
+    for i, char in enumerate(css):
+        if char == "{":
+            if depth == 0:
+                body_start = i + 1
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                blocks.append((css[prelude_start:body_start - 1].strip(), css[body_start:i]))
+                prelude_start = i + 1
+        elif char == ";" and depth == 0:
+            if css[prelude_start:i].strip():
+                blocks.append((css[prelude_start:i].strip(), None))
+            prelude_start = i + 1
+    return blocks
+
+def parse_css(css):
+    """把CSS拆成可以内联的规则和只能留在<style>中的规则
+    
+    只内联tag、.class和tag.class三种选择器，返回([(优先级, 顺序, tag, class, [(属性, 值)])], 其余CSS文本)。
+    @media等at规则只在部分条件下生效，整块原样留在<style>中，不内联其中的规则。
+    """
+    rules = []
+    leftover = []
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    for index, (selectors, body) in enumerate(split_css_blocks(css)):
+        if body is None:
+            leftover.append(f"{selectors};")
+            continue
+        if selectors.startswith("@"):
+            leftover.append(f"{selectors}{{{body.strip()}}}")
+            continue
+        declarations = [tuple(part.strip() for part in item.split(":", 1)) for item in body.split(";") if ":" in item]
+        for selector in (item.strip() for item in selectors.split(",")):
+            match = re.fullmatch(r"([a-zA-Z][a-zA-Z0-9]*)?(?:\.([-\w]+))?", selector)
+            if not selector or not match:
+                leftover.append(f"{selector}{{{body.strip()}}}")
+                continue
+            tag, class_name = match.group(1), match.group(2)
+            specificity = (10 if class_name else 0) + (1 if tag else 0)
+            rules.append((specificity, index, tag.lower() if tag else None, class_name, declarations))
+    rules.sort(key=lambda rule: (rule[0], rule[1]))
+    return rules, "".join(leftover)
+
+def inline_css(body, rules):
+    """把规则写进匹配元素的style属性，元素原有的style优先"""
+    if not rules:
+        return body
+    
+    def replace(match):
+        tag = match.group(1).lower()
+        attributes = match.group(2)
+        self_closing = attributes.rstrip().endswith("/")
+        if self_closing:
+            attributes = attributes.rstrip()[:-1]
+        parsed = {name.lower(): value for name, value in ATTRIBUTE_PATTERN.findall(attributes)}
+        classes = html.unescape(parsed.get("class", "").strip("\"'")).split()
+        styles = {}
+        for _, _, rule_tag, rule_class, declarations in rules:
+            if (rule_tag is None or rule_tag == tag) and (rule_class is None or rule_class in classes):
+                styles.update(declarations)
+        if not styles:
+            return match.group(0)
+        existing = html.unescape(parsed.get("style", "").strip("\"'"))
+        for item in existing.split(";"):
+            if ":" in item:
+                name, value = item.split(":", 1)
+                styles[name.strip()] = value.strip()
+        attributes = ATTRIBUTE_PATTERN.sub(lambda attr: "" if attr.group(1).lower() == "style" else attr.group(0), attributes)
+        style = ";".join(f"{name}:{value}" for name, value in styles.items()).replace('"', "'")
+        return f"<{match.group(1)}{attributes} style=\"{style}\"{' /' if self_closing else ''}>"
+    
+    return START_TAG_PATTERN.sub(replace, body)
+
+def strip_interactive(body):
+    """去掉邮件中不支持的交互元素、事件属性和javascript:链接，返回(HTML, 其中<style>的CSS)"""
+    css = "".join(re.findall(r"<style\b[^>]*>(.*?)</style>", body, flags=re.IGNORECASE | re.DOTALL))
+    body = re.sub(r"<!DOCTYPE[^>]*>", "", body, flags=re.IGNORECASE)
+    for tag in STRIPPED_ELEMENTS:
+        body = re.sub(rf"<{tag}\b[^>]*>.*?</{tag}\s*>", "", body, flags=re.IGNORECASE | re.DOTALL)
+    body = re.sub(rf"</?(?:{'|'.join(STRIPPED_VOID_TAGS + STRIPPED_ELEMENTS + UNWRAPPED_TAGS)})\b[^>]*>", "", body, flags=re.IGNORECASE)
+    # 折叠块在多数客户端中无法展开，改成普通段落直接显示内容
+    body = re.sub(r"<details\b[^>]*>", "<div>", body, flags=re.IGNORECASE)
+    body = re.sub(r"</details\s*>", "</div>", body, flags=re.IGNORECASE)
+    body = re.sub(r"<summary\b[^>]*>", "<p><strong>", body, flags=re.IGNORECASE)
+    body = re.sub(r"</summary\s*>", "</strong></p>", body, flags=re.IGNORECASE)
+    
+    def clean_tag(match):
+        attributes = ATTRIBUTE_PATTERN.sub(
+            lambda attr: "" if attr.group(1).lower().startswith("on")
+            or (attr.group(1).lower() in ("href", "src") and re.match(r"""["']?\s*javascript:""", attr.group(2) or "", re.IGNORECASE))
+            else attr.group(0),
+            match.group(2))
+        return f"<{match.group(1)}{attributes}>"
+    
+    return START_TAG_PATTERN.sub(clean_tag, body), css
+
+def minify_html(body):
+    """去掉注释和标签之间的换行缩进，<pre>中的内容保持原样"""
+    parts = re.split(r"(<pre\b.*?</pre\s*>)", body, flags=re.IGNORECASE | re.DOTALL)
+    for i in range(0, len(parts), 2):
+        part = re.sub(r"<!--.*?-->", "", parts[i], flags=re.DOTALL)
+        part = re.sub(r">\s*\n\s*<", "><", part)
+        parts[i] = re.sub(r"\s+", " ", part)
+    return "".join(parts).strip()
+
+def encoded_size(text):
+    """按UTF-8加base64传输编码后的字节数"""
+    return len(base64.encodebytes(text.encode("utf-8")))
+
+_email_template = None
+_email_template_lock = threading.Lock()
+
+def get_email_template():
+    """编译一次邮件模板：解析样式，把样式内联进外层模板并压缩，返回(页首, 页尾, 可内联规则, 其余CSS)"""
+    global _email_template
+    with _email_template_lock:
+        if _email_template is None:
+            rules, leftover = parse_css(EMAIL_CSS)
+            style = f"<style>{leftover}</style>" if leftover else ""
+            page = minify_html(inline_css(EMAIL_TEMPLATE.replace("{style}", style), rules))
+            head, tail = page.split("{notes}")
+            _email_template = (head, tail, rules, leftover)
+        return _email_template
+
+def split_sections(body):
+    """按<h2>把笔记拆成段落，第一段为第一个<h2>之前的内容"""
+    return [section for section in re.split(r"(?=<h2\b)", body, flags=re.IGNORECASE) if section.strip()]
+
+def section_heading(section):
+    match = re.search(r"<h2\b[^>]*>(.*?)</h2\s*>", section, flags=re.IGNORECASE | re.DOTALL)
+    return html.unescape(re.sub(r"<[^>]+>", "", match.group(1))).strip() if match else ""
+
+def build_overflow_note(sections, rules):
+    headings = "".join(f"<li>{html.escape(heading)}</li>" for heading in map(section_heading, sections) if heading)
+    note = (f'<div class="overflow-note">笔记篇幅较长，以下部分已放入附件“{html.escape(EMAIL_OVERFLOW_FILENAME)}”，'
+            f'附件中是完整笔记：<ul>{headings}</ul></div>')
+    return inline_css(note, rules)
+
+def render_email_html(title, html_notes, text_size=0, budget=EMAIL_SIZE_BUDGET):
+    """渲染邮件HTML：去掉交互元素、内联CSS、压缩空白，并按大小预算拆分
+    
+    返回(邮件HTML, 完整笔记HTML或None)。正文超出预算时从后往前把<h2>段落移出正文，
+    正文末尾列出被移走的段落，完整笔记另作附件；第一段总会保留。
+    """
+    head, tail, rules, _ = get_email_template()
+    head = head.replace("{title}", title)
+    notes, notes_css = strip_interactive(html_notes or "")
+    if notes_css:
+        extra_rules, extra_leftover = parse_css(notes_css)
+        # 无法内联的规则（后代选择器、:hover、@media等）与模板的一样留在<head>的<style>中
+        if extra_leftover:
+            head = head.replace("</head>", f"<style>{extra_leftover}</style></head>", 1)
+        # 笔记自带的样式写在模板样式之后，同等优先级时覆盖模板
+        rules = sorted(rules + [(specificity, index + len(rules), tag, class_name, declarations)
+                                for specificity, index, tag, class_name, declarations in extra_rules],
+                       key=lambda rule: (rule[0], rule[1]))
+    sections = [minify_html(inline_css(section, rules)) for section in split_sections(notes)]
+    
+    full_page = head + "".join(sections) + tail
+    if not budget or encoded_size(full_page) + text_size <= budget or len(sections) <= 1:
+        return full_page, None
+    
+    kept = len(sections) - 1
+    while kept > 1:
+        page = head + "".join(sections[:kept]) + build_overflow_note(sections[kept:], rules) + tail
+        if encoded_size(page) + text_size <= budget:
+            break
+        kept -= 1
+    page = head + "".join(sections[:kept]) + build_overflow_note(sections[kept:], rules) + tail
+    logger.info(f"邮件正文超出预算 {budget // 1024} KB，{len(sections) - kept} 个段落移到附件")
+    return page, full_page
+
+def build_email_message(title, summary, html_notes, to_header=None, images=None):
+    """构建笔记邮件：纯文本和HTML两个部分，正文超出大小预算时附上完整笔记
+    
+    images为HTML中以cid:引用的[(content_id, png字节)]，只附加正文中实际引用的图片；
+    附件中的图片改为data: URI，浏览器中直接打开即可显示。
+    """
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.image import MIMEImage
     
     # 同时添加纯文本版本作为备用
     text_content = f"""
@@ -690,101 +3221,389 @@ def send_email(title, summary, content=None):
     此邮件由自动化系统发送，请勿回复。
     """
     
+    with run_metrics.stage("stage.render"):
+        html_content, full_notes = render_email_html(title, html_notes, text_size=encoded_size(text_content))
+    
     # 添加纯文本和HTML两个部分
+    msg = MIMEMultipart('alternative')
     part1 = MIMEText(text_content, 'plain', 'utf-8')
     part2 = MIMEText(html_content, 'html', 'utf-8')
     
     msg.attach(part1)
-    msg.attach(part2)  # HTML版本会被大多数邮件客户端优先显示
+    inline_images = [(content_id, data) for content_id, data in images or [] if f"cid:{content_id}" in html_content]
+    if inline_images:
+        # 内嵌图片和HTML放在同一个multipart/related中，客户端不需要再联网加载
+        related = MIMEMultipart('related')
+        related.attach(part2)
+        for content_id, data in inline_images:
+            image = MIMEImage(data, 'png')
+            image.add_header('Content-ID', f"<{content_id}>")
+            image.add_header('Content-Disposition', 'inline', filename=f"{content_id.split('@')[0]}.png")
+            related.attach(image)
+        msg.attach(related)
+    else:
+        msg.attach(part2)  # HTML版本会被大多数邮件客户端优先显示
     
-    smtp_server = os.environ.get("SMTP_SERVER", "smtp.mailersend.net")
-    smtp_port = int(os.environ.get("SMTP_PORT", 587))
+    if full_notes:
+        for content_id, data in images or []:
+            full_notes = full_notes.replace(f"cid:{content_id}", f"data:image/png;base64,{base64.b64encode(data).decode('ascii')}")
+        attachment = MIMEText(full_notes, 'html', 'utf-8')
+        attachment.add_header('Content-Disposition', 'attachment', filename=('utf-8', '', EMAIL_OVERFLOW_FILENAME))
+        mixed = MIMEMultipart('mixed')
+        mixed.attach(msg)
+        mixed.attach(attachment)
+        msg = mixed
     
-    try:
-        logger.info(f"正在发送邮件....")
-        server = smtplib.SMTP(smtp_server, smtp_port)
-        server.starttls()
-        # 登录时仍使用环境变量中的凭据
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        text = msg.as_string()
-        # 发送时使用环境变量中的发件人地址
-        server.sendmail(EMAIL_SENDER, RECIPIENT_EMAIL, text)
-        server.quit()
-        logger.info("HTML邮件发送成功")
-        return True
-    except Exception as e:
-        logger.error(f"发送邮件失败: {str(e)}")
+    # 使用环境变量中的发件人地址，而不是硬编码
+    msg['From'] = EMAIL_SENDER
+    msg['To'] = to_header or RECIPIENT_EMAIL
+    msg['Subject'] = f"【新闻联播学习笔记】{title}"
+    return msg
+
+def check_required_env():
+    """检查必要的环境变量，缺失时返回False"""
+    required_vars = ["JINA_API_KEY", "GEMINI_API_KEY", "NOTION_API_KEY", 
+                    "NOTION_DATABASE_ID", "EMAIL_ADDRESS", 
+                    "EMAIL_PASSWORD", "RECIPIENT_EMAIL"]
+    
+    missing_vars = [var for var in required_vars if not os.environ.get(var)]
+    if missing_vars:
+        logger.error(f"缺少以下环境变量: {', '.join(missing_vars)}")
         return False
+    return True
 
-def main():
-    try:
-        # 检查必要的环境变量
-        required_vars = ["JINA_API_KEY", "GEMINI_API_KEY", "NOTION_API_KEY", 
-                        "NOTION_DATABASE_ID", "EMAIL_ADDRESS", 
-                        "EMAIL_PASSWORD", "RECIPIENT_EMAIL"]
+# 长文稿分段摘要（map-reduce）设置
+# 单次生成调用允许的新闻内容token上限，超出时先分段提炼再汇总
+GEMINI_TOKEN_BUDGET = int(os.environ.get("GEMINI_TOKEN_BUDGET", 16000))
+# 每个分段的token上限
+GEMINI_SEGMENT_TOKENS = int(os.environ.get("GEMINI_SEGMENT_TOKENS", 4000))
+# 分段提炼使用的模型
+GEMINI_MAP_MODEL = os.environ.get("GEMINI_MAP_MODEL", "gemini-2.5-flash")
+
+# 新闻条目的开头：编号（1. / 1、/ 一、）、【标题】或Markdown标题
+NEWS_ITEM_PATTERN = re.compile(r"^\s*(?:#{1,6}\s|\d{1,2}\s*[\.、．]|[一二三四五六七八九十]+、|【)")
+
+def estimate_tokens(text):
+    """粗略估计token数：中日韩字符约1个token，其余字符约4个字符1个token"""
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff" or "\u3000" <= ch <= "\u303f" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def split_news_items(content):
+    """按新闻条目切分文稿，没有识别到条目时按段落切分"""
+    items = []
+    current = []
+    for line in content.splitlines():
+        if NEWS_ITEM_PATTERN.match(line) and current:
+            items.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        items.append("\n".join(current))
+    if len(items) <= 1:
+        items = [p for p in re.split(r"\n\s*\n", content) if p.strip()]
+    return items
+
+def split_transcript(content, segment_tokens=None):
+    """把文稿切成不超过token上限的分段，尽量让同一条新闻留在同一个分段里"""
+    segment_tokens = segment_tokens or GEMINI_SEGMENT_TOKENS
+    segments = []
+    current = ""
+    for item in split_news_items(content):
+        # 单条新闻本身超长时按字符数硬切
+        while estimate_tokens(item) > segment_tokens:
+            cut = max(1, len(item) * segment_tokens // estimate_tokens(item))
+            if current:
+                segments.append(current)
+                current = ""
+            segments.append(item[:cut])
+            item = item[cut:]
+        if current and estimate_tokens(current) + estimate_tokens(item) > segment_tokens:
+            segments.append(current)
+            current = ""
+        current = f"{current}\n{item}" if current else item
+    if current.strip():
+        segments.append(current)
+    return segments
+
+def build_segment_prompt(segment, index, total):
+    """构建分段提炼prompt"""
+    return f"""
+    以下是一期新闻联播文字稿的第{index}/{total}部分。
+    请逐条提炼其中每一条新闻的要点，供后续汇总生成考研考公学习笔记使用：
+    1. 保留新闻标题、关键人物、时间、数据、政策名称和重要表述原文
+    2. 不要遗漏任何一条新闻，不要添加原文中没有的内容
+    3. 只输出提炼结果，不要任何解释
+    新闻内容:
+    {segment}
+    """
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=4, max=10),
+    retry=retry_if_exception(lambda e: is_transient_gemini_error(str(e))),
+    before_sleep=before_sleep_record(logger)
+)
+def summarize_segment(prompt):
+    """用flash模型提炼一个分段，结果按模型和prompt缓存"""
+    return call_gemini("segment", GEMINI_MAP_MODEL, prompt)
+
+def condense_transcript(content, token_budget=None, max_rounds=3):
+    """文稿超出token预算时并行分段提炼，返回可以放进单次调用的内容
+    
+    未超出预算时原样返回；某个分段提炼失败时保留该分段原文，不丢内容。
+    """
+    token_budget = token_budget or GEMINI_TOKEN_BUDGET
+    for round_index in range(max_rounds):
+        if estimate_tokens(content) <= token_budget:
+            return content
         
-        missing_vars = [var for var in required_vars if not os.environ.get(var)]
-        if missing_vars:
-            logger.error(f"缺少以下环境变量: {', '.join(missing_vars)}")
-            return
+        segments = split_transcript(content)
+        total = len(segments)
+        logger.info(f"内容约 {estimate_tokens(content)} token，超出预算 {token_budget}，分 {total} 段并行提炼（第{round_index + 1}轮）")
         
-        # 获取昨天的新闻联播URL
-        url, title = get_yesterday_url()
-        logger.info(f"获取URL中")
+        def map_segment(index, segment):
+            try:
+                return summarize_segment(build_segment_prompt(segment, index, total))
+            except Exception as e:
+                logger.warning(f"第{index}段提炼失败，保留原文: {str(e)}")
+                return segment
+        
+        with ContextThreadPoolExecutor(max_workers=max(1, API_CONCURRENCY["gemini_flash"]), thread_name_prefix="map") as executor:
+            summaries = list(executor.map(map_segment, range(1, total + 1), segments))
+        content = "\n\n".join(summaries)
+    return content
+
+def summarize_content(content):
+    """生成摘要，重试仍失败时返回占位摘要而不是抛出异常"""
+    try:
+        summary = summarize_with_gemini(content)
+        logger.info(f"成功生成摘要，长度: {len(summary)} 字符")
+        return summary
+    except Exception as e:
+        import traceback
+        error_str = str(e)
         
-        # 使用Jina AI读取网页内容
-        result = read_webpage_with_jina(url)
+        # 如果是重试失败，发送最终错误通知
+        if "RetryError" in error_str or "已重试3次仍失败" in error_str:
+            log_details = f"Gemini API重试3次后仍然失败\n模型: {'/'.join(GEMINI_SUMMARY_MODELS)}\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\n完整错误: {traceback.format_exc()}"
+            send_error_notification("重试失败", "Gemini API摘要生成重试3次后仍然失败", "Gemini AI", log_info=log_details)
+        
+        logger.error(f"生成摘要失败，将跳过摘要步骤: {error_str}")
+        return SUMMARY_PLACEHOLDER
+
+def fetch_stage(journal, url):
+    """读取页面正文并写入运行记录，已有记录时直接复用，读取失败返回None"""
+    if journal.is_done("fetched"):
+        content = journal.get("fetched")
+    else:
+        # 先直接抓取网页，必要时使用Jina AI读取
+        result = fetch_webpage(url)
         
         if not result or "data" not in result or "content" not in result["data"]:
             logger.error("无法获取网页内容")
-            return
+            return None
         
         content = result["data"]["content"]
-        logger.info(f"成功获取内容，长度: {len(content)} 字符")
-        
-        # 总结内容 - 添加重试失败处理
-        summary = None
-        try:
-            summary = summarize_with_gemini(content)
-            logger.info(f"成功生成摘要，长度: {len(summary)} 字符")
-        except Exception as e:
-            import traceback
-            error_str = str(e)
-            
-            # 如果是重试失败，发送最终错误通知
-            if "RetryError" in error_str or "已重试3次仍失败" in error_str:
-                log_details = f"Gemini API重试3次后仍然失败\n模型: gemini-2.5-flash\nAPI密钥: {GEMINI_API_KEY[:10]}...****\n内容长度: {len(content)} 字符\n完整错误: {traceback.format_exc()}"
-                send_error_notification("重试失败", "Gemini API摘要生成重试3次后仍然失败", "Gemini AI", log_info=log_details)
-            
-            logger.error(f"生成摘要失败，将跳过摘要步骤: {error_str}")
-            summary = "由于Gemini API不稳定，无法生成摘要。请稍后重试。"
-        
-        # 保存到Notion
-        page_id = save_to_notion(title, content, summary)
+        journal.record("fetched", content)
+    logger.info(f"成功获取内容，长度: {len(content)} 字符")
+    return content
+
+def notion_stage(journal, title, content, summary, notion_date=None):
+    """保存到Notion并写入运行记录，已保存时直接返回页面ID，失败返回None"""
+    page_id = journal.get("notion_saved")
+    if not journal.is_done("notion_saved"):
+        # 上次写到一半的页面从中断的那一批继续追加
+        resume = journal.get("notion_saved") if journal.status("notion_saved") == "partial" else None
+        page_id = save_to_notion(title, content, summary, date=notion_date, resume=resume,
+                                 on_progress=lambda progress: journal.record("notion_saved", progress, status="partial"))
         if page_id:
+            journal.record("notion_saved", page_id)
             logger.info(f"成功保存到Notion！")
         else:
             logger.warning("保存到Notion失败")
-        
-        # 发送邮件 - 添加重试失败处理
-        email_sent = False
+    return page_id
+
+def profiles_pending(journal):
+    """有其他笔记版本的订阅者且本期还没有全部投递"""
+    return not journal.is_done("profiles_sent") and any(name != "default" for name in load_subscriber_profiles())
+
+def journal_complete(journal):
+    return journal.first_incomplete() is None and not profiles_pending(journal)
+
+def profile_stage(journal, content, title, structured=None):
+    """为订阅了其他笔记版本的读者生成并投递对应的笔记，全部投递后返回True
+    
+    基础分析只生成一次并写入运行记录（单次生成模式下直接取结构化结果中的摘要和新闻点），
+    各版本只根据基础分析生成专属部分，并行生成和投递。
+    """
+    if not profiles_pending(journal):
+        return True
+    log = DeliveryLog(journal.run_id)
+    groups = {name: addresses for name, addresses in load_subscriber_profiles().items()
+              if name != "default" and log.pending(addresses)}
+    if not groups:
+        journal.record("profiles_sent", True)
+        return True
+    
+    analysis = journal.get("analyzed")
+    if not analysis:
         try:
-            email_sent = send_email(title, summary, content)
-            if email_sent:
-                logger.info("成功发送邮件")
-            else:
-                logger.warning("发送邮件失败")
+            with run_metrics.stage("stage.analysis"):
+                if structured:
+                    analysis = {"summary": structured.get("summary", ""), "key_points": structured.get("key_points", [])}
+                else:
+                    analysis = generate_base_analysis(condense_transcript(content), title)
         except Exception as e:
-            import traceback
-            error_str = str(e)
-            
-            # 如果邮件发送时HTML生成失败，也进行处理
-            if "生成HTML笔记失败" in error_str:
-                log_details = f"HTML笔记生成重试失败\n模型: gemini-2.5-pro\n完整错误: {traceback.format_exc()}"
-                send_error_notification("HTML笔记生成失败", "邮件中的HTML笔记生成失败", "Gemini AI", log_info=log_details)
-            
-            logger.error(f"发送邮件过程中出错: {error_str}")
-            
+            logger.error(f"生成基础分析失败，本次不发送其他版本的笔记: {str(e)}")
+            return False
+        journal.record("analyzed", analysis)
+    
+    def run_profile(name):
+        label = PROMPT_PROFILES[name]["label"]
+        try:
+            sections = generate_profile_sections(analysis, name, title)
+            summary, html_notes = render_profile(analysis, sections, name, title)
+            return deliver_email(f"{title}·{label}", summary, html_notes, run_id=journal.run_id, subscribers=groups[name])
+        except Exception as e:
+            logger.error(f"{label}版笔记生成或发送失败: {str(e)}")
+            return False
+    
+    with ContextThreadPoolExecutor(max_workers=len(groups), thread_name_prefix="profile") as executor:
+        results = list(executor.map(lambda name: run_metrics.timed(f"stage.profile.{name}", run_profile)(name), groups))
+    if all(results):
+        journal.record("profiles_sent", True)
+        logger.info(f"已发送 {len(groups)} 个版本的笔记")
+    return all(results)
+
+def archive_stage(journal, date, archive=None):
+    """把运行记录中已完成阶段的原文、摘要和笔记写入本地存档，写入失败只记录警告"""
+    if not ARCHIVE_ENABLED or not journal.is_done("fetched"):
+        return False
+    url, title = get_broadcast_url(date)
+    page_id = journal.get("notion_saved") if journal.is_done("notion_saved") else None
+    try:
+        with run_metrics.stage("stage.archive"):
+            (archive or transcript_archive).upsert(
+                date.strftime("%Y-%m-%d"), title=title, url=url, content=journal.get("fetched"),
+                summary=journal.get("summarized") if journal.is_done("summarized") else None,
+                notes_html=journal.get("notes_generated") if journal.is_done("notes_generated") else None,
+                notion_page_id=page_id if isinstance(page_id, str) else None,
+            )
+        return True
+    except sqlite3.Error as e:
+        logger.warning(f"写入本地存档失败: {str(e)}")
+        return False
+
+def process_broadcast(date, notion_date=None):
+    """处理一期新闻联播：读取网页、生成摘要、保存到Notion并发送邮件
+    
+    每个阶段完成后写入运行记录，重跑时已完成的阶段直接复用记录中的结果，
+    已保存的Notion页面和已发送的邮件不会重复创建。
+    """
+    # 同一日期同时只由一个任务处理，等待期间另一个任务可能已经完成了全部阶段
+    with date_lock(date.strftime("%Y-%m-%d")):
+        return _process_broadcast(date, notion_date)
+
+def _process_broadcast(date, notion_date=None):
+    url, title = get_broadcast_url(date)
+    journal = RunJournal(date.strftime("%Y-%m-%d"))
+    if journal_complete(journal):
+        logger.info(f"{title} 的所有阶段均已完成，跳过")
+        archive_stage(journal, date)
+        return True
+    
+    with run_metrics.stage("stage.fetch"):
+        content = fetch_stage(journal, url)
+    if content is None:
+        return False
+    run_metrics.add("stage.fetch", characters=len(content))
+    
+    # 摘要同时用于Notion和邮件纯文本部分，两者都已完成时无需再生成
+    summary_needed = not (journal.is_done("notion_saved") and journal.is_done("email_sent"))
+    generate_summary = summary_needed and not journal.is_done("summarized")
+    generate_notes = not journal.is_done("notes_generated") and not journal.is_done("email_sent")
+    
+    # 长文稿先分段提炼，保证每次生成调用都在token预算内；Notion仍保存完整原文
+    with run_metrics.stage("stage.condense"):
+        generation_input = condense_transcript(content) if generate_summary or generate_notes else content
+    
+    # 单次生成模式下只上传一次文稿，摘要和笔记都在本地从结构化结果渲染
+    structured = None
+    if GENERATION_MODE == "single" and (generate_summary or generate_notes):
+        with run_metrics.stage("stage.single_pass"):
+            structured = generate_single_pass(generation_input, title)
+    
+    # 摘要（flash）和HTML笔记（pro）互不依赖，拿到原文后同时开始生成
+    with ContextThreadPoolExecutor(max_workers=2, thread_name_prefix="generate") as executor:
+        summary_future = None
+        notes_future = None
+        if structured:
+            if generate_summary:
+                summary_future = executor.submit(run_metrics.timed("stage.summary", render_summary_text), structured)
+            if generate_notes:
+                notes_future = executor.submit(run_metrics.timed("stage.notes", render_notes_html), structured, title)
+        else:
+            if generate_summary:
+                summary_future = executor.submit(run_metrics.timed("stage.summary", summarize_content), generation_input)
+            if generate_notes:
+                notes_future = executor.submit(run_metrics.timed("stage.notes", generate_html_notes), generation_input, title)
+        
+        # Notion只需要摘要，不必等待耗时更长的HTML笔记
+        if summary_future:
+            summary = summary_future.result()
+            if summary != SUMMARY_PLACEHOLDER:
+                journal.record("summarized", summary)
+        else:
+            summary = journal.get("summarized")
+        
+        with run_metrics.stage("stage.notion"):
+            page_id = notion_stage(journal, title, content, summary, notion_date)
+        
+        # 发送邮件 - 添加重试失败处理
+        email_sent = journal.is_done("email_sent")
+        if not email_sent:
+            try:
+                if notes_future:
+                    html_notes = notes_future.result()
+                    if NOTES_FALLBACK_MARKER not in html_notes:
+                        journal.record("notes_generated", html_notes)
+                else:
+                    html_notes = journal.get("notes_generated")
+                with run_metrics.stage("stage.email"):
+                    email_sent = send_email(title, summary, content, html_notes=html_notes, run_id=journal.run_id)
+                if email_sent:
+                    journal.record("email_sent", True)
+                    logger.info("成功发送邮件")
+                else:
+                    logger.warning("发送邮件失败")
+            except Exception as e:
+                import traceback
+                error_str = str(e)
+                
+                # 如果HTML笔记生成重试后仍失败，也进行处理
+                if "RetryError" in error_str or "生成HTML笔记失败" in error_str:
+                    log_details = f"HTML笔记生成重试失败\n模型: {'/'.join(GEMINI_NOTES_MODELS)}\n完整错误: {traceback.format_exc()}"
+                    send_error_notification("HTML笔记生成失败", "邮件中的HTML笔记生成失败", "Gemini AI", log_info=log_details)
+                
+                logger.error(f"发送邮件过程中出错: {error_str}")
+    
+    profiles_sent = profile_stage(journal, content, title, structured)
+    archive_stage(journal, date)
+    return bool(page_id) and email_sent and profiles_sent
+
+def main():
+    run_metrics.reset()
+    try:
+        # 检查必要的环境变量
+        if not check_required_env():
+            return
+        
+        # 处理昨天的新闻联播
+        yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+        logger.info(f"获取URL中")
+        
+        process_broadcast(yesterday)
+    
     except Exception as e:
         import traceback
         logger.error(f"处理过程中发生错误: {str(e)}")
@@ -793,10 +3612,221 @@ def main():
         error_msg = f"新闻联播程序运行失败: {str(e)}"
         log_details = f"完整错误堆栈: {traceback.format_exc()}\n\n环境变量状态:\n- JINA_API_KEY: {'已设置' if JINA_API_KEY else '未设置'}\n- GEMINI_API_KEY: {'已设置' if GEMINI_API_KEY else '未设置'}\n- NOTION_API_KEY: {'已设置' if NOTION_API_KEY else '未设置'}\n- EMAIL配置: {'已设置' if EMAIL_ADDRESS and EMAIL_PASSWORD else '未设置'}"
         send_error_notification("程序运行错误", error_msg, "新闻联播自动化系统", log_info=log_details)
-        
+    
     finally:
+        # 合并本次运行的错误通知，并等待后台队列发送完毕
+        run_metrics.emit()
+        flush_notifications()
+        logger.info(usage_ledger.report())
         logger.info("处理完成")
 
+def backfill(start_date, end_date, max_workers=None):
+    """并发补跑一段日期范围内的新闻联播（包含首尾两天）
+    
+    每个日期在线程池中独立走完整流程，各外部API的并发由api_slot限制，
+    因此一个日期在等待Gemini时，其他日期的Jina读取、Notion写入和邮件发送可以同时进行。
+    返回 {日期字符串: 是否全部成功} 的字典。
+    """
+    if not check_required_env():
+        return {}
+    
+    if end_date < start_date:
+        start_date, end_date = end_date, start_date
+    days = (end_date - start_date).days + 1
+    dates = [start_date + datetime.timedelta(days=i) for i in range(days)]
+    max_workers = max_workers or BACKFILL_WORKERS
+    logger.info(f"开始回填 {start_date:%Y-%m-%d} 至 {end_date:%Y-%m-%d}，共 {days} 天，工作线程数: {max_workers}")
+    
+    results = {}
+    run_metrics.reset()
+    with ContextThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="backfill") as executor:
+        # 与每日定时任务保持一致：写入Notion的日期为播出日的次日
+        futures = {executor.submit(process_broadcast, date, date + datetime.timedelta(days=1)): date for date in dates}
+        for future in as_completed(futures):
+            date_str = futures[future].strftime("%Y-%m-%d")
+            try:
+                results[date_str] = future.result()
+            except Exception as e:
+                import traceback
+                logger.error(f"{date_str} 回填失败: {str(e)}")
+                send_error_notification("回填失败", f"{date_str} 新闻联播处理失败: {str(e)}", "新闻联播自动化系统", log_info=f"完整错误堆栈: {traceback.format_exc()}")
+                results[date_str] = False
+    
+    run_metrics.emit()
+    flush_notifications()
+    failed = sorted(date for date, ok in results.items() if not ok)
+    logger.info(f"回填完成，成功 {days - len(failed)} 天，失败 {len(failed)} 天")
+    logger.info(usage_ledger.report())
+    if failed:
+        logger.warning(f"以下日期未完全成功: {', '.join(failed)}")
+    return results
+
+def watch(date=None, max_hours=None):
+    """等待指定日期（默认昨天）的文字版发布，发布后立即处理，返回是否全部成功"""
+    run_metrics.reset()
+    try:
+        if not check_required_env():
+            return False
+        
+        date = date or datetime.datetime.now() - datetime.timedelta(days=1)
+        if journal_complete(RunJournal(date.strftime("%Y-%m-%d"))):
+            logger.info(f"{date:%Y-%m-%d} 已处理完成，无需等待")
+            return True
+        
+        if not wait_for_broadcast(date, max_hours):
+            logger.warning(f"{date:%Y-%m-%d} 的文字版在等待时间内未发布，本次不处理")
+            return False
+        
+        # 与每日定时任务保持一致：写入Notion的日期为播出日的次日
+        return process_broadcast(date, date + datetime.timedelta(days=1))
+    except Exception as e:
+        import traceback
+        logger.error(f"程序运行出错: {str(e)}")
+        send_error_notification("程序运行错误", f"新闻联播程序运行失败: {str(e)}", "新闻联播自动化系统",
+                                log_info=f"完整错误堆栈: {traceback.format_exc()}")
+        return False
+    finally:
+        run_metrics.emit()
+        flush_notifications()
+        logger.info(usage_ledger.report())
+
+def parse_date(value):
+    """解析YYYY-MM-DD格式的日期参数"""
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日期格式应为YYYY-MM-DD: {value}")
+
+def command_check():
+    """检查环境变量和本地目录，不导入任何SDK"""
+    ok = check_required_env()
+    print(f"环境变量: {'完整' if ok else '缺失，详见日志'}")
+    print(f"缓存目录: {CACHE_DIR}{'（已禁用）' if CACHE_DISABLED else ''}")
+    print(f"运行记录目录: {RUNS_DIR}")
+    print(f"生成模式: {GENERATION_MODE}，摘要模型: {'/'.join(GEMINI_SUMMARY_MODELS)}，笔记模型: {'/'.join(GEMINI_NOTES_MODELS)}")
+    return ok
+
+def command_fetch(date):
+    """只读取页面正文并写入运行记录"""
+    url, title = get_broadcast_url(date)
+    content = fetch_stage(RunJournal(date.strftime("%Y-%m-%d")), url)
+    if content is None:
+        return False
+    print(f"{title}: {len(content)} 字符")
+    return True
+
+def command_summarize(date):
+    """读取正文（已有记录时复用）并生成摘要"""
+    url, title = get_broadcast_url(date)
+    journal = RunJournal(date.strftime("%Y-%m-%d"))
+    content = fetch_stage(journal, url)
+    if content is None:
+        return False
+    summary = summarize_content(condense_transcript(content))
+    if summary == SUMMARY_PLACEHOLDER:
+        return False
+    journal.record("summarized", summary)
+    print(summary)
+    return True
+
+def command_notion(date):
+    """用运行记录中的正文和摘要保存到Notion"""
+    url, title = get_broadcast_url(date)
+    journal = RunJournal(date.strftime("%Y-%m-%d"))
+    if not journal.is_done("fetched") or not journal.is_done("summarized"):
+        logger.error(f"{title} 还没有正文或摘要，请先运行 fetch 和 summarize")
+        return False
+    # 与每日定时任务保持一致：写入Notion的日期为播出日的次日
+    page_id = notion_stage(journal, title, journal.get("fetched"), journal.get("summarized"),
+                           date + datetime.timedelta(days=1))
+    return bool(page_id)
+
+def command_email(date):
+    """用运行记录中的摘要和笔记重新发送邮件，不调用Gemini"""
+    url, title = get_broadcast_url(date)
+    journal = RunJournal(date.strftime("%Y-%m-%d"))
+    if not journal.is_done("summarized") and not journal.is_done("notes_generated"):
+        logger.error(f"{title} 还没有摘要或笔记，请先运行 summarize 或完整流程")
+        return False
+    summary = journal.get("summarized") or SUMMARY_PLACEHOLDER
+    email_sent = send_email(title, summary, journal.get("fetched"), html_notes=journal.get("notes_generated"),
+                            run_id=journal.run_id)
+    if email_sent:
+        journal.record("email_sent", True)
+        logger.info("成功发送邮件")
+    return email_sent
+
+def command_profiles(date):
+    """为其他笔记版本的订阅者生成并发送笔记，复用运行记录中的正文和基础分析"""
+    url, title = get_broadcast_url(date)
+    journal = RunJournal(date.strftime("%Y-%m-%d"))
+    content = fetch_stage(journal, url)
+    if content is None:
+        return False
+    return profile_stage(journal, content, title)
+
+COMMANDS = {
+    "fetch": command_fetch,
+    "summarize": command_summarize,
+    "notion": command_notion,
+    "email": command_email,
+    "profiles": command_profiles,
+}
+
+def cli(argv=None):
+    """命令行入口，返回进程退出码"""
+    global CACHE_DISABLED, IGNORE_JOURNAL
+    parser = argparse.ArgumentParser(description="新闻联播摘要生成程序")
+    parser.add_argument("--backfill", nargs=2, type=parse_date, metavar=("START", "END"),
+                        help="补跑指定日期范围（YYYY-MM-DD，包含首尾）")
+    parser.add_argument("--workers", type=int, default=None, help="回填模式下同时处理的日期数")
+    parser.add_argument("--no-cache", action="store_true", help="不读取也不写入本地缓存")
+    parser.add_argument("--force", action="store_true", help="忽略已有运行记录，重新执行所有阶段")
+    parser.add_argument("--usage", action="store_true", help="显示今天各API的用量和配额占用后退出")
+    parser.add_argument("--wait", nargs="?", const=True, type=parse_date, metavar="DATE",
+                        help="轮询等待指定日期（默认昨天）的文字版发布，发布后立即处理")
+    parser.add_argument("--wait-hours", type=float, default=None, help="--wait模式下最多等待的小时数")
+    
+    # 子命令只执行单个阶段，只加载该阶段需要的SDK
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    subparsers.add_parser("check", help="检查环境变量和本地目录")
+    for name, help_text in (("fetch", "只读取页面正文"), ("summarize", "读取正文并生成摘要"),
+                            ("notion", "用已有的正文和摘要保存到Notion"), ("email", "用已有的摘要和笔记重新发送邮件"),
+                            ("profiles", "为其他笔记版本的订阅者生成并发送笔记")):
+        subparser = subparsers.add_parser(name, help=help_text)
+        subparser.add_argument("date", nargs="?", type=parse_date, default=None, help="播出日期（YYYY-MM-DD），默认昨天")
+    args = parser.parse_args(argv)
+    
+    setup_logging()
+    if args.no_cache:
+        CACHE_DISABLED = True
+    if args.force:
+        IGNORE_JOURNAL = True
+    
+    if args.command == "check":
+        return 0 if command_check() else 1
+    if args.command:
+        date = args.date or datetime.datetime.now() - datetime.timedelta(days=1)
+        try:
+            # 单独执行的阶段同样读写运行记录，不能与调度器中同一天的任务同时进行
+            with date_lock(date.strftime("%Y-%m-%d")):
+                return 0 if COMMANDS[args.command](date) else 1
+        finally:
+            flush_notifications()
+    
+    if args.usage:
+        print(usage_ledger.report())
+    elif args.wait:
+        logger.info("开始等待新闻联播文字版发布")
+        watch(None if args.wait is True else args.wait, max_hours=args.wait_hours)
+    elif args.backfill:
+        logger.info("开始回填新闻联播摘要")
+        backfill(args.backfill[0], args.backfill[1], max_workers=args.workers)
+    else:
+        logger.info("开始运行新闻联播摘要生成程序")
+        main()
+    return 0
+
 if __name__ == "__main__":
-    logger.info("开始运行新闻联播摘要生成程序")
-    main()
+    import sys
+    sys.exit(cli())